@@ -0,0 +1,83 @@
+"""
+Synthetic plugin used by the benchmarks.
+
+Behaves like a real plugin's extract and transform commands, with the amount of work set through environment
+variables:
+
+- BENCH_FILES: raw files written by extract
+- BENCH_FILE_BYTES: size of each file
+- BENCH_META_EVERY: a meta file is written every N raw files
+- BENCH_EXTRACT_SECONDS / BENCH_TRANSFORM_SECONDS: time spread over the files, to mimic slow sources
+"""
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+
+def _write(path: Path, body: bytes) -> None:
+    # Finalized with a rename, like plugins that support streaming
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_bytes(body)
+    tmp_path.replace(path)
+
+
+def _body(index: int, size: int) -> bytes:
+    record = json.dumps({"index": index, "padding": ""})
+    return record.replace('""', '"' + "x" * max(size - len(record), 0) + '"').encode()
+
+
+def extract(out_dir: Path, start_date: datetime, end_date: datetime) -> None:
+    files = int(os.environ.get("BENCH_FILES", "100"))
+    size = int(os.environ.get("BENCH_FILE_BYTES", "1024"))
+    meta_every = int(os.environ.get("BENCH_META_EVERY", "10"))
+    delay = float(os.environ.get("BENCH_EXTRACT_SECONDS", "0")) / max(files, 1)
+    step = (end_date - start_date) / max(files, 1)
+
+    for i in range(files):
+        _write(out_dir / f"{i:07d}.json", _body(i, size))
+        if (i + 1) % meta_every == 0 or i == files - 1:
+            meta = {"extract_start": (start_date + step * (i + 1)).isoformat()}
+            _write(out_dir / f"{i:07d}.meta.json", json.dumps(meta).encode())
+        if delay:
+            time.sleep(delay)
+
+
+def transform(in_dir: Path, out_dir: Path) -> None:
+    files = sorted(path for path in in_dir.iterdir() if path.suffix == ".json" and not path.name.endswith(".meta.json"))
+    delay = float(os.environ.get("BENCH_TRANSFORM_SECONDS", "0")) / max(len(files), 1)
+
+    for path in files:
+        record = json.loads(path.read_bytes())
+        record["transformed"] = True
+        _write(out_dir / path.name, json.dumps(record).encode())
+        if delay:
+            time.sleep(delay)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["extract", "transform"])
+    parser.add_argument("--start_date", type=float)
+    parser.add_argument("--end_date", type=float)
+    parser.add_argument("--in_dir", type=Path)
+    parser.add_argument("--out_dir", type=Path, required=True)
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        start_date = datetime.fromtimestamp(args.start_date, timezone.utc)
+        end_date = (
+            datetime.fromtimestamp(args.end_date, timezone.utc)
+            if args.end_date is not None
+            else max(datetime.now(timezone.utc), start_date + timedelta(seconds=1))
+        )
+        extract(args.out_dir, start_date, end_date)
+    else:
+        transform(args.in_dir, args.out_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Benchmarks the ingest path: a plugin run followed by the upload and publishing of its output.
+
+A synthetic plugin (benchmarks/plugin) writes the configured amount of files, storage and queue are the in-memory
+fakes from lomnia_ingester.fakes with a simulated latency, and uv is replaced by a shim that runs the plugin script
+directly so the numbers don't depend on uv or the network.
+
+    python benchmarks/run.py                       # every scenario
+    python benchmarks/run.py many-small --iterations 5
+    python benchmarks/run.py --save-baseline       # keep the results in benchmarks/baseline.json
+    python benchmarks/run.py --compare             # fail when a scenario got slower than the baseline
+
+Baselines are machine specific, record one on the machine the comparison runs on.
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+from pydantic.dataclasses import dataclass
+
+from lomnia_ingester import metrics
+from lomnia_ingester.config import (
+    CacheConfig,
+    Configs,
+    CoordinationConfig,
+    MetricsConfig,
+    PluginsConfig,
+    QueueConfig,
+    RetryConfig,
+    S3Config,
+    SchedulerConfig,
+    SpoolConfig,
+    StoreConfig,
+)
+from lomnia_ingester.context import AppContext, set_context
+from lomnia_ingester.fakes import InMemoryQueuePublisher, InMemoryStorage
+from lomnia_ingester.models import Plugin
+from lomnia_ingester.plugin_scheduler import run_and_record
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+PLUGIN_DIR = BENCHMARKS_DIR / "plugin"
+DEFAULT_BASELINE = BENCHMARKS_DIR / "baseline.json"
+
+UV_SHIM = """#!{python}
+import os
+import sys
+
+# uv sync has nothing to install, uv run --no-sync <command> runs the synthetic plugin with that command
+args = sys.argv[1:]
+if args[0] == "sync":
+    os.makedirs(os.environ["UV_PROJECT_ENVIRONMENT"], exist_ok=True)
+    sys.exit(0)
+os.execv({python!r}, [{python!r}, "synthetic_plugin.py", *args[2:]])
+"""
+
+
+@dataclass
+class Scenario:
+    files: int
+    file_bytes: int
+    extract_seconds: float = 0
+    streaming: bool = False
+    packing: bool = False
+    store_backend: str = "sqlite"
+    upload_latency_seconds: float = 0.005
+    publish_latency_seconds: float = 0.002
+
+
+SCENARIOS = {
+    "smoke": Scenario(files=20, file_bytes=1024),
+    "many-small": Scenario(files=2000, file_bytes=512),
+    "few-large": Scenario(files=10, file_bytes=16 * 1024**2),
+    "slow-extract-streaming": Scenario(files=500, file_bytes=4096, extract_seconds=2, streaming=True),
+    "slow-extract": Scenario(files=500, file_bytes=4096, extract_seconds=2),
+    "many-small-packed": Scenario(files=2000, file_bytes=512, packing=True),
+}
+
+
+def install_uv_shim(bin_dir: Path) -> None:
+    shim = bin_dir / "uv"
+    shim.write_text(UV_SHIM.format(python=sys.executable))
+    shim.chmod(0o755)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+
+
+def build_context(name: str, scenario: Scenario, work_dir: Path) -> tuple[AppContext, Plugin]:
+    plugin = Plugin(
+        id=f"bench-{name}",
+        path=PLUGIN_DIR,
+        folder=None,
+        env={
+            "BENCH_FILES": str(scenario.files),
+            "BENCH_FILE_BYTES": str(scenario.file_bytes),
+            "BENCH_EXTRACT_SECONDS": str(scenario.extract_seconds),
+        },
+        schedule={"interval_minutes": 1},
+        streaming={"enabled": scenario.streaming, "poll_interval_seconds": 0.1},
+        packing={"enabled": scenario.packing},
+    )
+    store_path = work_dir / ("state.sqlite" if scenario.store_backend == "sqlite" else "state.json")
+    config = Configs(
+        s3=S3Config(
+            s3_bucket_name="bench",
+            s3_url="http://localhost",
+            s3_region_name="local",
+            s3_access_key_id="bench",
+            s3_secret_access_key="bench",  # noqa: S106
+        ),
+        queue=QueueConfig(
+            queue_host="localhost",
+            queue_port=5672,
+            queue_username="bench",
+            queue_password="bench",  # noqa: S106
+            queue_name="bench",
+        ),
+        plugins=PluginsConfig(plugins=[plugin]),
+        store=StoreConfig(store_backend=scenario.store_backend, store_path=store_path, upload_index_path=None),
+        cache=CacheConfig(cache_dir=work_dir / "cache"),
+        scheduler=SchedulerConfig(),
+        metrics=MetricsConfig(metrics_port=None),
+        spool=SpoolConfig(spool_enabled=False),
+        retry=RetryConfig(),
+        coordination=CoordinationConfig(),
+    )
+    context = AppContext(
+        config=config,
+        storage=InMemoryStorage("bench", latency_seconds=scenario.upload_latency_seconds),
+        queue_publisher=InMemoryQueuePublisher(latency_seconds=scenario.publish_latency_seconds),
+    )
+    return context, plugin
+
+
+def stage_seconds(plugin_id: str) -> dict[str, tuple[int, float]]:
+    return {
+        stage: totals
+        for (label_plugin_id, stage), totals in metrics.stage_seconds.totals().items()
+        if label_plugin_id == plugin_id
+    }
+
+
+def run_scenario(name: str, scenario: Scenario, iterations: int) -> dict:
+    with tempfile.TemporaryDirectory(prefix="lomnia-bench-") as tmp:
+        work_dir = Path(tmp)
+        context, plugin = build_context(name, scenario, work_dir)
+        set_context(context)
+
+        # Checks out the plugin and "syncs" its environment, both cached for the measured iterations
+        run_and_record(plugin)
+        before = stage_seconds(plugin.id)
+
+        durations = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            run_and_record(plugin)
+            durations.append(time.perf_counter() - started)
+
+        after = stage_seconds(plugin.id)
+        objects = len(context.storage.objects)
+        messages = len(context.queue_publisher.messages)
+        set_context(None)
+
+    stages = {
+        stage: round((total - before.get(stage, (0, 0.0))[1]) / iterations, 4) for stage, (_, total) in after.items()
+    }
+    p50 = statistics.median(durations)
+    # Raw and canonical copy of every file
+    files = scenario.files * 2
+    return {
+        "iterations": iterations,
+        "wall_seconds_p50": round(p50, 4),
+        "wall_seconds_max": round(max(durations), 4),
+        "files_per_second": round(files / p50, 1),
+        "megabytes_per_second": round(files * scenario.file_bytes / p50 / 1024**2, 2),
+        "stage_seconds": stages,
+        "objects_stored": objects,
+        "messages_published": messages,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        limit = expected["wall_seconds_p50"] * (1 + tolerance)
+        if result["wall_seconds_p50"] > limit:
+            regressions.append(
+                f"{name}: p50 {result['wall_seconds_p50']}s, baseline {expected['wall_seconds_p50']}s "
+                f"(+{tolerance:.0%} allowed)"
+            )
+    return regressions
+
+
+def print_results(results: dict, baseline: Optional[dict]) -> None:
+    for name, result in results.items():
+        line = (
+            f"{name:<24} p50={result['wall_seconds_p50']:.3f}s max={result['wall_seconds_max']:.3f}s "
+            f"{result['files_per_second']:.0f} files/s {result['megabytes_per_second']:.2f} MB/s"
+        )
+        if baseline and name in baseline:
+            change = result["wall_seconds_p50"] / baseline[name]["wall_seconds_p50"] - 1
+            line += f" ({change:+.0%} vs baseline)"
+        print(line)
+        # Summed over threads, stages running in parallel like upload can add up to more than the wall time
+        for stage, seconds in sorted(result["stage_seconds"].items()):
+            print(f"    {stage:<16} {seconds:.4f}s")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the plugin run and publish path")
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run, all by default: {', '.join(SCENARIOS)}")
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results to the baseline file")
+    parser.add_argument("--compare", action="store_true", help="Exit with an error on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown before it's a regression")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix="lomnia-bench-bin-") as bin_dir:
+        install_uv_shim(Path(bin_dir))
+        results = {name: run_scenario(name, SCENARIOS[name], args.iterations) for name in args.scenarios or SCENARIOS}
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else None
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results, baseline)
+
+    if args.save_baseline:
+        merged = {**(baseline or {}), **results}
+        args.baseline.write_text(json.dumps(merged, indent=2, sort_keys=True) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+
+    if args.compare:
+        if baseline is None:
+            print(f"No baseline at {args.baseline}, record one with --save-baseline")
+            return 1
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
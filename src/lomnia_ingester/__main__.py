@@ -1,15 +1,23 @@
 import logging
 
+from dotenv import load_dotenv
+
+from lomnia_ingester.config import LoggingConfig
 from lomnia_ingester.logging import setup_logging
 from lomnia_ingester.plugin_scheduler import schedule_and_wait
 
-setup_logging(level="DEBUG")
+load_dotenv()
+logging_config = LoggingConfig()
+setup_logging(
+    level=logging_config.log_level,
+    log_format=logging_config.log_format,
+    max_message_chars=logging_config.log_max_message_chars,
+    queue_size=logging_config.log_queue_size,
+)
 
 logger = logging.getLogger(__name__)
 logger.info("Application starting")
 
-logger.info("Loading config")
-
 
 if __name__ == "__main__":
     schedule_and_wait()
@@ -0,0 +1,104 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from lomnia_ingester.context import get_context
+from lomnia_ingester.models import FailedToRunPlugin, Plugin
+
+logger = logging.getLogger(__name__)
+
+
+def plan_windows(start_date: datetime, end_date: datetime, window: timedelta) -> list[tuple[datetime, datetime]]:
+    windows = []
+    window_start = start_date
+    while window_start < end_date:
+        window_end = min(window_start + window, end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+
+def needs_backfill(plugin: Plugin, start_date: datetime) -> bool:
+    if not plugin.backfill.enabled:
+        return False
+    return datetime.now(timezone.utc) - start_date > timedelta(hours=plugin.backfill.window_hours)
+
+
+def run_backfill(
+    plugin: Plugin,
+    start_date: datetime,
+    run_window: Callable[[datetime, datetime], None],
+    *,
+    fencing_token: Optional[int] = None,
+) -> None:
+    """
+    Extracts from start_date until now one window at a time, running up to max_parallel_windows of them at once.
+
+    Each window is delivered and checkpointed in the store on its own. The watermark only moves over windows that
+    completed without a gap from start_date, so a failed window is retried on the next run while the windows after
+    it that already completed are skipped. Windows are planned from the watermark with a fixed length, so a later
+    run plans the same windows as long as window_hours doesn't change. Every window takes one of the
+    SCHEDULER_MAX_WORKERS run slots, so a backfill never runs more extracts at once than the scheduler allows.
+    """
+    store = get_context().store
+    backfill = plugin.backfill
+    completed = store.completed_windows(plugin.id)
+    windows = [
+        window
+        for window in plan_windows(start_date, datetime.now(timezone.utc), timedelta(hours=backfill.window_hours))
+        if window[0] not in completed
+    ]
+
+    logger.info(
+        f"Starting backfill | plugin_id={plugin.id} | start_date={start_date.isoformat()} | windows={len(windows)} | "
+        f"already_completed={len(completed)}"
+    )
+
+    lock = threading.Lock()
+
+    def run(window_start: datetime, window_end: datetime):
+        logger.info(
+            f"Running backfill window | plugin_id={plugin.id} | start_date={window_start.isoformat()} | "
+            f"end_date={window_end.isoformat()}"
+        )
+        run_window(window_start, window_end)
+
+        with lock:
+            store.record_window(plugin.id, window_start, window_end, fencing_token=fencing_token)
+            completed[window_start] = window_end
+            _advance_watermark(plugin, start_date, completed, fencing_token)
+
+    with ThreadPoolExecutor(max_workers=backfill.max_parallel_windows, thread_name_prefix="backfill") as executor:
+        futures = [executor.submit(run, window_start, window_end) for window_start, window_end in windows]
+
+    failed = [future for future in futures if future.exception() is not None]
+    for future in failed:
+        logger.error(f"Backfill window failed | plugin_id={plugin.id} | error={future.exception()!r}")
+
+    if failed:
+        raise FailedToRunPlugin("BACKFILL_WINDOWS_FAILED")
+
+    logger.info(f"Backfill completed | plugin_id={plugin.id}")
+
+
+def _advance_watermark(
+    plugin: Plugin, start_date: datetime, completed: dict[datetime, datetime], fencing_token: Optional[int]
+) -> None:
+    watermark = start_date
+    while watermark in completed:
+        watermark = completed[watermark]
+
+    if watermark == start_date:
+        return
+
+    store = get_context().store
+    logger.info(f"Advancing backfill watermark | plugin_id={plugin.id} | next_start_date={watermark.isoformat()}")
+    store.set_next_start_date(
+        plugin_name=plugin.id,
+        next_start_date=watermark,
+        last_successful_run=datetime.now(timezone.utc),
+        fencing_token=fencing_token,
+    )
+    store.clear_windows(plugin.id, before=watermark)
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from lomnia_ingester.cache.lru import evict_lru, touch
+from lomnia_ingester.command import run_command
+from lomnia_ingester.models import FailedToRunPlugin
+
+logger = logging.getLogger(__name__)
+
+READY_MARKER = ".lomnia-synced"
+LOCK_FILES = ("pyproject.toml", "uv.lock")
+
+
+def environment_key(work_dir: Path) -> str:
+    """
+    Hash of the plugin folder location and its dependency files.
+
+    The location is part of the key because uv installs the plugin itself in editable mode, so an environment
+    only works for the checkout it was synced from.
+    """
+    digest = hashlib.sha256(str(work_dir.resolve()).encode())
+    for name in LOCK_FILES:
+        path = work_dir / name
+        digest.update(name.encode())
+        if path.exists():
+            digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+class EnvironmentCache:
+    """
+    Keeps one virtual environment per plugin folder and lockfile hash.
+
+    `uv sync` only runs the first time a hash is seen, later runs reuse the environment through
+    UV_PROJECT_ENVIRONMENT. Environments are evicted least recently used first once they take more than max_bytes.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._key_locks: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
+        self._in_use: defaultdict[Path, int] = defaultdict(int)
+
+    @contextmanager
+    def environment(self, work_dir: Path, *, timeout: Optional[float] = None) -> Iterator[Path]:
+        key = environment_key(work_dir)
+        entry = self.root / f"{work_dir.name}-{key}"
+
+        with self._key_locks[key]:
+            if (entry / READY_MARKER).exists():
+                logger.debug(f"Reusing plugin environment | work_dir={work_dir} | env_dir={entry}")
+            else:
+                self._sync(work_dir, entry, timeout)
+            with self._lock:
+                self._in_use[entry] += 1
+                touch(entry)
+
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                self._in_use[entry] -= 1
+                if self._in_use[entry] == 0:
+                    del self._in_use[entry]
+                evict_lru(self.root, self.max_bytes, keep=set(self._in_use))
+
+    def _sync(self, work_dir: Path, entry: Path, timeout: Optional[float]) -> None:
+        uv = shutil.which("uv")
+        if uv is None:
+            logger.error("uv executable not found")
+            raise FailedToRunPlugin("MISSING_EXECUTABLE_UV")
+
+        logger.info(f"Syncing plugin environment | work_dir={work_dir} | env_dir={entry}")
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        run_command(
+            [uv, "sync"],
+            cwd=work_dir,
+            env={**os.environ, "UV_PROJECT_ENVIRONMENT": str(entry)},
+            description="uv sync",
+            timeout=timeout,
+        )
+        (entry / READY_MARKER).touch()
@@ -0,0 +1,65 @@
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+LAST_USED_MARKER = ".lomnia-last-used"
+
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+    return total
+
+
+def touch(entry: Path) -> None:
+    (entry / LAST_USED_MARKER).touch()
+
+
+def last_used(entry: Path) -> float:
+    try:
+        return (entry / LAST_USED_MARKER).stat().st_mtime
+    except OSError:
+        return 0.0
+
+
+def evict_lru(
+    root: Path,
+    max_bytes: int,
+    *,
+    keep: Optional[set[Path]] = None,
+    remove: Optional[Callable[[Path], None]] = None,
+) -> None:
+    """Remove the least recently used entries under root until it fits in max_bytes."""
+    if not root.exists():
+        return
+
+    keep = keep or set()
+    entries = [entry for entry in root.iterdir() if entry.is_dir()]
+    sizes = {entry: dir_size(entry) for entry in entries}
+    total = sum(sizes.values())
+
+    for entry in sorted(entries, key=last_used):
+        if total <= max_bytes:
+            break
+        if entry in keep:
+            continue
+
+        logger.info(
+            f"Evicting cache entry | entry={entry} | size={sizes[entry]} | last_used={time.ctime(last_used(entry))}"
+        )
+
+        if remove is not None:
+            remove(entry)
+        else:
+            shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
@@ -0,0 +1,198 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from lomnia_ingester.cache.lru import LAST_USED_MARKER, evict_lru, touch
+from lomnia_ingester.command import run_command
+from lomnia_ingester.models import FailedToRunPlugin, Plugin
+
+logger = logging.getLogger(__name__)
+
+# Never copied from a local plugin path nor removed from a synced checkout
+SYNC_IGNORED_NAMES = {".venv", "__pycache__", LAST_USED_MARKER}
+
+
+def _cache_key(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()[:16]
+
+
+class WorkspaceCache:
+    """
+    Keeps plugin checkouts on disk between runs.
+
+    Git plugins are fetched into a bare mirror and checked out as one worktree per commit, local plugins are
+    synced into a single checkout by comparing file size and mtime. A local checkout isn't synced while another
+    run uses it, e.g. a second plugin from the same path, so files never change under a running plugin. Entries are
+    evicted least recently used first once the checkouts take more than max_bytes.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.mirrors_dir = root / "mirrors"
+        self.checkouts_dir = root / "checkouts"
+
+        self._lock = threading.Lock()
+        self._key_locks: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
+        self._in_use: defaultdict[Path, int] = defaultdict(int)
+
+    @contextmanager
+    def checkout(self, plugin: Plugin) -> Iterator[Path]:
+        if plugin.repo:
+            source = str(plugin.repo)
+            prepare = self._checkout_repo
+        elif plugin.path:
+            source = str(plugin.path)
+            prepare = self._checkout_path
+        else:
+            logger.error(f"Plugin has no repo or path | plugin_id={plugin.id}")
+            raise FailedToRunPlugin("MISSING_REPO_OR_PATH")
+
+        key = _cache_key(source)
+        with self._key_locks[key]:
+            entry = prepare(source, key)
+            with self._lock:
+                self._in_use[entry] += 1
+                touch(entry)
+
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                self._in_use[entry] -= 1
+                if self._in_use[entry] == 0:
+                    del self._in_use[entry]
+                self._evict()
+
+    def _evict(self) -> None:
+        evict_lru(self.checkouts_dir, self.max_bytes, keep=set(self._in_use), remove=self._remove_entry)
+
+    def _remove_entry(self, entry: Path) -> None:
+        shutil.rmtree(entry, ignore_errors=True)
+
+        # Worktrees are registered in their mirror, let git forget about the deleted one
+        if entry.name.startswith("git-"):
+            key = entry.name.split("-")[1]
+            mirror = self.mirrors_dir / f"{key}.git"
+            if mirror.exists():
+                run_command(
+                    [self._git(), "--git-dir", str(mirror), "worktree", "prune"], description="git worktree prune"
+                )
+
+    def _git(self) -> str:
+        git = shutil.which("git")
+        if git is None:
+            logger.error("git executable not found")
+            raise FailedToRunPlugin("MISSING_EXECUTABLES")
+        return git
+
+    def _checkout_repo(self, repo_url: str, key: str) -> Path:
+        git = self._git()
+        mirror = self.mirrors_dir / f"{key}.git"
+
+        if mirror.exists():
+            logger.info(f"Fetching plugin repository | repo_url={repo_url} | mirror={mirror}")
+            run_command([git, "--git-dir", str(mirror), "fetch", "--prune", "--quiet"], description="git fetch")
+        else:
+            logger.info(f"Cloning plugin repository | repo_url={repo_url} | mirror={mirror}")
+            self.mirrors_dir.mkdir(parents=True, exist_ok=True)
+            run_command([git, "clone", "--mirror", "--quiet", repo_url, str(mirror)], description="git clone")
+
+        commit = run_command(
+            [git, "--git-dir", str(mirror), "rev-parse", "HEAD"],
+            description="git rev-parse",
+        ).stdout.strip()
+
+        entry = self.checkouts_dir / f"git-{key}-{commit[:12]}"
+        if entry.exists():
+            logger.debug(f"Reusing cached checkout | repo_url={repo_url} | commit={commit} | entry={entry}")
+            return entry
+
+        logger.info(f"Checking out plugin commit | repo_url={repo_url} | commit={commit} | entry={entry}")
+        self.checkouts_dir.mkdir(parents=True, exist_ok=True)
+        run_command(
+            [git, "--git-dir", str(mirror), "worktree", "add", "--detach", "--force", str(entry), commit],
+            description="git worktree add",
+        )
+        return entry
+
+    def _checkout_path(self, path: str, key: str) -> Path:
+        src = Path(path)
+        entry = self.checkouts_dir / f"path-{key}"
+
+        # Runs of the same source only start under its key lock, so nothing starts using it while it syncs
+        with self._lock:
+            in_use = self._in_use.get(entry, 0)
+        if in_use and entry.exists():
+            logger.info(f"Local plugin checkout in use, not syncing it | src={src} | entry={entry} | runs={in_use}")
+            return entry
+
+        logger.info(f"Syncing plugin from local path | src={src} | entry={entry}")
+
+        if not src.exists():
+            logger.error(f"Plugin path does not exist | src={src}")
+            raise FailedToRunPlugin("PATH_DOES_NOT_EXIST")
+
+        entry.mkdir(parents=True, exist_ok=True)
+        copied = sync_tree(src, entry)
+        logger.debug(f"Local plugin synced | src={src} | entry={entry} | copied_files={copied}")
+        return entry
+
+
+def sync_tree(src: Path, dst: Path) -> int:
+    """Make dst mirror src, copying only files whose size or mtime changed. Returns the number of copied files."""
+    seen: set[str] = set()
+    copied = _copy_changed(src, dst, seen)
+    _remove_stale(dst, seen)
+    return copied
+
+
+def _copy_changed(src: Path, dst: Path, seen: set[str]) -> int:
+    copied = 0
+
+    for root, dirs, files in os.walk(src):
+        dirs[:] = [d for d in dirs if d not in SYNC_IGNORED_NAMES]
+        rel_root = os.path.relpath(root, src)
+        (dst / rel_root).mkdir(parents=True, exist_ok=True)
+        seen.add(os.path.normpath(rel_root))
+
+        for name in files:
+            if name in SYNC_IGNORED_NAMES:
+                continue
+
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            seen.add(rel)
+            src_stat = (src / rel).stat()
+            try:
+                dst_stat = (dst / rel).stat()
+                if dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns == src_stat.st_mtime_ns:
+                    continue
+            except FileNotFoundError:
+                pass
+
+            shutil.copy2(src / rel, dst / rel)
+            copied += 1
+
+    return copied
+
+
+def _remove_stale(dst: Path, seen: set[str]) -> None:
+    for root, dirs, files in os.walk(dst, topdown=False):
+        rel_root = os.path.relpath(root, dst)
+        if any(part in SYNC_IGNORED_NAMES for part in Path(rel_root).parts):
+            continue
+
+        for name in dirs + files:
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            if name in SYNC_IGNORED_NAMES or rel in seen:
+                continue
+            if (dst / rel).is_dir():
+                shutil.rmtree(dst / rel, ignore_errors=True)
+            else:
+                (dst / rel).unlink(missing_ok=True)
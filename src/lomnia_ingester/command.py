@@ -0,0 +1,217 @@
+import contextlib
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import IO, Callable, Optional
+
+from lomnia_ingester import metrics
+from lomnia_ingester.models import ResourceUsage
+
+logger = logging.getLogger(__name__)
+
+# Lines of each stream kept around to report why a command failed
+TAIL_LINES = 200
+# Time a command gets to exit after SIGTERM before it's killed
+TERMINATE_GRACE_SECONDS = 10
+
+
+def _read_stream(stream: IO[str], name: str, tail: deque, description: str) -> None:
+    for line in stream:
+        line = line.rstrip("\n")
+        tail.append(line)
+        logger.debug("Command %s | description=%s | %s", name, description, line)
+        metrics.command_output_lines_total.inc(description=description, stream=name)
+    stream.close()
+
+
+class CommandResult(subprocess.CompletedProcess):
+    def __init__(self, args, returncode: int, stdout: str, stderr: str, usage: ResourceUsage):
+        super().__init__(args, returncode, stdout=stdout, stderr=stderr)
+        self.usage = usage
+
+
+# Exit code and resources used, returned once a command exited
+CommandExit = tuple[int, ResourceUsage]
+
+
+def _poll_process(process: subprocess.Popen) -> Optional[CommandExit]:
+    """Reaps the command with wait4 if it exited, which also gives the resources it used (and its waited children)."""
+    pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+    if not pid:
+        return None
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+    usage = ResourceUsage(
+        cpu_seconds=rusage.ru_utime + rusage.ru_stime,
+        # Linux reports max RSS in kilobytes
+        max_rss_bytes=rusage.ru_maxrss * 1024,
+    )
+    return process.returncode, usage
+
+
+def _wait_process(process: subprocess.Popen) -> Callable[[Optional[float]], bool]:
+    def wait_exit(timeout: Optional[float]) -> bool:
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        return True
+
+    return wait_exit
+
+
+def _wait(
+    cmd: list[str],
+    poll: Callable[[], Optional[CommandExit]],
+    timeout: Optional[float],
+    watchdog: Optional[Callable[[], None]],
+    watchdog_interval: float,
+) -> CommandExit:
+    """Waits for the command to exit, the watchdog is called every watchdog_interval seconds and stops it by raising."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    next_check = time.monotonic() + watchdog_interval
+    delay = 0.01
+
+    while True:
+        exited = poll()
+        if exited is not None:
+            return exited
+
+        now = time.monotonic()
+        if deadline is not None and now >= deadline:
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        if watchdog is not None and now >= next_check:
+            watchdog()
+            next_check = now + watchdog_interval
+
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def _terminate(pid: int, wait_exit: Callable[[Optional[float]], bool], description: str) -> None:
+    """Stops the command and everything it started, the command runs in its own process group."""
+    if wait_exit(0):
+        return
+
+    logger.warning(f"Terminating command | description={description} | pid={pid}")
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(pid, signal.SIGTERM)
+    if wait_exit(TERMINATE_GRACE_SECONDS):
+        return
+
+    logger.warning(f"Command didn't exit after SIGTERM, killing it | description={description} | pid={pid}")
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(pid, signal.SIGKILL)
+    wait_exit(None)
+
+
+def run_command(
+    cmd: list[str],
+    *,
+    cwd: Path | None = None,
+    env: dict | None = None,
+    description: str,
+    timeout: Optional[float] = None,
+    watchdog: Optional[Callable[[], None]] = None,
+    watchdog_interval: float = 5,
+) -> CommandResult:
+    """
+    Runs a command, logging its output line by line while it runs.
+
+    Only the last TAIL_LINES lines of stdout and stderr are kept, they're what the returned CommandResult and the
+    raised CalledProcessError/TimeoutExpired hold. The command is terminated with its whole process group when it
+    runs longer than timeout seconds, the watchdog raises or the caller is interrupted.
+    """
+    logger.info(f"Running command | description={description} | cmd={cmd} | cwd={cwd if cwd else None}")
+
+    process = subprocess.Popen(  # noqa: S603
+        cmd,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
+        start_new_session=True,
+    )
+
+    return supervise_command(
+        cmd,
+        pid=process.pid,
+        streams={"stdout": process.stdout, "stderr": process.stderr},
+        poll=lambda: _poll_process(process),
+        wait_exit=_wait_process(process),
+        description=description,
+        cwd=cwd,
+        timeout=timeout,
+        watchdog=watchdog,
+        watchdog_interval=watchdog_interval,
+    )
+
+
+def supervise_command(
+    cmd: list[str],
+    *,
+    pid: int,
+    streams: dict[str, IO[str]],
+    poll: Callable[[], Optional[CommandExit]],
+    wait_exit: Callable[[Optional[float]], bool],
+    description: str,
+    cwd: Path | None = None,
+    timeout: Optional[float] = None,
+    watchdog: Optional[Callable[[], None]] = None,
+    watchdog_interval: float = 5,
+) -> CommandResult:
+    """
+    Follows a started command until it exits, with the output handling and limits described in run_command.
+
+    The command must lead its own process group. poll returns its exit once it exited and wait_exit blocks up to the
+    given number of seconds, None meaning no limit, returning whether it exited. That lets commands that aren't
+    children of this process, e.g. forked by a plugin worker, be supervised like the ones run_command starts.
+    """
+    tails: dict[str, deque] = {name: deque(maxlen=TAIL_LINES) for name in streams}
+    readers = [
+        threading.Thread(
+            target=_read_stream,
+            args=(stream, name, tails[name], description),
+            name=f"command-{name}",
+            daemon=True,
+        )
+        for name, stream in streams.items()
+    ]
+    for reader in readers:
+        reader.start()
+
+    try:
+        returncode, usage = _wait(cmd, poll, timeout, watchdog, watchdog_interval)
+    except subprocess.TimeoutExpired:
+        logger.exception(f"Command timed out | description={description} | cmd={cmd} | timeout={timeout}s")
+        _terminate(pid, wait_exit, description)
+        for reader in readers:
+            reader.join()
+        raise subprocess.TimeoutExpired(  # noqa: B904
+            cmd, timeout, output="\n".join(tails["stdout"]), stderr="\n".join(tails["stderr"])
+        )
+    except BaseException:
+        _terminate(pid, wait_exit, description)
+        raise
+
+    for reader in readers:
+        reader.join()
+
+    stdout = "\n".join(tails["stdout"])
+    stderr = "\n".join(tails["stderr"])
+
+    if returncode != 0:
+        logger.error(
+            f"Command failed | cmd={cmd} | cwd={cwd if cwd else None} | returncode={returncode} | "
+            f"stdout_tail={stdout} | stderr_tail={stderr}"
+        )
+        raise subprocess.CalledProcessError(returncode, cmd, output=stdout, stderr=stderr)
+
+    return CommandResult(cmd, returncode, stdout=stdout, stderr=stderr, usage=usage)
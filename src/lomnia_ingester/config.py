@@ -1,25 +1,38 @@
 import logging
 from pathlib import Path
+from typing import TYPE_CHECKING, Literal, Optional
 
 import yaml
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator, model_validator
 from pydantic.dataclasses import dataclass
 from pydantic_settings import BaseSettings
 
-from lomnia_ingester.models import FailedToRunPlugin, Plugin
-from lomnia_ingester.plugin_output_publisher import PluginOutputPublisher
-from lomnia_ingester.plugin_state_store import PluginStateStore
-from lomnia_ingester.queue.publisher import QueuePublisher
-from lomnia_ingester.storage.s3_client import S3Storage
+from lomnia_ingester.models import FailedToLoadPlugin, FailedToRunPlugin, Plugin
+from lomnia_ingester.retry import RetryPolicy
+
+if TYPE_CHECKING:
+    from boto3.s3.transfer import TransferConfig
 
-load_dotenv()
 logger = logging.getLogger(__name__)
 
 
+PLUGINS_CONFIG_PATH = Path("plugins.yaml")
+
+
 class PluginsConfig(BaseModel):
     plugins: list[Plugin]
 
+    @field_validator("plugins")
+    @classmethod
+    def validate_unique_ids(cls, plugins: list[Plugin]) -> list[Plugin]:
+        ids = [plugin.id for plugin in plugins]
+        duplicates = sorted({plugin_id for plugin_id in ids if ids.count(plugin_id) > 1})
+        if duplicates:
+            logger.error(f"Plugin ids must be unique | duplicates={duplicates}")
+            raise FailedToLoadPlugin("DUPLICATE_PLUGIN_ID")
+        return plugins
+
 
 class S3Config(BaseSettings):
     s3_bucket_name: str = Field(default=...)
@@ -27,6 +40,22 @@ class S3Config(BaseSettings):
     s3_region_name: str = Field(default=...)
     s3_access_key_id: str = Field(default=...)
     s3_secret_access_key: str = Field(default=...)
+    s3_upload_concurrency: int = Field(default=8, ge=1, description="How many files are uploaded at the same time")
+    s3_multipart_threshold: int = Field(default=8 * 1024**2, description="Files above this size use multipart uploads")
+    s3_multipart_chunksize: int = Field(default=8 * 1024**2, description="Size of each part of a multipart upload")
+    s3_multipart_concurrency: int = Field(
+        default=4, ge=1, description="How many parts of one file are uploaded at once"
+    )
+
+    def transfer_config(self) -> "TransferConfig":
+        from boto3.s3.transfer import TransferConfig
+
+        # Memory used by uploads is bounded by upload_concurrency * multipart_concurrency * multipart_chunksize
+        return TransferConfig(
+            multipart_threshold=self.s3_multipart_threshold,
+            multipart_chunksize=self.s3_multipart_chunksize,
+            max_concurrency=self.s3_multipart_concurrency,
+        )
 
 
 class QueueConfig(BaseSettings):
@@ -38,7 +67,128 @@ class QueueConfig(BaseSettings):
 
 
 class StoreConfig(BaseSettings):
+    store_backend: Literal["json", "sqlite"] = Field(default="json", description="How plugin state is persisted")
     store_path: Path = Field(default=...)
+    store_migrate_from: Optional[Path] = Field(
+        default=None, description="plugins_state.json to import when the SQLite store is still empty"
+    )
+    upload_index_path: Optional[Path] = Field(
+        default=None, description="SQLite index of uploaded content hashes, enables upload deduplication when set"
+    )
+    upload_hash_mode: Literal["before_upload", "during_upload"] = Field(
+        default="before_upload",
+        description="Hash files in a pass of their own before uploading, so duplicates are never uploaded, or while "
+        "uploading them, reading each file once but still uploading duplicates. Events for duplicates are skipped "
+        "either way",
+    )
+    upload_dedup_mode: Literal["skip", "copy"] = Field(
+        default="skip",
+        description="What to do with a file that was already uploaded: skip it or server-side copy it to its new key",
+    )
+
+
+class SchedulerConfig(BaseSettings):
+    scheduler_max_workers: int = Field(default=1, ge=1, description="How many plugin runs can happen at the same time")
+    scheduler_reload_interval_seconds: float = Field(
+        default=5, ge=0, description="How often plugins.yaml is checked for changes, 0 turns reloading off"
+    )
+
+
+class MetricsConfig(BaseSettings):
+    metrics_port: Optional[int] = Field(default=None, description="Serve Prometheus metrics on this port when set")
+    metrics_host: str = Field(default="127.0.0.1", description="Address the metrics endpoint listens on")
+
+
+class LoggingConfig(BaseSettings):
+    log_level: Literal["DEBUG", "INFO", "WARNING", "ERROR"] = Field(
+        default="INFO", description="Lowest level logged by the ingester, DEBUG logs every command output line"
+    )
+    log_format: Literal["rich", "json"] = Field(
+        default="rich", description="rich renders for a terminal, json writes one object per line for log collectors"
+    )
+    log_max_message_chars: int = Field(
+        default=8192, ge=0, description="Truncate longer log messages, e.g. command output, 0 keeps them whole"
+    )
+    log_queue_size: int = Field(
+        default=10000, ge=1, description="Records waiting for the console above which new ones are dropped"
+    )
+
+
+class CacheConfig(BaseSettings):
+    cache_dir: Path = Field(default=Path(".cache"), description="Where plugin checkouts are kept between runs")
+    cache_max_bytes: int = Field(default=5 * 1024**3, description="Size above which old checkouts are evicted")
+    cache_env_max_bytes: int = Field(
+        default=10 * 1024**3, description="Size above which old plugin virtual environments are evicted"
+    )
+
+
+class SpoolConfig(BaseSettings):
+    spool_enabled: bool = Field(
+        default=False, description="Hand finished runs to a local spool and upload them in the background"
+    )
+    spool_mode: Literal["always", "on_failure"] = Field(
+        default="always",
+        description="Spool every finished run, or upload inline and only spool the outputs whose delivery failed",
+    )
+    spool_dir: Path = Field(default=Path("spool"), description="Where spooled outputs wait to be uploaded")
+    spool_work_dir: Optional[Path] = Field(
+        default=None,
+        description="Where plugin runs write their output. Defaults to spool_dir/work when the spool is enabled, so "
+        "spooling a run is a rename, and to the system temp directory otherwise",
+    )
+    spool_min_free_bytes: int = Field(
+        default=1024**3, ge=0, description="Free space the work directory needs before a plugin run starts"
+    )
+    spool_concurrency: int = Field(default=2, ge=1, description="How many spooled outputs are uploaded at once")
+    spool_max_attempts: int = Field(default=10, ge=1, description="Attempts before a spooled output is set aside")
+    spool_retry_backoff_seconds: float = Field(
+        default=30, description="Wait before retrying a failed spooled output, doubled on every attempt"
+    )
+    spool_poll_interval_seconds: float = Field(default=5, description="How often the spool is checked for retries")
+
+    def work_root(self) -> Optional[Path]:
+        if self.spool_work_dir is not None:
+            return self.spool_work_dir
+        return self.spool_dir / "work" if self.spool_enabled else None
+
+
+class RetryConfig(BaseSettings):
+    retry_attempts: int = Field(default=5, ge=1, description="Attempts of one S3 upload or queue publish")
+    retry_base_delay_seconds: float = Field(default=0.5, description="Upper bound of the first retry wait")
+    retry_max_delay_seconds: float = Field(default=30, description="Cap of the exponential retry wait")
+
+    def policy(self) -> RetryPolicy:
+        return RetryPolicy(
+            attempts=self.retry_attempts,
+            base_delay_seconds=self.retry_base_delay_seconds,
+            max_delay_seconds=self.retry_max_delay_seconds,
+        )
+
+
+class CoordinationConfig(BaseSettings):
+    coordination_enabled: bool = Field(
+        default=False,
+        description="Coordinate plugin runs between ingester replicas with leases, so each due run happens on one "
+        "node. Every replica needs the SQLite state store and the lease database on a shared volume",
+    )
+    coordination_backend: Literal["sqlite"] = Field(default="sqlite", description="Where leases are kept")
+    coordination_path: Path = Field(default=Path("leases.sqlite"), description="Lease database of the sqlite backend")
+    coordination_node_id: Optional[str] = Field(
+        default=None,
+        description="Name of this replica, required with coordination. Must differ between replicas and stay the same "
+        "when a replica is recreated, its spooled outputs and checkouts are kept under it",
+    )
+    coordination_lease_seconds: float = Field(
+        default=60, gt=0, description="How long a run's lease outlives a node that stopped renewing it"
+    )
+
+    @model_validator(mode="after")
+    def validate_node_id(self) -> "CoordinationConfig":
+        # A generated id, like a container's hostname, changes when the replica is recreated and its spool is orphaned
+        if self.coordination_enabled and not self.coordination_node_id:
+            logger.error("Coordination needs a stable node id, set COORDINATION_NODE_ID for every replica")
+            raise FailedToRunPlugin("MISSING_COORDINATION_NODE_ID")
+        return self
 
 
 @dataclass
@@ -47,10 +197,16 @@ class Configs:
     queue: QueueConfig
     plugins: PluginsConfig
     store: StoreConfig
+    cache: CacheConfig
+    scheduler: SchedulerConfig
+    metrics: MetricsConfig
+    spool: SpoolConfig
+    retry: RetryConfig
+    coordination: CoordinationConfig
 
 
-def load_plugins_config():
-    with open("plugins.yaml") as stream:
+def load_plugins_config(path: Path = PLUGINS_CONFIG_PATH) -> PluginsConfig:
+    with open(path) as stream:
         try:
             config = yaml.safe_load(stream)
             plugins = PluginsConfig(**config)
@@ -64,37 +220,48 @@ def load_plugins_config():
 
 
 def load_config() -> Configs:
+    # Read here rather than on import, so importing the ingester never changes os.environ
+    load_dotenv()
     try:
         s3_config = S3Config()
 
         queue_config = QueueConfig()
         store_config = StoreConfig()
+        cache_config = CacheConfig()
+        scheduler_config = SchedulerConfig()
+        metrics_config = MetricsConfig()
+        spool_config = SpoolConfig()
+        retry_config = RetryConfig()
+        coordination_config = CoordinationConfig()
         plugins_config = load_plugins_config()
     except Exception as exc:
         raise FailedToRunPlugin(str(exc))  # noqa: B904
 
-    return Configs(s3=s3_config, queue=queue_config, plugins=plugins_config, store=store_config)
-
-
-config = load_config()
-logger.info("Loading S3 config")
-storage = S3Storage(
-    bucket=config.s3.s3_bucket_name,
-    endpoint_url=config.s3.s3_url,
-    region_name=config.s3.s3_region_name,
-    access_key_id=config.s3.s3_access_key_id,
-    secret_access_key=config.s3.s3_secret_access_key,
-)
-
-logger.info("Loading queue config")
-queuePublisher = QueuePublisher(
-    host=config.queue.queue_host,
-    port=config.queue.queue_port,
-    username=config.queue.queue_username,
-    password=config.queue.queue_password,
-    queue_name=config.queue.queue_name,
-)
+    if coordination_config.coordination_enabled:
+        # With the JSON store every replica keeps its own state and the fencing tokens protect nothing
+        if store_config.store_backend != "sqlite":
+            logger.error("Coordinated replicas need a shared state store, set STORE_BACKEND=sqlite")
+            raise FailedToRunPlugin("COORDINATION_NEEDS_SQLITE_STORE")
 
-publisher = PluginOutputPublisher(storage, queuePublisher)
+        # Replicas can share the volumes, checkouts, environments and spooled outputs stay apart per node
+        node_id = coordination_config.coordination_node_id
+        cache_config = cache_config.model_copy(update={"cache_dir": cache_config.cache_dir / node_id})
+        spool_config = spool_config.model_copy(
+            update={
+                "spool_dir": spool_config.spool_dir / node_id,
+                "spool_work_dir": spool_config.spool_work_dir / node_id if spool_config.spool_work_dir else None,
+            }
+        )
 
-store = PluginStateStore(config.store.store_path)
+    return Configs(
+        s3=s3_config,
+        queue=queue_config,
+        plugins=plugins_config,
+        store=store_config,
+        cache=cache_config,
+        scheduler=scheduler_config,
+        metrics=metrics_config,
+        spool=spool_config,
+        retry=retry_config,
+        coordination=coordination_config,
+    )
@@ -0,0 +1,172 @@
+import logging
+import threading
+from typing import Any, Callable, Optional, TypeVar, Union
+
+from lomnia_ingester.cache.environment import EnvironmentCache
+from lomnia_ingester.cache.workspace import WorkspaceCache
+from lomnia_ingester.config import Configs, load_config
+from lomnia_ingester.coordination import LeaseCoordinator, SqliteLeaseBackend
+from lomnia_ingester.plugin_output_publisher import PluginOutputPublisher
+from lomnia_ingester.plugin_state_store import PluginStateStore, SqlitePluginStateStore
+from lomnia_ingester.plugin_worker import PluginWorkerPool
+from lomnia_ingester.queue.publisher import QueuePublisher
+from lomnia_ingester.spool import OutputSpool, SpoolUploader
+from lomnia_ingester.storage.s3_client import S3Storage
+from lomnia_ingester.storage.upload_index import UploadIndex
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def component(factory: Callable[["AppContext"], T]) -> T:
+    """Builds the component on first access and keeps it, a thread safe cached_property."""
+    name = factory.__name__
+
+    def get(self: "AppContext") -> T:
+        with self._lock:
+            if name not in self._components:
+                self._components[name] = factory(self)
+            return self._components[name]
+
+    return property(get, doc=factory.__doc__)  # type: ignore[return-value]
+
+
+class AppContext:
+    """
+    Holds the application components and builds each one the first time it's used.
+
+    Importing the ingester therefore doesn't read the environment, validate plugins.yaml or create any client.
+    Components can be replaced by passing them to the constructor, e.g. AppContext(storage=InMemoryStorage()).
+    """
+
+    def __init__(self, **overrides: Any):
+        self._lock = threading.RLock()
+        self._components: dict[str, Any] = {}
+
+        for name, value in overrides.items():
+            if not isinstance(getattr(type(self), name, None), property):
+                raise TypeError(name)
+            self._components[name] = value
+
+    @component
+    def config(self) -> Configs:
+        logger.info("Loading config")
+        return load_config()
+
+    @component
+    def storage(self) -> S3Storage:
+        logger.info("Loading S3 config")
+        s3 = self.config.s3
+        return S3Storage(
+            bucket=s3.s3_bucket_name,
+            endpoint_url=s3.s3_url,
+            region_name=s3.s3_region_name,
+            access_key_id=s3.s3_access_key_id,
+            secret_access_key=s3.s3_secret_access_key,
+            transfer_config=s3.transfer_config(),
+            max_pool_connections=s3.s3_upload_concurrency * s3.s3_multipart_concurrency,
+            retry=self.config.retry.policy(),
+        )
+
+    @component
+    def queue_publisher(self) -> QueuePublisher:
+        logger.info("Loading queue config")
+        queue = self.config.queue
+        return QueuePublisher(
+            host=queue.queue_host,
+            port=queue.queue_port,
+            username=queue.queue_username,
+            password=queue.queue_password,
+            queue_name=queue.queue_name,
+            retry=self.config.retry.policy(),
+        )
+
+    @component
+    def upload_index(self) -> Optional[UploadIndex]:
+        path = self.config.store.upload_index_path
+        return UploadIndex(path) if path else None
+
+    @component
+    def publisher(self) -> PluginOutputPublisher:
+        return PluginOutputPublisher(
+            self.storage,
+            self.queue_publisher,
+            upload_concurrency=self.config.s3.s3_upload_concurrency,
+            upload_index=self.upload_index,
+            dedup_mode=self.config.store.upload_dedup_mode,
+            hash_mode=self.config.store.upload_hash_mode,
+        )
+
+    @component
+    def store(self) -> Union[PluginStateStore, SqlitePluginStateStore]:
+        store = self.config.store
+        if store.store_backend == "sqlite":
+            return SqlitePluginStateStore(store.store_path, migrate_from=store.store_migrate_from)
+        return PluginStateStore(store.store_path)
+
+    @component
+    def coordinator(self) -> Optional[LeaseCoordinator]:
+        coordination = self.config.coordination
+        if not coordination.coordination_enabled:
+            return None
+        return LeaseCoordinator(
+            SqliteLeaseBackend(coordination.coordination_path),
+            coordination.coordination_node_id,
+            coordination.coordination_lease_seconds,
+        )
+
+    @component
+    def workspace_cache(self) -> WorkspaceCache:
+        cache = self.config.cache
+        return WorkspaceCache(cache.cache_dir / "workspaces", cache.cache_max_bytes)
+
+    @component
+    def environment_cache(self) -> EnvironmentCache:
+        cache = self.config.cache
+        return EnvironmentCache(cache.cache_dir / "environments", cache.cache_env_max_bytes)
+
+    @component
+    def worker_pool(self) -> PluginWorkerPool:
+        return PluginWorkerPool()
+
+    @component
+    def run_slots(self) -> threading.BoundedSemaphore:
+        """Plugin runs and backfill windows going at once are capped by SCHEDULER_MAX_WORKERS together."""
+        return threading.BoundedSemaphore(self.config.scheduler.scheduler_max_workers)
+
+    @component
+    def spool(self) -> OutputSpool:
+        return OutputSpool(self.config.spool.spool_dir)
+
+    @component
+    def spool_uploader(self) -> SpoolUploader:
+        spool = self.config.spool
+        return SpoolUploader(
+            self.spool,
+            self.publisher,
+            store=self.store,
+            concurrency=spool.spool_concurrency,
+            poll_interval_seconds=spool.spool_poll_interval_seconds,
+            max_attempts=spool.spool_max_attempts,
+            backoff_seconds=spool.spool_retry_backoff_seconds,
+        )
+
+
+_context: Optional[AppContext] = None
+_context_lock = threading.Lock()
+
+
+def get_context() -> AppContext:
+    global _context
+    with _context_lock:
+        if _context is None:
+            _context = AppContext()
+        return _context
+
+
+def set_context(context: Optional[AppContext]) -> None:
+    """Replaces the application context, None goes back to building a default one on next use."""
+    global _context
+    with _context_lock:
+        _context = context
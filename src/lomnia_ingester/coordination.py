@@ -0,0 +1,190 @@
+import logging
+import sqlite3
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional
+
+from pydantic.dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Lease:
+    name: str
+    owner: str
+    # Grows every time the lease changes hands, writes carrying an older token are rejected by the state store
+    token: int
+    acquired_at: datetime
+    expires_at: datetime
+    # When the last lease that did its work was taken, by this node or another one
+    last_run_at: Optional[datetime] = None
+
+
+class SqliteLeaseBackend:
+    """
+    Expiring leases kept in a SQLite database that every node opens, e.g. on a volume shared by the replicas.
+
+    SQLite needs working file locks, which a local or bind mounted directory has but network filesystems often
+    don't. Expiry is compared with each node's wall clock, so the clocks of the nodes must be roughly in sync.
+    Another backend only needs the same acquire, renew and release methods.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    token INTEGER NOT NULL,
+                    acquired_at TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_run_at TEXT
+                )
+                """
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def acquire(self, name: str, owner: str, ttl_seconds: float) -> Optional[Lease]:
+        """Takes the lease unless someone holds it, a lease that ran out without being renewed is free."""
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=ttl_seconds)
+
+        with self._transaction() as conn:
+            row = conn.execute("SELECT token, expires_at, last_run_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row["expires_at"] > now.timestamp():
+                return None
+
+            token = row["token"] + 1 if row is not None else 1
+            conn.execute(
+                """
+                INSERT INTO leases (name, owner, token, acquired_at, expires_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET
+                    owner = excluded.owner,
+                    token = excluded.token,
+                    acquired_at = excluded.acquired_at,
+                    expires_at = excluded.expires_at
+                """,
+                (name, owner, token, now.isoformat(), expires_at.timestamp()),
+            )
+
+        last_run_at = row["last_run_at"] if row is not None else None
+        return Lease(
+            name=name,
+            owner=owner,
+            token=token,
+            acquired_at=now,
+            expires_at=expires_at,
+            last_run_at=datetime.fromisoformat(last_run_at) if last_run_at is not None else None,
+        )
+
+    def renew(self, lease: Lease, ttl_seconds: float) -> bool:
+        """Extends the lease, False when it was taken over after running out."""
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE leases SET expires_at = ? WHERE name = ? AND token = ?",
+                (expires_at.timestamp(), lease.name, lease.token),
+            ).rowcount
+        if updated:
+            lease.expires_at = expires_at
+        return bool(updated)
+
+    def release(self, lease: Lease, *, ran: bool) -> None:
+        """Frees the lease, ran tells whether it did its work so the next holder can see when that happened."""
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                UPDATE leases SET expires_at = 0, last_run_at = CASE WHEN ? THEN ? ELSE last_run_at END
+                WHERE name = ? AND token = ?
+                """,
+                (ran, lease.acquired_at.isoformat(), lease.name, lease.token),
+            )
+
+
+class LeaseCoordinator:
+    """
+    Takes leases for this node and renews the ones it holds in the background until they're released.
+
+    A node that dies stops renewing, so its leases run out after lease_seconds and other nodes can take them.
+    """
+
+    def __init__(self, backend: SqliteLeaseBackend, node_id: str, lease_seconds: float):
+        self.backend = backend
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+
+        self._lock = threading.Lock()
+        self._held: dict[str, Lease] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def acquire(self, name: str) -> Optional[Lease]:
+        lease = self.backend.acquire(name, self.node_id, self.lease_seconds)
+        if lease is None:
+            return None
+
+        logger.debug(f"Acquired lease | name={name} | node_id={self.node_id} | token={lease.token}")
+        with self._lock:
+            self._held[name] = lease
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._renew_forever, name="lease-renewal", daemon=True)
+                self._thread.start()
+        return lease
+
+    def release(self, lease: Lease, *, ran: bool) -> None:
+        with self._lock:
+            self._held.pop(lease.name, None)
+        self.backend.release(lease, ran=ran)
+
+    def _renew_forever(self) -> None:
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock:
+                held = list(self._held.values())
+            for lease in held:
+                try:
+                    renewed = self.backend.renew(lease, self.lease_seconds)
+                except sqlite3.Error:
+                    logger.exception(f"Failed to renew lease | name={lease.name} | token={lease.token}")
+                    continue
+                if not renewed:
+                    # The run goes on but the state store rejects its writes, the new holder's token is higher
+                    logger.error(f"Lost lease | name={lease.name} | node_id={self.node_id} | token={lease.token}")
+                    with self._lock:
+                        self._held.pop(lease.name, None)
+
+    def stop(self) -> None:
+        """Frees the leases still held, their runs may not have finished so they don't count as done."""
+        self._stop.set()
+        with self._lock:
+            held = list(self._held.values())
+            self._held.clear()
+        for lease in held:
+            self.backend.release(lease, ran=False)
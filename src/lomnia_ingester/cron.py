@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+
+from pydantic.dataclasses import dataclass
+
+# Minute, hour, day of month, month, day of week (0 is Sunday, 7 is accepted as Sunday too)
+FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+# How far ahead next_after looks before deciding an expression never matches, e.g. "0 0 30 2 *"
+MAX_SEARCH_DAYS = 366 * 5
+
+
+class InvalidCronExpression(ValueError):
+    def __init__(self, value):
+        super().__init__(value)
+
+
+def _parse_field(field: str, low: int, high: int) -> frozenset[int]:
+    values: set[int] = set()
+    for part in field.split(","):
+        range_part, _, step_part = part.partition("/")
+        step = int(step_part) if step_part else 1
+
+        if range_part == "*":
+            start, end = low, high
+        elif "-" in range_part:
+            start_str, end_str = range_part.split("-", 1)
+            start, end = int(start_str), int(end_str)
+        else:
+            start = int(range_part)
+            # "5/15" means every 15 starting at 5
+            end = high if step_part else start
+
+        if start < low or end > high or start > end or step < 1:
+            raise InvalidCronExpression(field)
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+@dataclass(frozen=True)
+class CronExpression:
+    """
+    A standard five field cron expression: minute, hour, day of month, month and day of week.
+
+    Fields accept *, numbers, ranges (1-5), lists (1,15) and steps (*/10, 0-30/5). Like cron, when both the day of
+    month and the day of week are restricted a day matching either of them matches. A field starting with * counts
+    as unrestricted there, so "0 0 */2 * 1" runs on odd days that are also Mondays.
+    """
+
+    minutes: frozenset[int]
+    hours: frozenset[int]
+    days: frozenset[int]
+    months: frozenset[int]
+    weekdays: frozenset[int]
+    any_day: bool
+    any_weekday: bool
+
+    @classmethod
+    def parse(cls, expression: str) -> "CronExpression":
+        fields = expression.split()
+        if len(fields) != 5:
+            raise InvalidCronExpression(expression)
+
+        try:
+            minutes, hours, days, months, weekdays = (
+                _parse_field(field, low, high) for field, (low, high) in zip(fields, FIELD_RANGES)
+            )
+        except ValueError as exc:
+            raise InvalidCronExpression(expression) from exc
+
+        return cls(
+            minutes=minutes,
+            hours=hours,
+            days=days,
+            months=months,
+            weekdays=frozenset(day % 7 for day in weekdays),
+            any_day=fields[2].startswith("*"),
+            any_weekday=fields[4].startswith("*"),
+        )
+
+    def _day_matches(self, dt: datetime) -> bool:
+        # Python counts weekdays from Monday, cron from Sunday
+        weekday_matches = (dt.weekday() + 1) % 7 in self.weekdays
+        day_matches = dt.day in self.days
+        if self.any_day or self.any_weekday:
+            return day_matches and weekday_matches
+        return day_matches or weekday_matches
+
+    def next_after(self, after: datetime) -> datetime:
+        """First time strictly after `after` that matches, in the timezone of `after`."""
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after + timedelta(days=MAX_SEARCH_DAYS)
+
+        # Skips a month, day or hour at a time when it doesn't match instead of checking every minute
+        while dt <= limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+
+        raise InvalidCronExpression(self)
@@ -0,0 +1,73 @@
+import hashlib
+import threading
+import time
+from pathlib import Path
+
+
+class InMemoryStorage:
+    """
+    Stand-in for S3Storage that keeps uploaded objects in memory.
+
+    Meant for benchmarks and tests, e.g. AppContext(storage=InMemoryStorage()). latency_seconds is added to every
+    request to mimic the round trip to a real bucket.
+    """
+
+    def __init__(self, bucket: str = "lomnia", *, latency_seconds: float = 0):
+        self.bucket = bucket
+        self.latency_seconds = latency_seconds
+        self.objects: dict[str, bytes] = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def upload_file(self, file_path: Path, key: str) -> str:
+        body = file_path.read_bytes()
+        self._request()
+        with self._lock:
+            self.objects[key] = body
+        return key
+
+    def upload_file_hashed(self, file_path: Path, key: str) -> str:
+        self.upload_file(file_path, key)
+        return hashlib.sha256(self.objects[key]).hexdigest()
+
+    def copy_file(self, source_key: str, key: str) -> str:
+        self._request()
+        with self._lock:
+            self.objects[key] = self.objects[source_key]
+        return key
+
+    def object_exists(self, key: str) -> bool:
+        self._request()
+        with self._lock:
+            return key in self.objects
+
+    def _request(self) -> None:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._lock:
+            self.requests += 1
+
+
+class InMemoryQueuePublisher:
+    """Stand-in for QueuePublisher that keeps published messages in memory, latency is added per batch."""
+
+    def __init__(self, *, latency_seconds: float = 0):
+        self.latency_seconds = latency_seconds
+        self.messages: list[bytes] = []
+        self.batches = 0
+        self._lock = threading.Lock()
+
+    def publish(self, message: bytes):
+        self.publish_batch([message])
+
+    def publish_batch(self, messages: list[bytes]):
+        if not messages:
+            return
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._lock:
+            self.messages.extend(messages)
+            self.batches += 1
+
+    def close(self):
+        pass
@@ -1,31 +1,164 @@
+import atexit
+import json
 import logging
 import logging.config
+import logging.handlers
+import queue
+from datetime import datetime, timezone
+from typing import Any, Literal, Optional
 
 from rich.logging import RichHandler
 
+from lomnia_ingester import metrics
+
+# Attributes every LogRecord has, anything else on a record was passed with extra= and is a structured field
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def split_fields(message: str) -> tuple[str, dict[str, str]]:
+    """
+    Splits a "Message | key=value | key=value" log line into its message and fields.
+
+    A part that isn't key=value, e.g. a value holding " | " itself, stays with the field before it.
+    """
+    text, *parts = message.split(" | ")
+    fields: dict[str, str] = {}
+    last_key = None
+    for part in parts:
+        key, sep, value = part.partition("=")
+        if sep and key.isidentifier():
+            fields[key] = value
+            last_key = key
+        elif last_key is not None:
+            fields[last_key] += f" | {part}"
+        else:
+            text += f" | {part}"
+    return text, fields
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the key=value parts of the message and the extra= values as fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message, fields = split_fields(record.getMessage())
+        entry: dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": message,
+            **fields,
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TruncateFilter(logging.Filter):
+    """Caps the rendered message, command output and error tails can be megabytes long."""
+
+    def __init__(self, max_chars: int):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        if len(message) > self.max_chars:
+            record.msg = f"{message[: self.max_chars]}... [truncated {len(message) - self.max_chars} chars]"
+            record.args = None
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread without formatting them first, dropping them when the queue is full.
+
+    QueueHandler renders the message on the caller's thread so the record can be pickled, the queue here never
+    leaves the process so that's left to the listener. Arguments are rendered a bit later, they shouldn't be
+    mutated after being logged. A full queue means the console can't keep up, waiting for it would slow down the
+    plugin runs, so the record is dropped and counted instead.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_records_dropped_total.inc(level=record.levelname)
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # Waits for room instead of failing on a full queue, the listener is draining it
+        self.queue.put(self._sentinel)
+
+
+def _console_handler(log_format: Literal["rich", "json"], level: str) -> logging.Handler:
+    if log_format == "json":
+        handler: logging.Handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler = RichHandler(rich_tracebacks=True, show_time=True, show_level=True, show_path=True)
+    handler.setLevel(level)
+    return handler
+
+
+def stop_logging():
+    """Writes out the records still queued and stops the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def setup_logging(
+    level="INFO",
+    log_format: Literal["rich", "json"] = "rich",
+    max_message_chars: int = 0,
+    queue_size: int = 10000,
+):
+    """
+    Logs to the console from a background thread, callers only put their records on a queue.
+
+    rich renders for a terminal, json writes one object per line for log collectors. Messages longer than
+    max_message_chars are truncated, 0 keeps them whole. At most queue_size records wait for the console, the
+    ones logged past that are dropped.
+    """
+    global _listener
+    stop_logging()
+
+    handler = _console_handler(log_format, level)
+    if max_message_chars:
+        handler.addFilter(TruncateFilter(max_message_chars))
+
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    _listener = _QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.unregister(stop_logging)
+    atexit.register(stop_logging)
 
-def setup_logging(level="INFO"):
     logging.config.dictConfig({
         "version": 1,
         "disable_existing_loggers": False,
         "handlers": {
-            "console": {
-                "()": RichHandler,
-                "level": level,
-                "rich_tracebacks": True,
-                "show_time": True,
-                "show_level": True,
-                "show_path": True,
+            "queue": {
+                "()": DeferredQueueHandler,
+                "queue": log_queue,
             },
         },
         "root": {
-            "handlers": ["console"],
+            "handlers": ["queue"],
             "level": "WARNING",
         },
         "loggers": {
             "lomnia_ingester": {
                 "level": level,
-                "handlers": ["console"],
+                "handlers": ["queue"],
                 "propagate": False,
             }
         },
@@ -0,0 +1,227 @@
+import abc
+import logging
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TypeVar
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class _Metric(abc.ABC):
+    type_name = ""
+
+    def __init__(self, name: str, description: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...]) -> dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}", *self._samples()]
+
+    @abc.abstractmethod
+    def _samples(self) -> list[str]:
+        """Sample lines of every label set, without the HELP and TYPE lines."""
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, description, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self._labels(key))} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+        # Per label set: one count per bucket, the sum and the total count
+        self._values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def totals(self) -> dict[tuple[str, ...], tuple[int, float]]:
+        """Count and sum of the observations of every label set, in labelnames order."""
+        with self._lock:
+            return {key: (count, total) for key, (_, total, count) in self._values.items()}
+
+    def _samples(self) -> list[str]:
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                labels = self._labels(key)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append(f"{self.name}_bucket{_format_labels({**labels, 'le': str(bound)})} {bucket_count}")
+                samples.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+                samples.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                samples.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return samples
+
+
+M = TypeVar("M", bound=_Metric)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: M) -> M:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.register(
+    Histogram(
+        "lomnia_plugin_stage_seconds",
+        "Time spent in each stage of a plugin run",
+        ("plugin_id", "stage"),
+    )
+)
+runs_total = registry.register(Counter("lomnia_plugin_runs_total", "Finished plugin runs", ("plugin_id", "status")))
+runs_in_flight = registry.register(Gauge("lomnia_plugin_runs_in_flight", "Plugin runs currently going", ("plugin_id",)))
+schedule_lag_seconds = registry.register(
+    Gauge(
+        "lomnia_plugin_schedule_lag_seconds",
+        "Time the latest run of a plugin waited between being due and starting",
+        ("plugin_id",),
+    )
+)
+files_uploaded_total = registry.register(
+    Counter("lomnia_files_uploaded_total", "Files uploaded to storage", ("plugin_id", "kind"))
+)
+bytes_uploaded_total = registry.register(
+    Counter("lomnia_bytes_uploaded_total", "Bytes uploaded to storage", ("plugin_id", "kind"))
+)
+messages_published_total = registry.register(
+    Counter("lomnia_messages_published_total", "Messages published to the queue", ("plugin_id",))
+)
+retries_total = registry.register(
+    Counter("lomnia_retries_total", "Operations retried after a transient error", ("operation",))
+)
+cpu_seconds_total = registry.register(
+    Counter("lomnia_plugin_cpu_seconds_total", "CPU time used by plugin commands", ("plugin_id", "stage"))
+)
+max_rss_bytes = registry.register(
+    Gauge("lomnia_plugin_max_rss_bytes", "Peak resident memory of the latest plugin command", ("plugin_id", "stage"))
+)
+command_output_lines_total = registry.register(
+    Counter("lomnia_command_output_lines_total", "Lines written by commands", ("description", "stream"))
+)
+config_reloads_total = registry.register(
+    Counter("lomnia_config_reloads_total", "Changes of plugins.yaml picked up while running", ("result",))
+)
+lease_claims_total = registry.register(
+    Counter("lomnia_lease_claims_total", "Attempts to claim a due plugin run", ("plugin_id", "result"))
+)
+backoff_interval_seconds = registry.register(
+    Gauge(
+        "lomnia_plugin_backoff_interval_seconds",
+        "Interval an adaptive plugin backed off to after runs without new data, 0 on its regular schedule",
+        ("plugin_id",),
+    )
+)
+log_records_dropped_total = registry.register(
+    Counter("lomnia_log_records_dropped_total", "Log records dropped because the console couldn't keep up", ("level",))
+)
+worker_starts_total = registry.register(
+    Counter("lomnia_plugin_worker_starts_total", "Pre-warmed plugin worker processes started", ("plugin_id",))
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # noqa: A002
+        logger.debug(f"Metrics request | {format % args}")
+
+
+def start_metrics_server(host: str, port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info(f"Serving metrics | url=http://{host}:{server.server_port}/metrics")
+    return server
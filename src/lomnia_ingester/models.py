@@ -1,16 +1,119 @@
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Literal, Optional
 
-from pydantic import BaseModel, Field, HttpUrl
+from pydantic import BaseModel, Field, HttpUrl, field_validator
 from pydantic.dataclasses import dataclass
 
+from lomnia_ingester.cron import CronExpression
+
+
+class PluginAdaptiveSchedule(BaseModel):
+    enabled: bool = Field(
+        False,
+        description="Run the plugin less often while its runs bring no new data, i.e. don't move its extraction start "
+        "date, and go back to the regular schedule once one does. The regular schedule is the shortest interval",
+    )
+    empty_runs_before_backoff: int = Field(3, ge=1, description="Consecutive empty runs before the interval grows")
+    backoff_factor: float = Field(2, gt=1, description="How much the interval grows after each further empty run")
+    max_interval_minutes: float = Field(60, gt=0, description="Longest interval the plugin backs off to")
+
 
 class PluginSchedule(BaseModel):
     interval_minutes: Optional[int] = Field(None, description="Run plugin every N minutes")
     interval_hours: Optional[int] = Field(None, description="Run plugin every N hours")
     interval_days: Optional[int] = Field(None, description="Run plugin every N days")
-    interval_months: Optional[int] = Field(None, description="Run plugin every N months")
+    interval_months: Optional[int] = Field(None, description="Run plugin every N calendar months")
+    cron: Optional[str] = Field(None, description="Run plugin at the times matching this cron expression, in UTC")
+    jitter_seconds: float = Field(
+        0, ge=0, description="Delay each run by a random amount up to this, so plugins due together spread out"
+    )
+    adaptive: PluginAdaptiveSchedule = Field(
+        default_factory=PluginAdaptiveSchedule, description="Backing off from plugins that have nothing new"
+    )
+
+    @field_validator("cron")
+    @classmethod
+    def validate_cron(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None:
+            CronExpression.parse(value)
+        return value
+
+
+class PluginConcurrency(BaseModel):
+    max_concurrent_runs: int = Field(1, ge=1, description="How many runs of this plugin can happen at the same time")
+    on_overlap: Literal["skip", "queue"] = Field(
+        "skip",
+        description="What to do when the plugin is due while max_concurrent_runs are still going. "
+        "Queued runs are coalesced into a single one",
+    )
+
+
+class PluginStreaming(BaseModel):
+    enabled: bool = Field(
+        False,
+        description="Upload files and publish their events while the plugin is still running. The plugin must write "
+        "files under a hidden, .tmp or .part name and rename them once they are complete",
+    )
+    poll_interval_seconds: float = Field(1.0, gt=0, description="How often output directories are checked")
+    transform_batch_size: int = Field(
+        0,
+        ge=0,
+        description="Run transform on every N finalized raw files while extract is still running, the plugin's "
+        "transform must then accept any subset of the raw files. 0 waits for extract to finish",
+    )
+
+
+class PluginTimeouts(BaseModel):
+    extract_seconds: Optional[float] = Field(None, gt=0, description="Kill extract when it runs longer than this")
+    transform_seconds: Optional[float] = Field(None, gt=0, description="Kill transform when it runs longer than this")
+    sync_seconds: Optional[float] = Field(
+        None, gt=0, description="Kill uv sync of the plugin environment when it runs longer than this"
+    )
+
+
+class PluginResources(BaseModel):
+    cpu_seconds: Optional[int] = Field(None, gt=0, description="CPU time each plugin command can use (RLIMIT_CPU)")
+    memory_bytes: Optional[int] = Field(None, gt=0, description="Address space each plugin command can use (RLIMIT_AS)")
+    nice: Optional[int] = Field(None, ge=0, le=19, description="Niceness added to the plugin commands")
+    max_wall_seconds: Optional[float] = Field(
+        None, gt=0, description="Kill a plugin command running longer than this, on top of its own timeout"
+    )
+    max_output_bytes: Optional[int] = Field(
+        None, gt=0, description="Abort the run when the raw or canonical directory grows past this size"
+    )
+
+
+class PluginBackfill(BaseModel):
+    enabled: bool = Field(
+        False,
+        description="Split long extract ranges into windows that run in parallel. The plugin's extract must accept "
+        "an --end_date argument",
+    )
+    window_hours: float = Field(24, gt=0, description="Length of each backfill window")
+    max_parallel_windows: int = Field(2, ge=1, description="How many windows run at the same time")
+    start_date: Optional[datetime] = Field(None, description="Where extraction starts for a plugin without state")
+
+
+class PluginPacking(BaseModel):
+    enabled: bool = Field(
+        False,
+        description="Bundle the small canonical files of a run into compressed archives, published as one event "
+        "listing their members. Not used with streaming, files are uploaded before the run ends",
+    )
+    compression: Literal["gzip", "zstd"] = Field("gzip", description="zstd needs the zstandard package")
+    max_file_bytes: int = Field(1024**2, gt=0, description="Canonical files up to this size are packed")
+    max_pack_bytes: int = Field(256 * 1024**2, gt=0, description="Uncompressed size above which a new archive starts")
+
+
+class PluginExecution(BaseModel):
+    mode: Literal["command", "worker"] = Field(
+        "command",
+        description="command starts extract and transform with uv run every time. worker keeps a pre-warmed process "
+        "per plugin environment that forks them with the plugin already imported, the plugin must expose them as "
+        "console scripts and not start threads or connections at import time",
+    )
+    worker_max_runs: int = Field(100, ge=1, description="Commands a worker runs before it's replaced by a fresh one")
 
 
 class Plugin(BaseModel):
@@ -27,6 +130,47 @@ class Plugin(BaseModel):
     )
     schedule: PluginSchedule = Field(..., description="Scheduling information for the plugin")
     run_on_startup: bool = Field(default=False, description="Should the plugin run as soon as the program start")
+    concurrency: PluginConcurrency = Field(
+        default_factory=PluginConcurrency, description="Limits for overlapping runs of this plugin"
+    )
+    streaming: PluginStreaming = Field(
+        default_factory=PluginStreaming, description="Hand off output files as soon as the plugin writes them"
+    )
+    timeouts: PluginTimeouts = Field(
+        default_factory=PluginTimeouts, description="Time limits of the commands run for this plugin"
+    )
+    resources: PluginResources = Field(
+        default_factory=PluginResources, description="Limits on what the plugin commands can use on the host"
+    )
+    backfill: PluginBackfill = Field(
+        default_factory=PluginBackfill, description="How ranges longer than one window are extracted"
+    )
+    packing: PluginPacking = Field(
+        default_factory=PluginPacking, description="Bundling of small canonical files into archives"
+    )
+    execution: PluginExecution = Field(
+        default_factory=PluginExecution, description="How the plugin commands are started"
+    )
+
+
+@dataclass
+class UploadStats:
+    raw_files: int = 0
+    canonical_files: int = 0
+    bytes_uploaded: int = 0
+    events_published: int = 0
+
+
+@dataclass
+class ResourceUsage:
+    cpu_seconds: float = 0
+    max_rss_bytes: int = 0
+
+    def __add__(self, other: "ResourceUsage") -> "ResourceUsage":
+        return ResourceUsage(
+            cpu_seconds=self.cpu_seconds + other.cpu_seconds,
+            max_rss_bytes=max(self.max_rss_bytes, other.max_rss_bytes),
+        )
 
 
 @dataclass
@@ -35,6 +179,37 @@ class PluginOutput:
     canonical: Path
     extracted_at: datetime
     id: str
+    # Set when the output was already uploaded while the plugin ran
+    upload_stats: Optional[UploadStats] = None
+    # Files at the top of the raw directory, when the runner already listed them
+    raw_files: Optional[list[Path]] = None
+    # What the plugin commands used, summed over extract and transform
+    resource_usage: Optional[ResourceUsage] = None
+
+
+@dataclass
+class PluginRun:
+    plugin_id: str
+    started_at: datetime
+    finished_at: datetime
+    status: Literal["success", "failed"]
+    stats: UploadStats
+    error: Optional[str] = None
+    resource_usage: Optional[ResourceUsage] = None
+
+    @property
+    def duration_seconds(self) -> float:
+        return (self.finished_at - self.started_at).total_seconds()
+
+
+@dataclass
+class ScheduleBackoff:
+    """Where an adaptive schedule stands, kept in the state store between runs and across nodes."""
+
+    empty_runs: int = 0
+    # Interval the plugin backed off to, None while it runs on its regular schedule
+    interval_seconds: Optional[float] = None
+    updated_at: Optional[datetime] = None
 
 
 class FailedToRunPlugin(ValueError):
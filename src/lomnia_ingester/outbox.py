@@ -0,0 +1,68 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_NAME = "outbox.jsonl"
+
+
+class Outbox:
+    """
+    Append-only record of what was already delivered for one plugin output.
+
+    Every upload and every published batch of events is written down as soon as it's confirmed, so delivering
+    the same output again only uploads the files and publishes the events that are still missing.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._uploads: dict[str, dict] = {}
+        self._published: set[str] = set()
+
+        if path.exists():
+            self._load()
+
+    def upload(self, kind: str, file: Path) -> Optional[dict]:
+        with self._lock:
+            return self._uploads.get(f"{kind}/{file.name}")
+
+    def is_published(self, key: str) -> bool:
+        with self._lock:
+            return key in self._published
+
+    def record_upload(self, kind: str, file: Path, bucket: str, key: str, duplicate: bool) -> None:
+        entry = {"type": "upload", "file": f"{kind}/{file.name}", "bucket": bucket, "key": key, "duplicate": duplicate}
+        with self._lock:
+            self._append(entry)
+            self._uploads[entry["file"]] = entry
+
+    def record_published(self, keys: list[str]) -> None:
+        with self._lock:
+            self._append({"type": "published", "keys": keys})
+            self._published.update(keys)
+
+    def _append(self, entry: dict) -> None:
+        with self.path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _load(self) -> None:
+        with self.path.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line is cut short when the process died while writing it
+                    logger.warning(f"Ignoring unreadable outbox line | path={self.path}")
+                    continue
+
+                if entry["type"] == "upload":
+                    self._uploads[entry["file"]] = entry
+                elif entry["type"] == "published":
+                    self._published.update(entry["keys"])
@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from pydantic.dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+META_SUFFIX = ".meta.json"
+
+
+def read_extract_start(meta_path: Path) -> Optional[datetime]:
+    try:
+        with meta_path.open("r", encoding="utf-8") as f:
+            extract_start = json.load(f).get("extract_start")
+        return datetime.fromisoformat(extract_start) if extract_start else None
+    except Exception as exc:
+        logger.warning(
+            "Failed to read extract_start from meta file",
+            extra={"path": str(meta_path), "error": str(exc)},
+        )
+        return None
+
+
+class ExtractWatermark:
+    """Latest extract_start seen across the meta files of a run, updated one file at a time."""
+
+    def __init__(self):
+        self.latest: Optional[datetime] = None
+        self._lock = threading.Lock()
+
+    def observe(self, meta_path: Path) -> None:
+        extract_start = read_extract_start(meta_path)
+        if extract_start is None:
+            return
+
+        with self._lock:
+            if self.latest is None or extract_start > self.latest:
+                self.latest = extract_start
+
+    def observe_all(self, meta_paths: list[Path]) -> None:
+        for meta_path in meta_paths:
+            self.observe(meta_path)
+
+
+def nested_meta_files(directory: Path) -> list[Path]:
+    """Meta files in the subdirectories of a plugin output directory, the ones OutputWatcher doesn't see."""
+    return [
+        Path(root) / name
+        for root, _, names in os.walk(directory)
+        if root != str(directory)
+        for name in names
+        if name.endswith(META_SUFFIX)
+    ]
+
+
+@dataclass
+class OutputManifest:
+    # Files at the top of the directory, the ones the publisher uploads
+    files: list[Path]
+    latest_extract_start: Optional[datetime]
+
+
+def scan_output(directory: Path, *, max_workers: int = 8) -> OutputManifest:
+    """
+    Walks a plugin output directory once, listing its files and computing the extract watermark.
+
+    Meta files are read on a small thread pool since reading them is what dominates on large raw trees.
+    """
+    files: list[Path] = []
+    meta_paths: list[Path] = []
+
+    for root, _, names in os.walk(directory):
+        top_level = root == str(directory)
+        for name in names:
+            path = Path(root) / name
+            if top_level:
+                files.append(path)
+            if name.endswith(META_SUFFIX):
+                meta_paths.append(path)
+
+    watermark = ExtractWatermark()
+    if meta_paths:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(meta_paths)), thread_name_prefix="meta") as executor:
+            list(executor.map(watermark.observe, meta_paths))
+
+    return OutputManifest(files=sorted(files), latest_extract_start=watermark.latest)
@@ -0,0 +1,127 @@
+import io
+import json
+import logging
+import tarfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Literal, Optional
+
+from lomnia_ingester.models import FailedToRunPlugin, PluginPacking
+from lomnia_ingester.output_manifest import META_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+PACK_INDEX_NAME = "index.json"
+PACK_SUFFIXES = {"gzip": ".pack.tar.gz", "zstd": ".pack.tar.zst"}
+PACK_FORMATS = {"gzip": "tar+gzip", "zstd": "tar+zstd"}
+
+
+def pack_compression(path: Path) -> Optional[Literal["gzip", "zstd"]]:
+    for compression, suffix in PACK_SUFFIXES.items():
+        if path.name.endswith(suffix):
+            return compression  # type: ignore[return-value]
+    return None
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as exc:
+        logger.exception("zstd packing needs the zstandard package")
+        raise FailedToRunPlugin("MISSING_DEPENDENCY_ZSTANDARD") from exc
+    return zstandard
+
+
+@contextmanager
+def _open_tar(path: Path, mode: Literal["r", "w"], compression: str) -> Iterator[tarfile.TarFile]:
+    # Streaming modes only, neither side needs to seek in the compressed file
+    with path.open(f"{mode}b") as f:
+        if compression == "gzip":
+            with tarfile.open(fileobj=f, mode=f"{mode}|gz") as tar:
+                yield tar
+            return
+
+        zstandard = _zstandard()
+        stream: IO[bytes]
+        if mode == "w":
+            stream = zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(f, closefd=False)
+        with stream, tarfile.open(fileobj=stream, mode=f"{mode}|") as tar:
+            yield tar
+
+
+def _chunks(files: list[Path], max_pack_bytes: int) -> Iterator[list[Path]]:
+    chunk: list[Path] = []
+    chunk_bytes = 0
+    for file in files:
+        size = file.stat().st_size
+        if chunk and chunk_bytes + size > max_pack_bytes:
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(file)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def pack_canonical(directory: Path, name: str, packing: PluginPacking) -> list[Path]:
+    """
+    Replaces the small files of a canonical directory with compressed tar archives.
+
+    Each archive starts with an index.json listing its members, which is also what the archive's queue event
+    carries. Meta files and files above max_file_bytes are left alone and uploaded as usual.
+    """
+    small_files = sorted(
+        file
+        for file in directory.iterdir()
+        if file.is_file()
+        and not file.name.endswith(META_SUFFIX)
+        and pack_compression(file) is None
+        and file.stat().st_size <= packing.max_file_bytes
+    )
+    if len(small_files) < 2:
+        return []
+
+    archives = []
+    for i, chunk in enumerate(_chunks(small_files, packing.max_pack_bytes)):
+        archive = directory / f"{name}-{i}{PACK_SUFFIXES[packing.compression]}"
+        _write_pack(archive, chunk, packing.compression)
+        for file in chunk:
+            file.unlink()
+        archives.append(archive)
+
+    logger.info(f"Packed canonical files | directory={directory} | files={len(small_files)} | archives={len(archives)}")
+    return archives
+
+
+def _write_pack(archive: Path, files: list[Path], compression: str) -> None:
+    index = [{"name": file.name, "size": file.stat().st_size} for file in files]
+    index_bytes = json.dumps({"members": index}).encode()
+
+    # Written under a .tmp name so a streaming watcher never picks up a half written archive
+    tmp_path = archive.with_name(f"{archive.name}.tmp")
+    with _open_tar(tmp_path, "w", compression) as tar:
+        info = tarfile.TarInfo(PACK_INDEX_NAME)
+        info.size = len(index_bytes)
+        tar.addfile(info, io.BytesIO(index_bytes))
+        for file in files:
+            tar.add(file, arcname=file.name)
+    tmp_path.replace(archive)
+
+
+def read_pack_index(archive: Path) -> dict:
+    """Reads the index of an archive written by pack_canonical, only the first member is decompressed."""
+    compression = pack_compression(archive)
+    if compression is None:
+        raise FailedToRunPlugin("NOT_A_PACK")
+
+    with _open_tar(archive, "r", compression) as tar:
+        member = tar.next()
+        index_file = tar.extractfile(member) if member is not None and member.name == PACK_INDEX_NAME else None
+        if index_file is None:
+            raise FailedToRunPlugin("PACK_INDEX_NOT_FOUND")
+        index = json.load(index_file)
+
+    return {"format": PACK_FORMATS[compression], "members": index["members"]}
@@ -0,0 +1,45 @@
+import os
+from pathlib import Path
+
+IN_PROGRESS_SUFFIXES = (".tmp", ".part")
+
+
+def is_finalized(name: str) -> bool:
+    """
+    Completion protocol for streaming plugins.
+
+    A plugin writes a file under a hidden name or one ending in .tmp/.part and renames it once it's complete, so any
+    other file that shows up in the output directory can be handed off right away.
+    """
+    return not name.startswith(".") and not name.endswith(IN_PROGRESS_SUFFIXES)
+
+
+class OutputWatcher:
+    """
+    Polls a plugin output directory and returns the finalized files that weren't seen before.
+
+    A file is told apart by its name, inode and modification time, so a file that's replaced or rewritten under a
+    name already handed off, e.g. by a later transform batch, is handed off again.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._seen: dict[str, tuple[int, int]] = {}
+
+    def poll(self) -> list[Path]:
+        if not self.directory.exists():
+            return []
+
+        new_files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not is_finalized(entry.name) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                version = (stat.st_ino, stat.st_mtime_ns)
+                if self._seen.get(entry.name) == version:
+                    continue
+                self._seen[entry.name] = version
+                new_files.append(Path(entry.path))
+
+        return sorted(new_files)
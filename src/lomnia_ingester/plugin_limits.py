@@ -0,0 +1,49 @@
+import json
+import logging
+import sys
+from pathlib import Path
+from typing import Callable, Optional
+
+from lomnia_ingester.cache.lru import dir_size
+from lomnia_ingester.models import FailedToRunPlugin, PluginResources
+
+logger = logging.getLogger(__name__)
+
+LIMITS_SCRIPT = Path(__file__).with_name("plugin_limits_exec.py")
+
+
+def command_timeout(resources: PluginResources, timeout: Optional[float]) -> Optional[float]:
+    limits = [limit for limit in (timeout, resources.max_wall_seconds) if limit is not None]
+    return min(limits) if limits else None
+
+
+def command_limits(resources: PluginResources) -> dict:
+    """The limits plugin_worker_server.apply_limits sets in a command process."""
+    return {"cpu_seconds": resources.cpu_seconds, "memory_bytes": resources.memory_bytes, "nice": resources.nice}
+
+
+def limits_command(resources: PluginResources) -> list[str]:
+    """
+    Prefix that starts a command with the plugin's limits applied, empty when it has none.
+
+    Limits are rlimits, so they hold for each process of the plugin rather than for the group as a whole.
+    """
+    limits = command_limits(resources)
+    if all(value is None for value in limits.values()):
+        return []
+    return [sys.executable, str(LIMITS_SCRIPT), json.dumps(limits)]
+
+
+def output_size_watchdog(resources: PluginResources, directory: Path) -> Optional[Callable[[], None]]:
+    if resources.max_output_bytes is None:
+        return None
+
+    def check():
+        size = dir_size(directory)
+        if size > resources.max_output_bytes:
+            logger.error(
+                f"Plugin output too large | directory={directory} | size={size} | limit={resources.max_output_bytes}"
+            )
+            raise FailedToRunPlugin("OUTPUT_SIZE_LIMIT_EXCEEDED")
+
+    return check
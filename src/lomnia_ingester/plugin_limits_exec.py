@@ -0,0 +1,25 @@
+"""
+Applies the resource limits of a plugin command and execs it: `python plugin_limits_exec.py '<limits json>' cmd...`.
+
+Setting limits in a preexec_fn runs Python code between fork and exec, which isn't safe in the multi-threaded
+ingester, the child can block forever on a lock another thread held when it forked. Here the limits are set in a
+fresh interpreter instead and the exec keeps the pid, so the command is supervised as if it was started directly.
+
+Runs next to plugin_worker_server.py, whose apply_limits sets the same limits in worker commands.
+"""
+
+import json
+import os
+import sys
+
+from plugin_worker_server import apply_limits
+
+
+def main() -> None:
+    apply_limits(json.loads(sys.argv[1]))
+    cmd = sys.argv[2:]
+    os.execvp(cmd[0], cmd)  # noqa: S606
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 import json
 import logging
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
+from typing import Literal, Optional
 
 from pydantic.dataclasses import dataclass
 
-from lomnia_ingester.models import FailedToRunPlugin, PluginOutput
+from lomnia_ingester import metrics
+from lomnia_ingester.models import FailedToRunPlugin, PluginOutput, UploadStats
+from lomnia_ingester.outbox import Outbox
+from lomnia_ingester.output_packing import pack_compression, read_pack_index
 from lomnia_ingester.queue.publisher import QueuePublisher
 from lomnia_ingester.storage.s3_client import S3Storage
+from lomnia_ingester.storage.upload_index import UploadIndex, file_sha256
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +24,10 @@ logger = logging.getLogger(__name__)
 class PluginFilesUploadResult:
     bucket: str
     key: str
+    # The content was already uploaded before, consumers already heard about it
+    duplicate: bool = False
+    # Whether the file's bytes were sent to storage by this upload
+    transferred: bool = True
 
 
 class PluginOutputPublisher:
@@ -23,11 +35,19 @@ class PluginOutputPublisher:
         self,
         storage: S3Storage,
         publisher: QueuePublisher,
+        upload_concurrency: int = 1,
+        upload_index: Optional[UploadIndex] = None,
+        dedup_mode: Literal["skip", "copy"] = "skip",
+        hash_mode: Literal["before_upload", "during_upload"] = "before_upload",
     ):
         self.storage = storage
         self.publisher = publisher
+        self.upload_concurrency = upload_concurrency
+        self.upload_index = upload_index
+        self.dedup_mode = dedup_mode
+        self.hash_mode = hash_mode
 
-    def handle_output(self, output: PluginOutput):
+    def handle_output(self, output: PluginOutput, outbox: Optional[Outbox] = None) -> UploadStats:
         canonical_dir = output.canonical
         raw_dir = output.raw
         extracted_at = output.extracted_at
@@ -42,44 +62,51 @@ class PluginOutputPublisher:
             logger.error(f"Canonical directory not found | plugin_id={output.id} | canonical_dir={canonical_dir}")
             raise FailedToRunPlugin("CANONICAL_FOLDER_NOT_FOUND")
 
-        # Upload raw files
-        for file in raw_dir.iterdir():
-            if not file.is_file():
-                continue
+        with self.uploader(output.id, extracted_at, outbox=outbox) as uploader:
+            for kind, file in self._output_files(output):
+                uploader.submit(kind, file)
 
-            logger.debug(f"Uploading raw file | plugin_id={output.id} | file={file}")
+        logger.info(f"Finished handling plugin output | plugin_id={output.id} | stats={uploader.stats}")
+        return uploader.stats
 
-            self.upload(
-                folder=f"{output.id}/raw",
-                file_path=file,
-                extracted_at=extracted_at,
-            )
-
-        for file in canonical_dir.iterdir():
-            if not file.is_file():
-                continue
-
-            logger.debug(f"Uploading canonical file | plugin_id={output.id} | file={file}")
-
-            result = self.upload(
-                folder=f"{output.id}/canonical",
-                file_path=file,
-                extracted_at=extracted_at,
-            )
-
-            payload = {
-                "bucket": result.bucket,
-                "key": result.key,
-            }
+    @contextmanager
+    def uploader(
+        self,
+        plugin_id: str,
+        extracted_at: datetime,
+        *,
+        publish_on_collect: bool = False,
+        outbox: Optional[Outbox] = None,
+    ):
+        """
+        Upload pipeline for the files of one plugin run.
 
-            logger.info(
-                f"Publishing canonical file event | plugin_id={output.id} | bucket={result.bucket} | key={result.key}"
-            )
+        Leaving the context waits for every upload and publishes the remaining canonical events, or cancels the
+        uploads that haven't started if the block raised. With an outbox, files and events it already holds are
+        not delivered again.
+        """
+        output_uploader = OutputUploader(
+            self, plugin_id, extracted_at, publish_on_collect=publish_on_collect, outbox=outbox
+        )
+        try:
+            yield output_uploader
+        except BaseException:
+            output_uploader.cancel()
+            raise
+        output_uploader.finish()
 
-            if not file.name.endswith(".meta.json"):
-                self.publisher.publish(json.dumps(payload).encode())
+    def _output_files(self, output: PluginOutput) -> Iterator[tuple[str, Path]]:
+        if output.raw_files is not None:
+            for file in output.raw_files:
+                yield "raw", file
+        else:
+            for file in output.raw.iterdir():
+                if file.is_file():
+                    yield "raw", file
 
-        logger.info(f"Finished handling plugin output | plugin_id={output.id}")
+        for file in output.canonical.iterdir():
+            if file.is_file():
+                yield "canonical", file
 
     def upload(
         self,
@@ -90,11 +117,223 @@ class PluginOutputPublisher:
         date_path = extracted_at.strftime("%Y/%m/%d")
         key = f"plugins/{folder}/{date_path}/{file_path.name}"
 
-        logger.debug(f"Uploading file to storage | bucket={self.storage.bucket} | key={key} | local_path={file_path}")
+        if self.upload_index is None:
+            logger.debug(
+                "Uploading file to storage | bucket=%s | key=%s | local_path=%s", self.storage.bucket, key, file_path
+            )
+            self.storage.upload_file(file_path, key)
+            return PluginFilesUploadResult(bucket=self.storage.bucket, key=key)
+
+        if self.hash_mode == "during_upload":
+            return self._upload_hashed(folder, file_path, key)
 
+        sha256 = file_sha256(file_path)
+        existing_key = self._find_uploaded(folder, sha256)
+
+        if existing_key is not None:
+            if existing_key != key and self.dedup_mode == "copy":
+                logger.debug(
+                    "Copying identical object | bucket=%s | source_key=%s | key=%s",
+                    self.storage.bucket,
+                    existing_key,
+                    key,
+                )
+                self.storage.copy_file(existing_key, key)
+            else:
+                logger.debug(
+                    "Skipping identical object | bucket=%s | existing_key=%s | local_path=%s",
+                    self.storage.bucket,
+                    existing_key,
+                    file_path,
+                )
+                key = existing_key
+
+            return PluginFilesUploadResult(bucket=self.storage.bucket, key=key, duplicate=True, transferred=False)
+
+        logger.debug(
+            "Uploading file to storage | bucket=%s | key=%s | local_path=%s", self.storage.bucket, key, file_path
+        )
         self.storage.upload_file(file_path, key)
+        self.upload_index.record(folder, sha256, file_path.stat().st_size, self.storage.bucket, key)
+
+        return PluginFilesUploadResult(bucket=self.storage.bucket, key=key)
+
+    def _upload_hashed(self, folder: str, file_path: Path, key: str) -> PluginFilesUploadResult:
+        """Uploads first and hashes in the same read, duplicates are only recognized once they're uploaded."""
+        logger.debug(
+            "Uploading file to storage | bucket=%s | key=%s | local_path=%s", self.storage.bucket, key, file_path
+        )
+        sha256 = self.storage.upload_file_hashed(file_path, key)
+
+        existing_key = self._find_uploaded(folder, sha256)
+        if existing_key is None:
+            self.upload_index.record(folder, sha256, file_path.stat().st_size, self.storage.bucket, key)
+        else:
+            logger.debug("Uploaded a duplicate of an existing object | key=%s | existing_key=%s", key, existing_key)
+
+        return PluginFilesUploadResult(bucket=self.storage.bucket, key=key, duplicate=existing_key is not None)
+
+    def _find_uploaded(self, folder: str, sha256: str) -> Optional[str]:
+        """
+        Key of an object already holding this content, checked against storage before it's trusted.
+
+        The index only knows what was uploaded, an object removed since then, by a lifecycle rule or by hand, is
+        dropped from it so the file is uploaded again.
+        """
+        existing_key = self.upload_index.find(folder, sha256, self.storage.bucket)
+        if existing_key is None or self.storage.object_exists(existing_key):
+            return existing_key
+
+        logger.warning(
+            "Indexed object missing from storage, uploading it again | bucket=%s | key=%s",
+            self.storage.bucket,
+            existing_key,
+        )
+        self.upload_index.forget(folder, sha256, self.storage.bucket)
+        return None
+
 
-        return PluginFilesUploadResult(
-            bucket=self.storage.bucket,
-            key=key,
+class OutputUploader:
+    """
+    Uploads files on a bounded thread pool and turns finished canonical uploads into queue events.
+
+    Events are only created once the upload of their file went through. They're published together when the
+    uploader finishes, or on every collect() when publish_on_collect is set so consumers hear about files while
+    the plugin is still running.
+    """
+
+    def __init__(
+        self,
+        output_publisher: PluginOutputPublisher,
+        plugin_id: str,
+        extracted_at: datetime,
+        *,
+        publish_on_collect: bool = False,
+        outbox: Optional[Outbox] = None,
+    ):
+        self.output_publisher = output_publisher
+        self.plugin_id = plugin_id
+        self.extracted_at = extracted_at
+        self.publish_on_collect = publish_on_collect
+        self.outbox = outbox
+
+        concurrency = output_publisher.upload_concurrency
+        # Only a couple of uploads per worker are queued at a time so huge outputs don't pile up in memory
+        self._max_pending = concurrency * 2
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="upload")
+        self._pending: dict[Future, tuple[str, Path]] = {}
+        # Object key and body of each event waiting to be published
+        self._events: list[tuple[str, bytes]] = []
+        self.stats = UploadStats()
+
+    def submit(self, kind: str, file: Path):
+        delivered = self.outbox.upload(kind, file) if self.outbox is not None else None
+        if delivered is not None:
+            logger.debug("File already uploaded by a previous attempt | plugin_id=%s | file=%s", self.plugin_id, file)
+            result = PluginFilesUploadResult(
+                bucket=delivered["bucket"], key=delivered["key"], duplicate=delivered["duplicate"]
+            )
+            self._queue_event(kind, file, result)
+            return
+
+        if len(self._pending) >= self._max_pending:
+            wait(self._pending, return_when=FIRST_COMPLETED)
+            self._handle_done()
+
+        logger.debug("Uploading %s file | plugin_id=%s | file=%s", kind, self.plugin_id, file)
+        future = self._executor.submit(self._upload, kind, file)
+        self._pending[future] = (kind, file)
+
+    def _upload(self, kind: str, file: Path) -> PluginFilesUploadResult:
+        with metrics.stage_seconds.time(plugin_id=self.plugin_id, stage="upload"):
+            result = self.output_publisher.upload(
+                folder=f"{self.plugin_id}/{kind}",
+                file_path=file,
+                extracted_at=self.extracted_at,
+            )
+
+        # Written right away so the upload isn't lost if another file of the run fails
+        if self.outbox is not None:
+            self.outbox.record_upload(kind, file, result.bucket, result.key, result.duplicate)
+        return result
+
+    def collect(self):
+        """Handle the uploads that already finished without waiting for the others."""
+        self._handle_done()
+        if self.publish_on_collect:
+            self._publish()
+
+    def finish(self):
+        try:
+            wait(self._pending)
+            self._handle_done()
+            self._publish()
+        except BaseException:
+            self.cancel()
+            raise
+        self._executor.shutdown(wait=True)
+
+    def cancel(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _handle_done(self):
+        done = [future for future in self._pending if future.done()]
+        for future in done:
+            kind, file = self._pending.pop(future)
+            result: PluginFilesUploadResult = future.result()
+
+            if result.transferred:
+                size = file.stat().st_size
+                metrics.files_uploaded_total.inc(plugin_id=self.plugin_id, kind=kind)
+                metrics.bytes_uploaded_total.inc(size, plugin_id=self.plugin_id, kind=kind)
+                self.stats.bytes_uploaded += size
+                if kind == "canonical":
+                    self.stats.canonical_files += 1
+                else:
+                    self.stats.raw_files += 1
+
+            self._queue_event(kind, file, result)
+
+    def _queue_event(self, kind: str, file: Path, result: PluginFilesUploadResult):
+        if kind != "canonical" or file.name.endswith(".meta.json"):
+            return
+
+        if result.duplicate:
+            # Consumers already got an event for this exact content
+            logger.debug("Skipping event for duplicate file | plugin_id=%s | key=%s", self.plugin_id, result.key)
+            return
+
+        if self.outbox is not None and self.outbox.is_published(result.key):
+            logger.debug(
+                "Event already published by a previous attempt | plugin_id=%s | key=%s", self.plugin_id, result.key
+            )
+            return
+
+        payload = {
+            "bucket": result.bucket,
+            "key": result.key,
+        }
+        if pack_compression(file) is not None:
+            # One event for the whole archive, listing the files it holds
+            payload.update(read_pack_index(file))
+
+        logger.debug(
+            "Queueing canonical file event | plugin_id=%s | bucket=%s | key=%s",
+            self.plugin_id,
+            result.bucket,
+            result.key,
         )
+        self._events.append((result.key, json.dumps(payload).encode()))
+
+    def _publish(self):
+        if not self._events:
+            return
+
+        logger.info(f"Publishing canonical file events | plugin_id={self.plugin_id} | count={len(self._events)}")
+        with metrics.stage_seconds.time(plugin_id=self.plugin_id, stage="publish"):
+            self.output_publisher.publisher.publish_batch([body for _, body in self._events])
+        if self.outbox is not None:
+            self.outbox.record_published([key for key, _ in self._events])
+        metrics.messages_published_total.inc(len(self._events), plugin_id=self.plugin_id)
+        self.stats.events_published += len(self._events)
+        self._events = []
@@ -1,242 +1,404 @@
-import json
 import logging
+import os
 import shutil
-import subprocess
 import tempfile
-from contextlib import contextmanager
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Optional
-
-from lomnia_ingester.config import store
-from lomnia_ingester.models import FailedToRunPlugin, Plugin, PluginOutput
+from typing import Callable, Optional
+
+from lomnia_ingester import metrics
+from lomnia_ingester.command import CommandResult, run_command
+from lomnia_ingester.context import get_context
+from lomnia_ingester.models import FailedToRunPlugin, Plugin, PluginOutput, ResourceUsage
+from lomnia_ingester.output_manifest import META_SUFFIX, ExtractWatermark, nested_meta_files, scan_output
+from lomnia_ingester.output_packing import pack_canonical
+from lomnia_ingester.output_watcher import OutputWatcher
+from lomnia_ingester.plugin_limits import command_timeout, limits_command, output_size_watchdog
+from lomnia_ingester.plugin_output_publisher import OutputUploader, PluginOutputPublisher
 
 logger = logging.getLogger(__name__)
 
+RUN_DIR_PREFIX = "lomnia-run-"
 
-def run_command(
-    cmd: list[str],
-    *,
-    cwd: Path | None = None,
-    env: dict | None = None,
-    description: str,
-):
-    logger.info(f"Running command | description={description} | cmd={cmd} | cwd={cwd if cwd else None}")
 
-    try:
-        result = subprocess.run(  # noqa: S603
-            cmd,
-            cwd=cwd,
-            env=env,
-            check=True,
-            capture_output=True,
-            text=True,
-        )
-    except subprocess.CalledProcessError as exc:
-        logger.exception(
-            f"Command failed | cmd={cmd} | cwd={cwd if cwd else None} | "
-            f"stdout={exc.stdout} | stderr={exc.stderr} | returncode={exc.returncode}"
-        )
-        raise
+def plugin_env(plugin: Plugin, env_dir: Path) -> dict[str, str]:
+    base = plugin.env if plugin.env is not None else os.environ
+    return {**base, "UV_PROJECT_ENVIRONMENT": str(env_dir)}
 
-    if result.stdout:
-        logger.debug(f"Command stdout | stdout={result.stdout}")
-    if result.stderr:
-        logger.debug(f"Command stderr | stderr={result.stderr}")
 
-    return result
+def record_usage(plugin: Plugin, stage: str, usage: ResourceUsage):
+    logger.info(
+        f"{stage.capitalize()} completed | plugin_id={plugin.id} | cpu_seconds={usage.cpu_seconds:.2f} | "
+        f"max_rss_bytes={usage.max_rss_bytes}"
+    )
+    metrics.cpu_seconds_total.inc(usage.cpu_seconds, plugin_id=plugin.id, stage=stage)
+    metrics.max_rss_bytes.set(usage.max_rss_bytes, plugin_id=plugin.id, stage=stage)
+
 
+def run_plugin_command(
+    work_dir: Path,
+    env_dir: Path,
+    plugin: Plugin,
+    command: str,
+    args: list[str],
+    *,
+    timeout: Optional[float],
+    watchdog: Optional[Callable[[], None]],
+) -> CommandResult:
+    """Runs extract or transform, in the plugin's pre-warmed worker when it uses one and otherwise with uv run."""
+    env = plugin_env(plugin, env_dir)
+    description = f"plugin {command}"
+
+    if plugin.execution.mode == "worker":
+        with get_context().worker_pool.worker(plugin, work_dir, env) as worker:
+            if command in worker.commands:
+                return worker.run(
+                    command,
+                    args,
+                    description=description,
+                    resources=plugin.resources,
+                    timeout=timeout,
+                    watchdog=watchdog,
+                )
 
-def run_extract(work_dir: Path, plugin: Plugin, out_dir: Path, start_date: datetime):
     uv = shutil.which("uv")
     if uv is None:
         logger.error("uv executable not found")
         raise FailedToRunPlugin("MISSING_EXECUTABLE_UV")
 
-    logger.info(
-        f"Starting extract | plugin_id={plugin.id} | work_dir={work_dir} | out_dir={out_dir} | start_date={start_date.isoformat()}"
-    )
-
-    run_command(
-        [uv, "sync"],
+    return run_command(
+        [*limits_command(plugin.resources), uv, "run", "--no-sync", command, *args],
         cwd=work_dir,
-        description="uv sync",
+        env=env,
+        description=description,
+        timeout=timeout,
+        watchdog=watchdog,
     )
 
-    run_command(
-        [
-            uv,
-            "run",
-            "extract",
-            "--start_date",
-            str(start_date.timestamp()),
-            "--out_dir",
-            str(out_dir),
-        ],
-        cwd=work_dir,
-        env=plugin.env,
-        description="plugin extract",
+
+def run_extract(
+    work_dir: Path,
+    env_dir: Path,
+    plugin: Plugin,
+    out_dir: Path,
+    start_date: datetime,
+    end_date: Optional[datetime] = None,
+) -> ResourceUsage:
+    logger.info(
+        f"Starting extract | plugin_id={plugin.id} | work_dir={work_dir} | out_dir={out_dir} | start_date={start_date.isoformat()}"
     )
 
-    logger.info(f"Extract completed | plugin_id={plugin.id}")
+    watchdog = output_size_watchdog(plugin.resources, out_dir)
+    with metrics.stage_seconds.time(plugin_id=plugin.id, stage="extract"):
+        result = run_plugin_command(
+            work_dir,
+            env_dir,
+            plugin,
+            "extract",
+            [
+                "--start_date",
+                str(start_date.timestamp()),
+                "--out_dir",
+                str(out_dir),
+                # Only passed to plugins that opted into backfill, the others don't know the argument
+                *(["--end_date", str(end_date.timestamp())] if end_date is not None else []),
+            ],
+            timeout=command_timeout(plugin.resources, plugin.timeouts.extract_seconds),
+            watchdog=watchdog,
+        )
+    if watchdog is not None:
+        watchdog()
 
+    record_usage(plugin, "extract", result.usage)
+    return result.usage
 
-def run_transform(work_dir: Path, plugin: Plugin, in_dir: Path, out_dir: Path):
-    uv = shutil.which("uv")
-    if uv is None:
-        logger.error("uv executable not found")
-        raise FailedToRunPlugin("MISSING_EXECUTABLE_UV")
 
+def run_transform(work_dir: Path, env_dir: Path, plugin: Plugin, in_dir: Path, out_dir: Path) -> ResourceUsage:
     logger.info(
         f"Starting transform | plugin_id={plugin.id} | work_dir={work_dir} | in_dir={in_dir} | out_dir={out_dir}"
     )
 
-    run_command(
-        [uv, "sync"],
-        cwd=work_dir,
-        description="uv sync",
-    )
-
-    run_command(
-        [
-            uv,
-            "run",
+    watchdog = output_size_watchdog(plugin.resources, out_dir)
+    with metrics.stage_seconds.time(plugin_id=plugin.id, stage="transform"):
+        result = run_plugin_command(
+            work_dir,
+            env_dir,
+            plugin,
             "transform",
-            "--in_dir",
-            str(in_dir),
-            "--out_dir",
-            str(out_dir),
-        ],
-        cwd=work_dir,
-        env=plugin.env,
-        description="plugin transform",
-    )
+            ["--in_dir", str(in_dir), "--out_dir", str(out_dir)],
+            timeout=command_timeout(plugin.resources, plugin.timeouts.transform_seconds),
+            watchdog=watchdog,
+        )
+    if watchdog is not None:
+        watchdog()
 
-    logger.info(f"Transform completed | plugin_id={plugin.id}")
+    record_usage(plugin, "transform", result.usage)
+    return result.usage
 
 
-def clone_plugin(repo_url: str, out_dir: str):
-    git = shutil.which("git")
-    if git is None:
-        logger.error("git executable not found")
-        raise FailedToRunPlugin("MISSING_EXECUTABLES")
+def get_latest_extract_start(out_dir: Path) -> Optional[datetime]:
+    return scan_output(out_dir).latest_extract_start
 
-    logger.info(f"Cloning plugin repository | repo_url={repo_url} | out_dir={out_dir}")
 
-    run_command(
-        [git, "clone", repo_url, out_dir],
-        description="git clone",
-    )
+def _link_batch(files: list[Path], batch_dir: Path):
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    for file in files:
+        try:
+            os.link(file, batch_dir / file.name)
+        except OSError:
+            shutil.copy2(file, batch_dir / file.name)
+
+
+def stream_extract_and_transform(
+    work_dir: Path,
+    env_dir: Path,
+    plugin: Plugin,
+    raw_dir: Path,
+    canonical_dir: Path,
+    start_date: datetime,
+    uploader: OutputUploader,
+    end_date: Optional[datetime] = None,
+) -> tuple[Optional[datetime], ResourceUsage]:
+    """
+    Runs extract and transform while uploading every file as soon as the plugin finalizes it.
+
+    With a transform batch size, transform also runs on groups of finalized raw files while extract is still going
+    instead of waiting for the whole extract. Returns the extract watermark, built from the top-level meta files as
+    they show up and the nested ones once extract finished, and the resources the plugin commands used.
+    """
+    streaming = plugin.streaming
+    raw_watcher = OutputWatcher(raw_dir)
+    canonical_watcher = OutputWatcher(canonical_dir)
+    watermark = ExtractWatermark()
+    # Next to the raw directory so batches can be hard links to the raw files
+    batches_dir = Path(tempfile.mkdtemp(prefix=f"{RUN_DIR_PREFIX}{plugin.id}-batches-", dir=raw_dir.parent))
+    pending_raw: list[Path] = []
+    batch_count = 0
+    usage = ResourceUsage()
+
+    def hand_off(finished: bool):
+        nonlocal pending_raw, batch_count, usage
+
+        new_raw = raw_watcher.poll()
+        for file in new_raw:
+            uploader.submit("raw", file)
+            if file.name.endswith(META_SUFFIX):
+                watermark.observe(file)
+
+        if streaming.transform_batch_size:
+            pending_raw += new_raw
+            if pending_raw and (finished or len(pending_raw) >= streaming.transform_batch_size):
+                batch_dir = batches_dir / str(batch_count)
+                batch_count += 1
+                _link_batch(pending_raw, batch_dir)
+                pending_raw = []
+
+                logger.info(f"Transforming raw batch | plugin_id={plugin.id} | batch={batch_dir}")
+                usage += run_transform(work_dir, env_dir, plugin=plugin, in_dir=batch_dir, out_dir=canonical_dir)
+                shutil.rmtree(batch_dir, ignore_errors=True)
+
+        for file in canonical_watcher.poll():
+            uploader.submit("canonical", file)
+
+        uploader.collect()
 
+    try:
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="extract") as executor:
+            extract = executor.submit(
+                run_extract,
+                work_dir,
+                env_dir,
+                plugin=plugin,
+                out_dir=raw_dir,
+                start_date=start_date,
+                end_date=end_date,
+            )
 
-def copy_plugin(path: str, out_dir: str):
-    src = Path(path)
-    dst = Path(out_dir)
+            while not extract.done():
+                hand_off(finished=False)
+                time.sleep(streaming.poll_interval_seconds)
 
-    logger.info(f"Copying plugin from local path | src={src} | dst={dst}")
+            usage += extract.result()
+            hand_off(finished=True)
 
-    if not src.exists():
-        logger.error(f"Plugin path does not exist | src={src}")
-        raise FailedToRunPlugin("PATH_DOES_NOT_EXIST")
+        # Plugins can also write meta files in subdirectories, which aren't uploaded but count for the watermark
+        watermark.observe_all(nested_meta_files(raw_dir))
 
-    if dst.exists():
-        logger.debug(f"Destination exists, removing | dst={dst}")
-        shutil.rmtree(dst)
+        if not streaming.transform_batch_size:
+            usage += run_transform(work_dir, env_dir, plugin=plugin, in_dir=raw_dir, out_dir=canonical_dir)
+            hand_off(finished=True)
+    finally:
+        shutil.rmtree(batches_dir, ignore_errors=True)
 
-    shutil.copytree(src, dst)
+    if not canonical_dir.exists():
+        logger.error(f"Canonical directory not found | plugin_id={plugin.id} | canonical_dir={canonical_dir}")
+        raise FailedToRunPlugin("CANONICAL_FOLDER_NOT_FOUND")
 
+    return watermark.latest, usage
 
-def get_latest_extract_start(out_dir: Path) -> Optional[datetime]:
-    latest: Optional[datetime] = None
 
-    for meta_path in out_dir.rglob("*.meta.json"):
-        try:
-            with meta_path.open("r", encoding="utf-8") as f:
-                data = json.load(f)
+def make_run_dirs(plugin: Plugin) -> tuple[Path, Path]:
+    """
+    Creates the raw and canonical directories of a run in the configured work directory.
 
-            extract_start = data.get("extract_start")
-            if not extract_start:
-                continue
+    Fails before the plugin starts when the work directory is short on space rather than halfway through a large
+    extract.
+    """
+    spool = get_context().config.spool
+    work_root = spool.work_root()
+    if work_root is not None:
+        work_root.mkdir(parents=True, exist_ok=True)
 
-            extract_start_dt = datetime.fromisoformat(extract_start)
+    free_bytes = shutil.disk_usage(work_root or tempfile.gettempdir()).free
+    if free_bytes < spool.spool_min_free_bytes:
+        logger.error(
+            f"Not enough free space to run plugin | plugin_id={plugin.id} | work_dir={work_root} | "
+            f"free_bytes={free_bytes} | min_free_bytes={spool.spool_min_free_bytes}"
+        )
+        raise FailedToRunPlugin("INSUFFICIENT_DISK_SPACE")
 
-            if latest is None or extract_start_dt > latest:
-                latest = extract_start_dt
+    raw_dir = Path(tempfile.mkdtemp(prefix=f"{RUN_DIR_PREFIX}{plugin.id}-raw-", dir=work_root))
+    canonical_dir = Path(tempfile.mkdtemp(prefix=f"{RUN_DIR_PREFIX}{plugin.id}-canonical-", dir=work_root))
+    return raw_dir, canonical_dir
 
-        except Exception as exc:
-            logger.warning(
-                "Failed to read extract_start from meta file",
-                extra={"path": str(meta_path), "error": str(exc)},
-            )
 
-    return latest
+def remove_stale_run_dirs(work_root: Path) -> None:
+    """Removes run directories left behind by a process that died mid-run, only call it when no run is going."""
+    if not work_root.exists():
+        return
+    for entry in work_root.glob(f"{RUN_DIR_PREFIX}*"):
+        logger.info(f"Removing stale run directory | path={entry}")
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+def get_start_date(plugin: Plugin) -> datetime:
+    start_date = get_context().store.get_next_start_date(plugin_name=plugin.id)
+    if start_date is None:
+        start_date = plugin.backfill.start_date or datetime.now(timezone.utc) - timedelta(days=1)
+    if start_date.tzinfo is None:
+        # Meta files and plugins.yaml can hold dates without a timezone, they're taken as UTC
+        start_date = start_date.replace(tzinfo=timezone.utc)
+    logger.info(f"Loading next extraction start date | {start_date}")
+    return start_date
 
 
 @contextmanager
-def run_plugin(plugin: Plugin):
-    tmp = Path(tempfile.mkdtemp())
-    raw_dir = Path(tempfile.mkdtemp())
-    canonical_dir = Path(tempfile.mkdtemp())
-    work_dir = tmp / plugin.folder if plugin.folder is not None else tmp
+def run_plugin(
+    plugin: Plugin,
+    publisher: Optional[PluginOutputPublisher] = None,
+    *,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    update_watermark: bool = True,
+    fencing_token: Optional[int] = None,
+):
+    """
+    Runs a plugin and yields its output.
+
+    When the plugin has streaming enabled and a publisher is given, files are uploaded and published while the
+    plugin runs and the yielded output carries the upload stats. Backfill windows pass their own start and end
+    dates and leave the watermark alone, it's advanced by the backfill once its windows are done. The fencing
+    token of the run's lease, when replicas coordinate, goes along with the watermark update.
+    """
+    context = get_context()
+    store = context.store
+    raw_dir, canonical_dir = make_run_dirs(plugin)
 
-    last_week = datetime.now(timezone.utc) - timedelta(days=1)
     extracted_at = datetime.now(timezone.utc)
 
-    start_date = store.get_next_start_date(plugin_name=plugin.id) or last_week
-    logger.info(f"Loading next extraction start date | {start_date}")
+    if start_date is None:
+        start_date = get_start_date(plugin)
 
-    logger.info(
-        f"Starting plugin run | plugin_id={plugin.id} | tmp={tmp} | raw_dir={raw_dir} | canonical_dir={canonical_dir}"
-    )
+    logger.info(f"Starting plugin run | plugin_id={plugin.id} | raw_dir={raw_dir} | canonical_dir={canonical_dir}")
 
     try:
-        if plugin.repo:
-            clone_plugin(str(plugin.repo), str(tmp))
-        elif plugin.path:
-            copy_plugin(str(plugin.path), out_dir=str(tmp))
-        else:
-            logger.error(f"Plugin has no repo or path | plugin_id={plugin.id}")
-            raise FailedToRunPlugin("MISSING_REPO_OR_PATH")  # noqa: TRY301
-
-        run_extract(
-            work_dir,
-            plugin=plugin,
-            out_dir=raw_dir,
-            start_date=start_date,
-        )
-
-        latest_extract_date = get_latest_extract_start(raw_dir)
-
-        run_transform(
-            work_dir,
-            plugin=plugin,
-            in_dir=raw_dir,
-            out_dir=canonical_dir,
-        )
+        with ExitStack() as stack:
+            with metrics.stage_seconds.time(plugin_id=plugin.id, stage="checkout"):
+                checkout = stack.enter_context(context.workspace_cache.checkout(plugin))
+            work_dir = checkout / plugin.folder if plugin.folder is not None else checkout
+
+            with metrics.stage_seconds.time(plugin_id=plugin.id, stage="uv_sync"):
+                env_dir = stack.enter_context(
+                    context.environment_cache.environment(work_dir, timeout=plugin.timeouts.sync_seconds)
+                )
+
+            if plugin.streaming.enabled and publisher is not None:
+                with publisher.uploader(plugin.id, extracted_at, publish_on_collect=True) as uploader:
+                    latest_extract_date, usage = stream_extract_and_transform(
+                        work_dir,
+                        env_dir,
+                        plugin=plugin,
+                        raw_dir=raw_dir,
+                        canonical_dir=canonical_dir,
+                        start_date=start_date,
+                        uploader=uploader,
+                        end_date=end_date,
+                    )
+                upload_stats = uploader.stats
+                raw_files = None
+            else:
+                usage = run_extract(
+                    work_dir,
+                    env_dir,
+                    plugin=plugin,
+                    out_dir=raw_dir,
+                    start_date=start_date,
+                    end_date=end_date,
+                )
+
+                # Scanned right after extract like the watermark always was, one walk gives both the watermark and
+                # the files the publisher uploads. Transform only reads the raw directory
+                with metrics.stage_seconds.time(plugin_id=plugin.id, stage="watermark_scan"):
+                    manifest = scan_output(raw_dir)
+                latest_extract_date = manifest.latest_extract_start
+                raw_files = manifest.files
+
+                usage += run_transform(
+                    work_dir,
+                    env_dir,
+                    plugin=plugin,
+                    in_dir=raw_dir,
+                    out_dir=canonical_dir,
+                )
+                upload_stats = None
+
+                if plugin.packing.enabled:
+                    with metrics.stage_seconds.time(plugin_id=plugin.id, stage="pack"):
+                        # Parallel backfill windows can start in the same second, the suffix keeps their keys apart
+                        pack_name = f"{plugin.id}-{extracted_at.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+                        pack_canonical(canonical_dir, pack_name, plugin.packing)
 
         yield PluginOutput(
             raw=raw_dir,
             canonical=canonical_dir,
             extracted_at=extracted_at,
             id=plugin.id,
+            upload_stats=upload_stats,
+            raw_files=raw_files,
+            resource_usage=usage,
         )
 
-        if latest_extract_date is not None:
+        if update_watermark and latest_extract_date is not None:
             logger.info(f"Saving next extraction start date | {latest_extract_date}")
             store.set_next_start_date(
                 plugin_name=plugin.id,
                 next_start_date=latest_extract_date,
                 last_successful_run=datetime.now(timezone.utc),
+                fencing_token=fencing_token,
             )
 
-        logger.info(f"Plugin run completed | plugin_id={plugin.id}")
+        duration = (datetime.now(timezone.utc) - extracted_at).total_seconds()
+        logger.info(f"Plugin run completed | plugin_id={plugin.id} | duration_seconds={duration:.2f}")
 
     except Exception:
         logger.exception(f"Plugin run failed | plugin_id={plugin.id}")
         raise
 
     finally:
-        logger.debug(f"Cleaning up temporary directories | tmp={tmp}")
-        shutil.rmtree(tmp, ignore_errors=True)
+        logger.debug(f"Cleaning up temporary directories | raw_dir={raw_dir} | canonical_dir={canonical_dir}")
         shutil.rmtree(raw_dir, ignore_errors=True)
         shutil.rmtree(canonical_dir, ignore_errors=True)
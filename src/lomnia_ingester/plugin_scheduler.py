@@ -1,45 +1,552 @@
+import calendar
+import heapq
+import itertools
 import logging
+import random
+import tempfile
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Optional
 
-import schedule
-
-from lomnia_ingester.config import config, publisher
-from lomnia_ingester.models import Plugin
-from lomnia_ingester.plugin_runner import run_plugin
+from lomnia_ingester import metrics
+from lomnia_ingester.backfill import needs_backfill, run_backfill
+from lomnia_ingester.config import PLUGINS_CONFIG_PATH, PluginsConfig
+from lomnia_ingester.context import AppContext, get_context
+from lomnia_ingester.coordination import Lease, LeaseCoordinator
+from lomnia_ingester.cron import CronExpression
+from lomnia_ingester.models import Plugin, PluginOutput, PluginRun, PluginSchedule, ScheduleBackoff, UploadStats
+from lomnia_ingester.outbox import OUTBOX_NAME, Outbox
+from lomnia_ingester.plugin_runner import get_start_date, remove_stale_run_dirs, run_plugin
+from lomnia_ingester.plugins_config_watcher import PluginsConfigWatcher
 
 logger = logging.getLogger(__name__)
 
+# Longest the scheduler sleeps without looking at the heap again
+MAX_SLEEP_SECONDS = 60
+
+
+def run_and_publish(plugin: Plugin, *, fencing_token: Optional[int] = None):
+    store = get_context().store
+    watermark = store.get_next_start_date(plugin.id)
+    start_date = get_start_date(plugin)
+    if needs_backfill(plugin, start_date):
+        run_backfill(
+            plugin,
+            start_date,
+            lambda window_start, window_end: run_and_record(
+                plugin, start_date=window_start, end_date=window_end, update_watermark=False
+            ),
+            fencing_token=fencing_token,
+        )
+    else:
+        run_and_record(plugin, start_date=start_date, fencing_token=fencing_token)
+
+    if plugin.schedule.adaptive.enabled:
+        # The plugin only moves its start date forward when it extracted something new
+        record_backoff(
+            plugin, produced_data=store.get_next_start_date(plugin.id) != watermark, fencing_token=fencing_token
+        )
+
+
+def run_and_record(
+    plugin: Plugin,
+    *,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    update_watermark: bool = True,
+    fencing_token: Optional[int] = None,
+):
+    context = get_context()
+    # A backfill runs its windows in parallel, each takes a slot like any other run
+    with context.run_slots:
+        _run_and_record(
+            context,
+            plugin,
+            start_date=start_date,
+            end_date=end_date,
+            update_watermark=update_watermark,
+            fencing_token=fencing_token,
+        )
+
+
+def _run_and_record(
+    context: AppContext,
+    plugin: Plugin,
+    *,
+    start_date: Optional[datetime],
+    end_date: Optional[datetime],
+    update_watermark: bool,
+    fencing_token: Optional[int],
+):
+    publisher = context.publisher
+    started_at = datetime.now(timezone.utc)
+    stats = UploadStats()
+    resource_usage = None
+    error = None
+
+    try:
+        with run_plugin(
+            plugin,
+            publisher,
+            start_date=start_date,
+            end_date=end_date,
+            update_watermark=update_watermark,
+            fencing_token=fencing_token,
+        ) as plugin_output:
+            resource_usage = plugin_output.resource_usage
+            if plugin_output.upload_stats is not None:
+                # Streaming runs upload while the plugin is running
+                stats = plugin_output.upload_stats
+            else:
+                stats = deliver_output(context, plugin_output, run_started_at=started_at)
+    except Exception as exc:
+        error = repr(exc)
+        raise
+    finally:
+        metrics.runs_total.inc(plugin_id=plugin.id, status="failed" if error else "success")
+        context.store.record_run(
+            PluginRun(
+                plugin_id=plugin.id,
+                started_at=started_at,
+                finished_at=datetime.now(timezone.utc),
+                status="failed" if error else "success",
+                stats=stats,
+                error=error,
+                resource_usage=resource_usage,
+            )
+        )
+
+
+def deliver_output(context: AppContext, output: PluginOutput, *, run_started_at: datetime) -> UploadStats:
+    """
+    Uploads the output, or spools it depending on the spool settings.
+
+    A spooled output is uploaded later, the spool uploader then records its stats on the run started at
+    run_started_at, so this returns empty stats for it.
+    """
+    spool = context.config.spool
+    if not spool.spool_enabled:
+        return context.publisher.handle_output(output)
+
+    if spool.spool_mode == "always":
+        # The output is durable once spooled, so the run is done and its start date can move forward
+        context.spool.enqueue(output, run_started_at=run_started_at)
+        context.spool_uploader.wake()
+        return UploadStats()
+
+    with tempfile.TemporaryDirectory() as outbox_dir:
+        outbox = Outbox(Path(outbox_dir) / OUTBOX_NAME)
+        try:
+            return context.publisher.handle_output(output, outbox=outbox)
+        except Exception:
+            # Keep what was delivered so far, the spool only retries the missing files and events
+            logger.exception(f"Failed to deliver plugin output, spooling it | plugin_id={output.id}")
+            context.spool.enqueue(output, outbox=outbox, run_started_at=run_started_at)
+            context.spool_uploader.wake()
+            return UploadStats()
+
+
+class PluginDispatcher:
+    """
+    Runs plugins on a bounded worker pool so a slow plugin doesn't hold back the others.
+
+    Each plugin can have at most `concurrency.max_concurrent_runs` runs going. When it's due again while at that
+    limit, the run is either skipped or queued, and queued runs of the same plugin are coalesced into one.
+
+    With a coordinator, replicas schedule every plugin but a run only happens on the node that takes the plugin's
+    lease, so a plugin runs on one node at a time. A node also skips the run when the lease shows another node
+    already took it for the same due time.
+    """
+
+    def __init__(self, max_workers: int, coordinator: Optional[LeaseCoordinator] = None):
+        self.coordinator = coordinator
+        # Called with the plugin after each of its runs, failed or not
+        self.on_run_finished: Optional[Callable[[Plugin], None]] = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="plugin")
+        self._lock = threading.Lock()
+        self._running: defaultdict[str, int] = defaultdict(int)
+        self._queued: dict[str, Plugin] = {}
+
+    def submit(self, plugin: Plugin):
+        with self._lock:
+            if self._running[plugin.id] >= plugin.concurrency.max_concurrent_runs:
+                if plugin.concurrency.on_overlap == "queue":
+                    logger.info(f"Plugin still running, queueing next run | plugin_id={plugin.id}")
+                    self._queued[plugin.id] = plugin
+                else:
+                    logger.info(f"Plugin still running, skipping run | plugin_id={plugin.id}")
+                return
+
+            self._running[plugin.id] += 1
+
+        self._executor.submit(self._run, plugin, time.monotonic())
+
+    def forget(self, plugin_id: str):
+        """Drops the queued run of a plugin that was removed, the runs already going finish."""
+        with self._lock:
+            self._queued.pop(plugin_id, None)
+
+    def _run(self, plugin: Plugin, submitted_at: float):
+        metrics.schedule_lag_seconds.set(time.monotonic() - submitted_at, plugin_id=plugin.id)
+        metrics.runs_in_flight.inc(plugin_id=plugin.id)
+        try:
+            if self.coordinator is None:
+                run_and_publish(plugin)
+            else:
+                self._run_with_lease(plugin, self.coordinator)
+        except Exception:
+            logger.exception(f"Plugin run errored | plugin_id={plugin.id}")
+        finally:
+            metrics.runs_in_flight.dec(plugin_id=plugin.id)
+            with self._lock:
+                self._running[plugin.id] -= 1
+                queued = self._queued.pop(plugin.id, None)
+
+            if self.on_run_finished is not None:
+                self.on_run_finished(plugin)
+            if queued is not None:
+                self.submit(queued)
+
+    def _run_with_lease(self, plugin: Plugin, coordinator: LeaseCoordinator):
+        lease = coordinator.acquire(plugin.id)
+        if lease is None:
+            logger.info(f"Plugin is running on another node, skipping run | plugin_id={plugin.id}")
+            metrics.lease_claims_total.inc(plugin_id=plugin.id, result="held")
+            return
+
+        try:
+            already_ran = _ran_since_due(plugin, lease)
+        except Exception:
+            coordinator.release(lease, ran=False)
+            raise
+        if already_ran:
+            logger.info(f"Plugin already ran for this due time, skipping run | plugin_id={plugin.id}")
+            metrics.lease_claims_total.inc(plugin_id=plugin.id, result="already_ran")
+            coordinator.release(lease, ran=False)
+            return
+
+        metrics.lease_claims_total.inc(plugin_id=plugin.id, result="acquired")
+        succeeded = False
+        try:
+            run_and_publish(plugin, fencing_token=lease.token)
+            succeeded = True
+        finally:
+            # Only a successful run counts as done for this due time, the other nodes retry a failed one
+            coordinator.release(lease, ran=succeeded)
+
+
+def _ran_since_due(plugin: Plugin, lease: Lease) -> bool:
+    # Every node is due at about the same time, the first one to take the lease runs the plugin
+    last_runs = [
+        last_run
+        for last_run in (get_context().store.get_last_successful_run(plugin.id), lease.last_run_at)
+        if last_run is not None
+    ]
+    if not last_runs:
+        return False
+    now = datetime.now(timezone.utc)
+    last_run = max(last_runs)
+    due = with_backoff(next_due(plugin.schedule, last_run, now), last_run, backoff_interval(plugin))
+    return due is not None and due > now
+
+
+def add_months(dt: datetime, months: int) -> datetime:
+    month_index = dt.month - 1 + months
+    year = dt.year + month_index // 12
+    month = month_index % 12 + 1
+    # The 31st of January plus one month is the last day of February
+    day = min(dt.day, calendar.monthrange(year, month)[1])
+    return dt.replace(year=year, month=month, day=day)
+
+
+def next_due(schedule: PluginSchedule, last_run: Optional[datetime], now: datetime) -> Optional[datetime]:
+    """
+    Next time a plugin with this schedule is due after its last run, None when it has no schedule.
+
+    Without a previous run, intervals count from now. A due time that passed while the ingester was down is
+    caught up with a single run right away rather than one run per missed interval.
+    """
+    base = last_run or now
+    candidates = []
+    if schedule.interval_minutes:
+        candidates.append(base + timedelta(minutes=schedule.interval_minutes))
+    if schedule.interval_hours:
+        candidates.append(base + timedelta(hours=schedule.interval_hours))
+    if schedule.interval_days:
+        candidates.append(base + timedelta(days=schedule.interval_days))
+    if schedule.interval_months:
+        candidates.append(add_months(base, schedule.interval_months))
+    if schedule.cron:
+        candidates.append(CronExpression.parse(schedule.cron).next_after(base))
+
+    if not candidates:
+        return None
+    return max(min(candidates), now)
+
+
+def backoff_interval(plugin: Plugin) -> Optional[timedelta]:
+    """Interval an adaptive plugin backed off to, None while it runs on its regular schedule."""
+    if not plugin.schedule.adaptive.enabled:
+        return None
+    backoff = get_context().store.get_schedule_backoff(plugin.id)
+    if backoff is None or backoff.interval_seconds is None:
+        return None
+    return timedelta(seconds=backoff.interval_seconds)
+
 
-def run_and_publish(plugin: Plugin):
-    with run_plugin(plugin) as plugin_output:
-        publisher.handle_output(plugin_output)
+def with_backoff(
+    due: Optional[datetime], last_run: Optional[datetime], interval: Optional[timedelta]
+) -> Optional[datetime]:
+    if due is None or last_run is None or interval is None:
+        return due
+    return max(due, last_run + interval)
 
 
-def schedule_plugins():
-    run_on_startup = []
-    for plugin in config.plugins.plugins:
+def next_backoff(
+    plugin: Plugin, backoff: Optional[ScheduleBackoff], *, produced_data: bool, now: datetime
+) -> ScheduleBackoff:
+    """
+    Where the adaptive schedule of a plugin goes after a successful run.
+
+    After empty_runs_before_backoff runs in a row without new data, every further empty run multiplies the interval
+    by backoff_factor, starting from the regular one and up to max_interval_minutes. A run with new data goes back
+    to the regular schedule.
+    """
+    if produced_data:
+        return ScheduleBackoff(empty_runs=0, interval_seconds=None, updated_at=now)
+
+    adaptive = plugin.schedule.adaptive
+    empty_runs = backoff.empty_runs + 1 if backoff is not None else 1
+    interval_seconds = backoff.interval_seconds if backoff is not None else None
+    regular_due = next_due(plugin.schedule, now, now)
+    if empty_runs >= adaptive.empty_runs_before_backoff and regular_due is not None:
+        current = interval_seconds or (regular_due - now).total_seconds()
+        interval_seconds = min(current * adaptive.backoff_factor, adaptive.max_interval_minutes * 60)
+    return ScheduleBackoff(empty_runs=empty_runs, interval_seconds=interval_seconds, updated_at=now)
+
+
+def record_backoff(plugin: Plugin, *, produced_data: bool, fencing_token: Optional[int] = None):
+    store = get_context().store
+    backoff = store.get_schedule_backoff(plugin.id)
+    new = next_backoff(plugin, backoff, produced_data=produced_data, now=datetime.now(timezone.utc))
+
+    previous_interval = backoff.interval_seconds if backoff is not None else None
+    if new.interval_seconds is None and previous_interval is not None:
+        logger.info(f"Plugin has new data, back to its regular schedule | plugin_id={plugin.id}")
+    elif new.interval_seconds != previous_interval:
+        logger.info(
+            f"Plugin has no new data, backing off | plugin_id={plugin.id} | empty_runs={new.empty_runs} | "
+            f"interval_seconds={new.interval_seconds:.0f}"
+        )
+
+    store.set_schedule_backoff(plugin.id, new, fencing_token=fencing_token)
+    metrics.backoff_interval_seconds.set(new.interval_seconds or 0, plugin_id=plugin.id)
+
+
+class PluginScheduler:
+    """
+    Keeps the plugins in a heap ordered by their next due time and sleeps until the earliest one is due.
+
+    Due times are computed from the last successful run in the state store, so restarting the ingester neither
+    resets the timers nor skips the runs that were due while it was down. Each due time gets its own random jitter
+    so plugins sharing a schedule don't all start in the same second.
+
+    Plugins can be added, removed and rescheduled while it runs. Heap entries aren't removed, each plugin has one
+    live entry and the others are dropped when they reach the top. A plugin with an adaptive schedule is rescheduled
+    after each run that changed its backoff interval.
+    """
+
+    def __init__(self, dispatcher: PluginDispatcher):
+        self.dispatcher = dispatcher
+        self._lock = threading.Lock()
+        self._heap: list[tuple[datetime, int, str]] = []
+        self._counter = itertools.count()
+        self._plugins: dict[str, Plugin] = {}
+        self._entries: dict[str, int] = {}
+        self._last_dispatch: dict[str, datetime] = {}
+        # Backoff interval each adaptive plugin was last scheduled with
+        self._backoff: dict[str, Optional[timedelta]] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        dispatcher.on_run_finished = self._run_finished
+
+    def add(self, plugin: Plugin, *, run_now: bool = False):
+        """Schedules a plugin, replacing the due time it had if it was already scheduled."""
+        now = datetime.now(timezone.utc)
+        due = now if run_now else self._next_due(plugin, now)
+        with self._lock:
+            self._plugins[plugin.id] = plugin
+            self._push(plugin.id, due)
+
+    def _push(self, plugin_id: str, due: Optional[datetime]):
+        if due is None:
+            self._entries.pop(plugin_id, None)
+            logger.warning(f"Plugin has no schedule, it won't run | plugin_id={plugin_id}")
+            return
+
+        logger.info(f"Scheduling plugin | plugin_id={plugin_id} | due_at={due.isoformat()}")
+        entry = next(self._counter)
+        self._entries[plugin_id] = entry
+        heapq.heappush(self._heap, (due, entry, plugin_id))
+        self._wake.set()
+
+    def remove(self, plugin_id: str):
+        with self._lock:
+            self._plugins.pop(plugin_id, None)
+            self._entries.pop(plugin_id, None)
+            self._backoff.pop(plugin_id, None)
+        self.dispatcher.forget(plugin_id)
+
+    def reload(self, plugins: list[Plugin]):
+        """
+        Applies a new list of plugins, only touching the ones that changed.
+
+        New plugins are scheduled, with a run right away when they have run_on_startup. Removed plugins aren't
+        scheduled anymore and a plugin whose schedule changed gets a new due time from its last run. Other changes
+        only replace the plugin used by its next runs. Runs already going aren't affected.
+        """
+        with self._lock:
+            current = dict(self._plugins)
+        new = {plugin.id: plugin for plugin in plugins}
+
+        for plugin_id in current.keys() - new.keys():
+            logger.info(f"Removing plugin | plugin_id={plugin_id}")
+            self.remove(plugin_id)
+
+        for plugin in plugins:
+            old = current.get(plugin.id)
+            if old is None:
+                logger.info(f"Adding plugin | plugin_id={plugin.id}")
+                self.add(plugin, run_now=plugin.run_on_startup)
+            elif old.schedule != plugin.schedule:
+                logger.info(f"Rescheduling plugin | plugin_id={plugin.id}")
+                self.add(plugin)
+            elif old != plugin:
+                logger.info(f"Updating plugin | plugin_id={plugin.id}")
+                with self._lock:
+                    self._plugins[plugin.id] = plugin
+
+    def _next_due(self, plugin: Plugin, now: datetime) -> Optional[datetime]:
+        # A failed run doesn't update last_successful_run, the dispatch time keeps it from being retried right away
+        last_runs = [
+            last_run
+            for last_run in (
+                get_context().store.get_last_successful_run(plugin.id),
+                self._last_dispatch.get(plugin.id),
+            )
+            if last_run is not None
+        ]
+        last_run = max(last_runs, default=None)
+        interval = backoff_interval(plugin)
+        self._backoff[plugin.id] = interval
+        due = with_backoff(next_due(plugin.schedule, last_run, now), last_run, interval)
+        if due is None or not plugin.schedule.jitter_seconds:
+            return due
+        return due + timedelta(seconds=random.uniform(0, plugin.schedule.jitter_seconds))  # noqa: S311
+
+    def _run_finished(self, plugin: Plugin):
+        if not plugin.schedule.adaptive.enabled or backoff_interval(plugin) == self._backoff.get(plugin.id):
+            return
+
+        due = self._next_due(plugin, datetime.now(timezone.utc))
+        with self._lock:
+            # Only a plugin waiting for its next run, run_forever schedules one that was just dispatched
+            if plugin.id in self._plugins and plugin.id in self._entries:
+                self._push(plugin.id, due)
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            now = datetime.now(timezone.utc)
+            plugin = None
+            with self._lock:
+                while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0][1]:
+                    heapq.heappop(self._heap)
+
+                if self._heap and self._heap[0][0] <= now:
+                    _, _, plugin_id = heapq.heappop(self._heap)
+                    del self._entries[plugin_id]
+                    plugin = self._plugins[plugin_id]
+                    timeout = 0.0
+                else:
+                    timeout = (self._heap[0][0] - now).total_seconds() if self._heap else MAX_SLEEP_SECONDS
+
+            if plugin is None:
+                # Capped so a change of the wall clock is noticed
+                self._wake.wait(min(timeout, MAX_SLEEP_SECONDS))
+                self._wake.clear()
+                continue
+
+            self._last_dispatch[plugin.id] = now
+            self.dispatcher.submit(plugin)
+
+            due = self._next_due(plugin, datetime.now(timezone.utc))
+            with self._lock:
+                # A reload while the plugin was dispatched may have removed or rescheduled it already
+                if plugin.id in self._plugins and plugin.id not in self._entries:
+                    self._push(plugin.id, due)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+def schedule_plugins(scheduler: PluginScheduler):
+    for plugin in get_context().config.plugins.plugins:
         if plugin.run_on_startup:
-            run_on_startup.append(plugin)
-        if plugin.schedule.interval_minutes:
-            logger.info(f"Scheduling plugin {plugin.id} every {plugin.schedule.interval_minutes} minutes")
-            schedule.every(plugin.schedule.interval_minutes).minutes.do(run_and_publish, plugin)
-        if plugin.schedule.interval_hours:
-            logger.info(f"Scheduling plugin {plugin.id} every {plugin.schedule.interval_hours} hours")
-            schedule.every(plugin.schedule.interval_hours).hours.do(run_and_publish, plugin)
-        if plugin.schedule.interval_days:
-            logger.info(f"Scheduling plugin {plugin.id} every {plugin.schedule.interval_days} days")
-            schedule.every(plugin.schedule.interval_days).days.do(run_and_publish, plugin)
-        if plugin.schedule.interval_months:
-            logger.info(f"Scheduling plugin {plugin.id} every {plugin.schedule.interval_months * 30} days")
-            schedule.every(plugin.schedule.interval_months * 30).days.do(run_and_publish, plugin)
-    for plugin in run_on_startup:
-        logger.debug(f"Running plugin {plugin.id} immediately since it has run_on_startup set to true")
-        run_and_publish(plugin)
+            logger.debug(f"Running plugin {plugin.id} immediately since it has run_on_startup set to true")
+        scheduler.add(plugin, run_now=plugin.run_on_startup)
+
+
+def apply_plugins_config(scheduler: PluginScheduler, plugins_config: PluginsConfig):
+    context = get_context()
+    removed = {plugin.id for plugin in context.config.plugins.plugins} - {
+        plugin.id for plugin in plugins_config.plugins
+    }
+    context.config.plugins = plugins_config
+    scheduler.reload(plugins_config.plugins)
+    for plugin_id in removed:
+        context.worker_pool.retire(plugin_id)
 
 
 def schedule_and_wait():
+    config = get_context().config
+    if config.metrics.metrics_port is not None:
+        metrics.start_metrics_server(config.metrics.metrics_host, config.metrics.metrics_port)
+
+    work_root = config.spool.work_root()
+    if work_root is not None:
+        remove_stale_run_dirs(work_root)
+
+    if config.spool.spool_enabled:
+        logger.info(f"Starting spool uploader | spool_dir={config.spool.spool_dir}")
+        get_context().spool_uploader.start()
+
     logger.info("Scheduling plugins")
-    schedule_plugins()
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    coordinator = get_context().coordinator
+    if coordinator is not None:
+        logger.info(f"Coordinating plugin runs with other nodes | node_id={coordinator.node_id}")
+
+    scheduler = PluginScheduler(PluginDispatcher(config.scheduler.scheduler_max_workers, coordinator))
+    schedule_plugins(scheduler)
+
+    watcher = None
+    if config.scheduler.scheduler_reload_interval_seconds:
+        watcher = PluginsConfigWatcher(
+            PLUGINS_CONFIG_PATH,
+            lambda plugins_config: apply_plugins_config(scheduler, plugins_config),
+            config.scheduler.scheduler_reload_interval_seconds,
+        )
+        watcher.start()
+
+    try:
+        scheduler.run_forever()
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        get_context().worker_pool.close()
+        if coordinator is not None:
+            coordinator.stop()
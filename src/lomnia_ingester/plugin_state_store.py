@@ -1,8 +1,39 @@
 import json
+import logging
+import sqlite3
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
 
+from lomnia_ingester.models import FailedToRunPlugin, PluginRun, ScheduleBackoff, UploadStats
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_dt(value: Optional[str]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return datetime.fromisoformat(value)
+
+
+def _format_dt(value: Optional[datetime]) -> Optional[str]:
+    if value is None:
+        return None
+    return value.isoformat()
+
+
+def _check_fencing_token(plugin_name: str, fencing_token: Optional[int], latest: Optional[int]) -> None:
+    # A node that lost its lease still finishes its run, the token keeps it from overwriting the new holder's state
+    if fencing_token is not None and latest is not None and fencing_token < latest:
+        logger.error(
+            f"Rejecting write with stale fencing token | plugin_id={plugin_name} | fencing_token={fencing_token} | "
+            f"latest_token={latest}"
+        )
+        raise FailedToRunPlugin("STALE_FENCING_TOKEN")
+
 
 class PluginStateStore:
     def __init__(self, path: Path):
@@ -14,6 +45,7 @@ class PluginStateStore:
             self._state = {"plugins": {}}
 
         self._state.setdefault("plugins", {})
+        self._lock = threading.RLock()
 
     def _save(self) -> None:
         tmp_path = self.path.with_suffix(".tmp")
@@ -26,19 +58,21 @@ class PluginStateStore:
     def _plugin(self, plugin_name: str) -> dict:
         return self._state["plugins"].setdefault(plugin_name, {})
 
-    def _parse_dt(self, value: Optional[str]) -> Optional[datetime]:
-        if value is None:
-            return None
-        return datetime.fromisoformat(value)
-
-    def _format_dt(self, value: Optional[datetime]) -> Optional[str]:
-        if value is None:
-            return None
-        return value.isoformat()
+    def _fence(self, plugin_name: str, fencing_token: Optional[int]) -> None:
+        plugin = self._plugin(plugin_name)
+        _check_fencing_token(plugin_name, fencing_token, plugin.get("fencing_token"))
+        if fencing_token is not None:
+            plugin["fencing_token"] = fencing_token
 
     def get_next_start_date(self, plugin_name: str) -> Optional[datetime]:
-        plugin = self._plugin(plugin_name)
-        return self._parse_dt(plugin.get("next_start_date"))
+        with self._lock:
+            plugin = self._plugin(plugin_name)
+            return _parse_dt(plugin.get("next_start_date"))
+
+    def get_last_successful_run(self, plugin_name: str) -> Optional[datetime]:
+        with self._lock:
+            plugin = self._plugin(plugin_name)
+            return _parse_dt(plugin.get("last_successful_run"))
 
     def set_next_start_date(
         self,
@@ -46,20 +80,434 @@ class PluginStateStore:
         next_start_date: datetime,
         *,
         last_successful_run: Optional[datetime] = None,
+        fencing_token: Optional[int] = None,
     ) -> None:
-        plugin = self._plugin(plugin_name)
+        with self._lock:
+            self._fence(plugin_name, fencing_token)
+            plugin = self._plugin(plugin_name)
 
-        plugin["next_start_date"] = self._format_dt(next_start_date)
+            plugin["next_start_date"] = _format_dt(next_start_date)
 
-        if last_successful_run is not None:
-            plugin["last_successful_run"] = self._format_dt(last_successful_run)
+            if last_successful_run is not None:
+                plugin["last_successful_run"] = _format_dt(last_successful_run)
 
-        self._save()
+            self._save()
 
     def clear_plugin(self, plugin_name: str) -> None:
-        if plugin_name in self._state["plugins"]:
-            del self._state["plugins"][plugin_name]
+        with self._lock:
+            if plugin_name in self._state["plugins"]:
+                del self._state["plugins"][plugin_name]
+                self._save()
+
+    def all_plugins(self) -> dict:
+        with self._lock:
+            return dict(self._state["plugins"])
+
+    def record_window(
+        self,
+        plugin_name: str,
+        window_start: datetime,
+        window_end: datetime,
+        *,
+        fencing_token: Optional[int] = None,
+    ) -> None:
+        with self._lock:
+            self._fence(plugin_name, fencing_token)
+            windows = self._plugin(plugin_name).setdefault("backfill_windows", {})
+            windows[_format_dt(window_start)] = _format_dt(window_end)
+            self._save()
+
+    def completed_windows(self, plugin_name: str) -> dict[datetime, datetime]:
+        with self._lock:
+            windows = self._plugin(plugin_name).get("backfill_windows", {})
+            return {_parse_dt(start): _parse_dt(end) for start, end in windows.items()}
+
+    def clear_windows(self, plugin_name: str, before: datetime) -> None:
+        with self._lock:
+            plugin = self._plugin(plugin_name)
+            windows = plugin.get("backfill_windows", {})
+            remaining = {start: end for start, end in windows.items() if _parse_dt(end) > before}
+            if remaining:
+                plugin["backfill_windows"] = remaining
+            else:
+                plugin.pop("backfill_windows", None)
             self._save()
 
+    def get_schedule_backoff(self, plugin_name: str) -> Optional[ScheduleBackoff]:
+        with self._lock:
+            backoff = self._plugin(plugin_name).get("schedule_backoff")
+            if backoff is None:
+                return None
+            return ScheduleBackoff(
+                empty_runs=backoff["empty_runs"],
+                interval_seconds=backoff.get("interval_seconds"),
+                updated_at=_parse_dt(backoff.get("updated_at")),
+            )
+
+    def set_schedule_backoff(
+        self, plugin_name: str, backoff: ScheduleBackoff, *, fencing_token: Optional[int] = None
+    ) -> None:
+        with self._lock:
+            self._fence(plugin_name, fencing_token)
+            self._plugin(plugin_name)["schedule_backoff"] = {
+                "empty_runs": backoff.empty_runs,
+                "interval_seconds": backoff.interval_seconds,
+                "updated_at": _format_dt(backoff.updated_at),
+            }
+            self._save()
+
+    def record_run(self, run: PluginRun) -> None:
+        # The JSON store only keeps the latest state of each plugin, use SqlitePluginStateStore for run history
+        logger.debug(f"Not recording run history in JSON store | plugin_id={run.plugin_id} | status={run.status}")
+
+    def record_delivery(self, plugin_name: str, run_started_at: datetime, stats: UploadStats) -> None:
+        logger.debug(f"Not recording run history in JSON store | plugin_id={plugin_name}")
+
+
+class SqlitePluginStateStore:
+    """
+    Plugin state kept in an embedded SQLite database.
+
+    The database runs in WAL mode and every thread gets its own connection, so plugins running in parallel threads
+    or processes can read and update their own rows without rewriting the whole state. Every run is also recorded
+    in the runs table. Writes made under a lease pass its fencing token, so replicas can share the database.
+    """
+
+    def __init__(self, path: Path, *, migrate_from: Optional[Path] = None):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS plugins (
+                    plugin_name TEXT PRIMARY KEY,
+                    next_start_date TEXT,
+                    last_successful_run TEXT
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    plugin_name TEXT NOT NULL,
+                    started_at TEXT NOT NULL,
+                    finished_at TEXT NOT NULL,
+                    duration_seconds REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    raw_files INTEGER NOT NULL,
+                    canonical_files INTEGER NOT NULL,
+                    bytes_uploaded INTEGER NOT NULL,
+                    events_published INTEGER NOT NULL,
+                    error TEXT,
+                    cpu_seconds REAL,
+                    max_rss_bytes INTEGER
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS runs_plugin_started ON runs (plugin_name, started_at)")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS run_deliveries (
+                    plugin_name TEXT NOT NULL,
+                    started_at TEXT NOT NULL,
+                    raw_files INTEGER NOT NULL,
+                    canonical_files INTEGER NOT NULL,
+                    bytes_uploaded INTEGER NOT NULL,
+                    events_published INTEGER NOT NULL,
+                    PRIMARY KEY (plugin_name, started_at)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS backfill_windows (
+                    plugin_name TEXT NOT NULL,
+                    window_start TEXT NOT NULL,
+                    window_end TEXT NOT NULL,
+                    PRIMARY KEY (plugin_name, window_start)
+                )
+                """
+            )
+            self._add_missing_columns(conn, "runs", {"cpu_seconds": "REAL", "max_rss_bytes": "INTEGER"})
+            self._add_missing_columns(
+                conn,
+                "plugins",
+                {
+                    "fencing_token": "INTEGER",
+                    "empty_runs": "INTEGER",
+                    "backoff_interval_seconds": "REAL",
+                    "backoff_updated_at": "TEXT",
+                },
+            )
+
+        if migrate_from is not None:
+            self.migrate_from_json(migrate_from)
+
+    @staticmethod
+    def _add_missing_columns(conn: sqlite3.Connection, table: str, columns: dict[str, str]) -> None:
+        """Brings tables created by older versions up to date, new columns are nullable."""
+        existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, column_type in columns.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # BEGIN IMMEDIATE takes the write lock up front, concurrent writers wait for it instead of failing mid-way
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _fence(conn: sqlite3.Connection, plugin_name: str, fencing_token: Optional[int]) -> None:
+        """Rejects writes of a lease older than the latest one seen, and records the token, in the caller's transaction."""
+        if fencing_token is None:
+            return
+
+        row = conn.execute("SELECT fencing_token FROM plugins WHERE plugin_name = ?", (plugin_name,)).fetchone()
+        _check_fencing_token(plugin_name, fencing_token, row["fencing_token"] if row else None)
+        conn.execute(
+            """
+            INSERT INTO plugins (plugin_name, fencing_token) VALUES (?, ?)
+            ON CONFLICT (plugin_name) DO UPDATE SET fencing_token = excluded.fencing_token
+            """,
+            (plugin_name, fencing_token),
+        )
+
+    def migrate_from_json(self, json_path: Path) -> None:
+        """Imports a plugins_state.json file, only when the database doesn't know about any plugin yet."""
+        if not json_path.exists():
+            return
+
+        with self._transaction() as conn:
+            if conn.execute("SELECT COUNT(*) FROM plugins").fetchone()[0] > 0:
+                return
+
+            with json_path.open("r") as f:
+                plugins = json.load(f).get("plugins", {})
+
+            logger.info(f"Migrating plugin state from JSON | json_path={json_path} | plugins={len(plugins)}")
+            conn.executemany(
+                "INSERT INTO plugins (plugin_name, next_start_date, last_successful_run) VALUES (?, ?, ?)",
+                [
+                    (name, state.get("next_start_date"), state.get("last_successful_run"))
+                    for name, state in plugins.items()
+                ],
+            )
+
+    def get_next_start_date(self, plugin_name: str) -> Optional[datetime]:
+        row = (
+            self
+            ._connection()
+            .execute("SELECT next_start_date FROM plugins WHERE plugin_name = ?", (plugin_name,))
+            .fetchone()
+        )
+        return _parse_dt(row["next_start_date"]) if row else None
+
+    def get_last_successful_run(self, plugin_name: str) -> Optional[datetime]:
+        row = (
+            self
+            ._connection()
+            .execute("SELECT last_successful_run FROM plugins WHERE plugin_name = ?", (plugin_name,))
+            .fetchone()
+        )
+        return _parse_dt(row["last_successful_run"]) if row else None
+
+    def set_next_start_date(
+        self,
+        plugin_name: str,
+        next_start_date: datetime,
+        *,
+        last_successful_run: Optional[datetime] = None,
+        fencing_token: Optional[int] = None,
+    ) -> None:
+        with self._transaction() as conn:
+            self._fence(conn, plugin_name, fencing_token)
+            conn.execute(
+                """
+                INSERT INTO plugins (plugin_name, next_start_date, last_successful_run) VALUES (?, ?, ?)
+                ON CONFLICT (plugin_name) DO UPDATE SET
+                    next_start_date = excluded.next_start_date,
+                    last_successful_run = COALESCE(excluded.last_successful_run, plugins.last_successful_run)
+                """,
+                (plugin_name, _format_dt(next_start_date), _format_dt(last_successful_run)),
+            )
+
+    def clear_plugin(self, plugin_name: str) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM plugins WHERE plugin_name = ?", (plugin_name,))
+            conn.execute("DELETE FROM backfill_windows WHERE plugin_name = ?", (plugin_name,))
+
     def all_plugins(self) -> dict:
-        return dict(self._state["plugins"])
+        rows = self._connection().execute("SELECT * FROM plugins").fetchall()
+        return {
+            row["plugin_name"]: {
+                key: row[key]
+                for key in (
+                    "next_start_date",
+                    "last_successful_run",
+                    "empty_runs",
+                    "backoff_interval_seconds",
+                    "backoff_updated_at",
+                )
+                if row[key] is not None
+            }
+            for row in rows
+        }
+
+    def record_window(
+        self,
+        plugin_name: str,
+        window_start: datetime,
+        window_end: datetime,
+        *,
+        fencing_token: Optional[int] = None,
+    ) -> None:
+        with self._transaction() as conn:
+            self._fence(conn, plugin_name, fencing_token)
+            conn.execute(
+                "INSERT OR REPLACE INTO backfill_windows (plugin_name, window_start, window_end) VALUES (?, ?, ?)",
+                (plugin_name, _format_dt(window_start), _format_dt(window_end)),
+            )
+
+    def completed_windows(self, plugin_name: str) -> dict[datetime, datetime]:
+        rows = (
+            self
+            ._connection()
+            .execute("SELECT window_start, window_end FROM backfill_windows WHERE plugin_name = ?", (plugin_name,))
+            .fetchall()
+        )
+        return {_parse_dt(row["window_start"]): _parse_dt(row["window_end"]) for row in rows}
+
+    def clear_windows(self, plugin_name: str, before: datetime) -> None:
+        # Windows are compared as datetimes, the ISO strings of different timezones don't sort chronologically
+        completed = self.completed_windows(plugin_name)
+        with self._transaction() as conn:
+            conn.executemany(
+                "DELETE FROM backfill_windows WHERE plugin_name = ? AND window_start = ?",
+                [(plugin_name, _format_dt(start)) for start, end in completed.items() if end <= before],
+            )
+
+    def get_schedule_backoff(self, plugin_name: str) -> Optional[ScheduleBackoff]:
+        row = (
+            self
+            ._connection()
+            .execute(
+                "SELECT empty_runs, backoff_interval_seconds, backoff_updated_at FROM plugins WHERE plugin_name = ?",
+                (plugin_name,),
+            )
+            .fetchone()
+        )
+        if row is None or row["empty_runs"] is None:
+            return None
+        return ScheduleBackoff(
+            empty_runs=row["empty_runs"],
+            interval_seconds=row["backoff_interval_seconds"],
+            updated_at=_parse_dt(row["backoff_updated_at"]),
+        )
+
+    def set_schedule_backoff(
+        self, plugin_name: str, backoff: ScheduleBackoff, *, fencing_token: Optional[int] = None
+    ) -> None:
+        with self._transaction() as conn:
+            self._fence(conn, plugin_name, fencing_token)
+            conn.execute(
+                """
+                INSERT INTO plugins (plugin_name, empty_runs, backoff_interval_seconds, backoff_updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (plugin_name) DO UPDATE SET
+                    empty_runs = excluded.empty_runs,
+                    backoff_interval_seconds = excluded.backoff_interval_seconds,
+                    backoff_updated_at = excluded.backoff_updated_at
+                """,
+                (plugin_name, backoff.empty_runs, backoff.interval_seconds, _format_dt(backoff.updated_at)),
+            )
+
+    def record_run(self, run: PluginRun) -> None:
+        with self._transaction() as conn:
+            stats = run.stats
+            # A spooled output can finish uploading before its run is recorded
+            key = (run.plugin_id, _format_dt(run.started_at))
+            delivered = conn.execute(
+                "SELECT raw_files, canonical_files, bytes_uploaded, events_published FROM run_deliveries "
+                "WHERE plugin_name = ? AND started_at = ?",
+                key,
+            ).fetchone()
+            if delivered is not None:
+                stats = UploadStats(**dict(delivered))
+                conn.execute("DELETE FROM run_deliveries WHERE plugin_name = ? AND started_at = ?", key)
+            conn.execute(
+                """
+                INSERT INTO runs (
+                    plugin_name, started_at, finished_at, duration_seconds, status,
+                    raw_files, canonical_files, bytes_uploaded, events_published, error,
+                    cpu_seconds, max_rss_bytes
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    run.plugin_id,
+                    _format_dt(run.started_at),
+                    _format_dt(run.finished_at),
+                    run.duration_seconds,
+                    run.status,
+                    stats.raw_files,
+                    stats.canonical_files,
+                    stats.bytes_uploaded,
+                    stats.events_published,
+                    run.error,
+                    run.resource_usage.cpu_seconds if run.resource_usage else None,
+                    run.resource_usage.max_rss_bytes if run.resource_usage else None,
+                ),
+            )
+
+    def record_delivery(self, plugin_name: str, run_started_at: datetime, stats: UploadStats) -> None:
+        """Sets the upload stats of a run whose output was delivered later, by the spool uploader."""
+        values = (stats.raw_files, stats.canonical_files, stats.bytes_uploaded, stats.events_published)
+        with self._transaction() as conn:
+            updated = conn.execute(
+                """
+                UPDATE runs SET raw_files = ?, canonical_files = ?, bytes_uploaded = ?, events_published = ?
+                WHERE plugin_name = ? AND started_at = ?
+                """,
+                (*values, plugin_name, _format_dt(run_started_at)),
+            ).rowcount
+            if not updated:
+                # record_run picks these up when it inserts the run
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO run_deliveries (
+                        plugin_name, started_at, raw_files, canonical_files, bytes_uploaded, events_published
+                    ) VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (plugin_name, _format_dt(run_started_at), *values),
+                )
+
+    def runs(self, plugin_name: str, limit: int = 100) -> list[dict]:
+        rows = (
+            self
+            ._connection()
+            .execute(
+                "SELECT * FROM runs WHERE plugin_name = ? ORDER BY started_at DESC LIMIT ?",
+                (plugin_name, limit),
+            )
+            .fetchall()
+        )
+        return [dict(row) for row in rows]
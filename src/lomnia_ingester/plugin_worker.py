@@ -0,0 +1,341 @@
+import contextlib
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import threading
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Optional
+
+from lomnia_ingester import metrics
+from lomnia_ingester.cache.workspace import SYNC_IGNORED_NAMES
+from lomnia_ingester.command import CommandExit, CommandResult, supervise_command
+from lomnia_ingester.models import FailedToRunPlugin, Plugin, PluginResources, ResourceUsage
+from lomnia_ingester.plugin_limits import command_limits
+
+logger = logging.getLogger(__name__)
+
+SERVER_SCRIPT = Path(__file__).with_name("plugin_worker_server.py")
+# Importing the plugin's dependencies the first time can be slow, e.g. while Python compiles their bytecode
+WORKER_START_TIMEOUT_SECONDS = 120
+# Time the worker gets to fork a requested command
+WORKER_SPAWN_TIMEOUT_SECONDS = 30
+# Time an idle worker gets to exit once it's told to
+WORKER_STOP_TIMEOUT_SECONDS = 10
+
+
+def _source_digest(work_dir: Path) -> str:
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(work_dir):
+        dirs[:] = sorted(d for d in dirs if d not in SYNC_IGNORED_NAMES)
+        for name in sorted(files):
+            if name.endswith(".py"):
+                path = os.path.join(root, name)
+                digest.update(f"{path}:{os.stat(path).st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def worker_key(work_dir: Path, env: dict[str, str]) -> str:
+    """
+    Identifies what a worker has imported: the checkout, its Python sources and the plugin environment variables.
+
+    UV_PROJECT_ENVIRONMENT is one of the variables and the environment path holds the hash of the lockfile, so a
+    dependency change gives a new key too.
+    """
+    digest = hashlib.sha256(str(work_dir.resolve()).encode())
+    digest.update(json.dumps(env, sort_keys=True).encode())
+    digest.update(_source_digest(work_dir).encode())
+    return digest.hexdigest()[:16]
+
+
+class _PendingCommand:
+    def __init__(self):
+        self.started = threading.Event()
+        self.exited = threading.Event()
+        self.pid: Optional[int] = None
+        self.exit: Optional[CommandExit] = None
+
+
+class PluginWorker:
+    """
+    A long lived process, running plugin_worker_server in the plugin environment, that forks extract and transform.
+
+    The plugin and its dependencies are imported once when the worker starts instead of by every command. Commands
+    are supervised like the ones run_command starts: their output is logged, timeouts and watchdogs stop their
+    process group and they report the resources they used.
+    """
+
+    def __init__(self, plugin_id: str, key: str, work_dir: Path, env: dict[str, str]):
+        self.plugin_id = plugin_id
+        self.key = key
+        self.commands: frozenset[str] = frozenset()
+        self.runs = 0
+
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending: dict[int, _PendingCommand] = {}
+        self._in_flight = 0
+        self._retired = False
+        self._alive = True
+        self._ready = threading.Event()
+
+        uv = shutil.which("uv")
+        if uv is None:
+            logger.error("uv executable not found")
+            raise FailedToRunPlugin("MISSING_EXECUTABLE_UV")
+
+        logger.info(f"Starting plugin worker | plugin_id={plugin_id} | work_dir={work_dir} | key={key}")
+        self._sock, worker_sock = socket.socketpair()
+        try:
+            self.process = subprocess.Popen(  # noqa: S603
+                [uv, "run", "--no-sync", "python", str(SERVER_SCRIPT), str(worker_sock.fileno())],
+                cwd=work_dir,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                pass_fds=(worker_sock.fileno(),),
+                start_new_session=True,
+            )
+        finally:
+            worker_sock.close()
+        metrics.worker_starts_total.inc(plugin_id=plugin_id)
+
+        self._reader = threading.Thread(target=self._read_events, name=f"plugin-worker-{plugin_id}", daemon=True)
+        self._reader.start()
+
+        if not self._ready.wait(WORKER_START_TIMEOUT_SECONDS) or not self._alive:
+            logger.error(f"Plugin worker failed to start | plugin_id={plugin_id} | work_dir={work_dir}")
+            self._stop()
+            raise FailedToRunPlugin("WORKER_START_FAILED")
+
+        logger.info(
+            f"Plugin worker ready | plugin_id={plugin_id} | pid={self.process.pid} | commands={sorted(self.commands)}"
+        )
+
+    def usable(self, key: str, max_runs: int) -> bool:
+        return self._alive and not self._retired and self.key == key and self.runs < max_runs
+
+    def acquire(self) -> None:
+        with self._lock:
+            self._in_flight += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            stop = self._retired and self._in_flight == 0
+        if stop:
+            self._stop()
+
+    def retire(self) -> None:
+        """Stops the worker once the commands it's running finished, it doesn't take new ones."""
+        with self._lock:
+            stop = not self._retired and self._in_flight == 0
+            self._retired = True
+        if stop:
+            self._stop()
+
+    def _stop(self) -> None:
+        logger.info(f"Stopping plugin worker | plugin_id={self.plugin_id} | pid={self.process.pid} | runs={self.runs}")
+        # The worker exits once it reads the end of the socket and its commands are done
+        with contextlib.suppress(OSError):
+            self._sock.shutdown(socket.SHUT_WR)
+        try:
+            self.process.wait(timeout=WORKER_STOP_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Plugin worker didn't exit, killing it | plugin_id={self.plugin_id}")
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+
+    def _read_events(self) -> None:
+        try:
+            self._receive_events()
+        except OSError:
+            logger.debug(f"Plugin worker socket closed | plugin_id={self.plugin_id}")
+        except Exception:
+            # The worker can't be trusted with more commands, nothing would report their exit
+            logger.exception(f"Unreadable message from plugin worker, giving it up | plugin_id={self.plugin_id}")
+
+        self._alive = False
+        self._ready.set()
+        self._sock.close()
+        with self._lock:
+            pending = list(self._pending.values())
+        for command in pending:
+            self._abandon(command)
+
+    def _receive_events(self) -> None:
+        buffer = b""
+        while True:
+            data = self._sock.recv(65536)
+            if not data:
+                return
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                self._handle_event(json.loads(line))
+
+    def _abandon(self, command: _PendingCommand) -> None:
+        # Nothing reports the exit of commands forked by a worker that's gone, kill them rather than let them run
+        if command.exited.is_set():
+            return
+        if command.pid is not None:
+            logger.error(f"Plugin worker exited while running a command | plugin_id={self.plugin_id}")
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(command.pid, signal.SIGKILL)
+        command.exit = (-signal.SIGKILL, ResourceUsage())
+        command.started.set()
+        command.exited.set()
+
+    def _handle_event(self, event: dict) -> None:
+        if event["event"] == "ready":
+            self.commands = frozenset(event["commands"])
+            self._ready.set()
+            return
+
+        with self._lock:
+            command = self._pending.get(event["id"])
+        if command is None:
+            return
+
+        if event["event"] == "started":
+            command.pid = event["pid"]
+            command.started.set()
+        elif event["event"] == "exited":
+            command.exit = (
+                event["returncode"],
+                ResourceUsage(cpu_seconds=event["cpu_seconds"], max_rss_bytes=event["max_rss_bytes"]),
+            )
+            command.exited.set()
+
+    def _send(self, request: dict, fds: list[int]) -> None:
+        data = json.dumps(request).encode() + b"\n"
+        sent = socket.send_fds(self._sock, [data], fds)
+        if sent < len(data):
+            self._sock.sendall(data[sent:])
+
+    def run(
+        self,
+        command: str,
+        args: list[str],
+        *,
+        description: str,
+        resources: PluginResources,
+        timeout: Optional[float] = None,
+        watchdog: Optional[Callable[[], None]] = None,
+    ) -> CommandResult:
+        """Runs one of the plugin's commands in a child of the worker, like run_command would with uv run."""
+        cmd = [command, *args]
+        logger.info(
+            f"Running command in plugin worker | description={description} | cmd={cmd} | worker_pid={self.process.pid}"
+        )
+
+        pending = _PendingCommand()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        streams = {"stdout": open(stdout_r, errors="replace"), "stderr": open(stderr_r, errors="replace")}  # noqa: SIM115
+        limits = command_limits(resources)
+
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = pending
+            self.runs += 1
+            try:
+                self._send({"id": request_id, "command": command, "args": args, "limits": limits}, [stdout_w, stderr_w])
+            except OSError:
+                self._abandon(pending)
+            finally:
+                # The child holds the write ends now, reading stops once it and what it started exited
+                os.close(stdout_w)
+                os.close(stderr_w)
+
+        try:
+            if not pending.started.wait(WORKER_SPAWN_TIMEOUT_SECONDS) or pending.pid is None:
+                logger.error(f"Plugin worker didn't start the command | plugin_id={self.plugin_id} | cmd={cmd}")
+                for stream in streams.values():
+                    stream.close()
+                self.retire()
+                raise FailedToRunPlugin("WORKER_UNAVAILABLE")
+
+            return supervise_command(
+                cmd,
+                pid=pending.pid,
+                streams=streams,
+                poll=lambda: pending.exit,
+                wait_exit=pending.exited.wait,
+                description=description,
+                timeout=timeout,
+                watchdog=watchdog,
+            )
+        finally:
+            with self._lock:
+                del self._pending[request_id]
+
+
+class PluginWorkerPool:
+    """
+    Keeps one pre-warmed PluginWorker per plugin.
+
+    A worker is replaced when the checkout, sources, environment or plugin variables it imported changed, after
+    worker_max_runs commands and when it exited. The replaced worker stops once its running commands finished.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._plugin_locks: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
+        self._workers: dict[str, PluginWorker] = {}
+
+    @contextmanager
+    def worker(self, plugin: Plugin, work_dir: Path, env: dict[str, str]) -> Iterator[PluginWorker]:
+        key = worker_key(work_dir, env)
+
+        with self._plugin_locks[plugin.id]:
+            with self._lock:
+                worker = self._workers.get(plugin.id)
+
+            if worker is not None and not worker.usable(key, plugin.execution.worker_max_runs):
+                logger.info(
+                    f"Replacing plugin worker | plugin_id={plugin.id} | runs={worker.runs} | "
+                    f"key_changed={worker.key != key}"
+                )
+                worker.retire()
+                worker = None
+
+            if worker is None:
+                worker = PluginWorker(plugin.id, key, work_dir, env)
+                missing = {"extract", "transform"} - worker.commands
+                if missing:
+                    logger.warning(
+                        f"Plugin has no console script for some commands, they run with uv run | "
+                        f"plugin_id={plugin.id} | missing={sorted(missing)}"
+                    )
+                with self._lock:
+                    self._workers[plugin.id] = worker
+
+            worker.acquire()
+
+        try:
+            yield worker
+        finally:
+            worker.release()
+
+    def retire(self, plugin_id: str) -> None:
+        """Stops the worker of a plugin that was removed, once its running commands finished."""
+        with self._lock:
+            worker = self._workers.pop(plugin_id, None)
+        if worker is not None:
+            worker.retire()
+
+    def close(self) -> None:
+        with self._lock:
+            workers = list(self._workers.values())
+            self._workers.clear()
+        for worker in workers:
+            worker.retire()
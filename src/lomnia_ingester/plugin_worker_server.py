@@ -0,0 +1,187 @@
+"""
+Pre-warmed plugin worker, started by PluginWorker inside the plugin environment with `uv run --no-sync python`.
+
+Imports the plugin's extract and transform console scripts once, then forks a child for every command requested
+over the socket it was given, so each command starts with the plugin and its dependencies already imported.
+
+This file runs on the plugin's interpreter, not the ingester's, so it only uses the standard library and must keep
+working on the oldest Python plugins can use.
+
+Protocol, one JSON object per line in both directions:
+
+- worker: {"event": "ready", "commands": [...]} once the entry points are imported
+- ingester: {"id": 1, "command": "extract", "args": [...], "limits": {...}}, sent along with two file descriptors
+  that become the stdout and stderr of the command
+- worker: {"id": 1, "event": "started", "pid": 123} right after the fork, the child leads its own process group
+- worker: {"id": 1, "event": "exited", "returncode": 0, "cpu_seconds": 1.5, "max_rss_bytes": 1024}
+
+The worker exits once the ingester closes its end of the socket and the running commands finished.
+"""
+
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import traceback
+from collections import deque
+
+COMMANDS = ("extract", "transform")
+# The stdout and stderr of a command
+FDS_PER_REQUEST = 2
+
+
+def load_commands() -> dict:
+    from importlib.metadata import entry_points
+
+    eps = entry_points()
+    # Python 3.9 returns a dict of groups, later versions a selectable collection
+    scripts = eps.select(group="console_scripts") if hasattr(eps, "select") else eps.get("console_scripts", ())
+    commands = {}
+    for ep in scripts:
+        if ep.name in COMMANDS and ep.name not in commands:
+            commands[ep.name] = ep.load()
+    return commands
+
+
+def apply_limits(limits: dict) -> None:
+    # Also used by plugin_limits_exec.py for the commands started with uv run
+    if limits.get("cpu_seconds") is not None or limits.get("memory_bytes") is not None:
+        import resource
+
+        if limits.get("cpu_seconds") is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, (limits["cpu_seconds"], limits["cpu_seconds"] + 5))
+        if limits.get("memory_bytes") is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (limits["memory_bytes"], limits["memory_bytes"]))
+    if limits.get("nice") is not None:
+        os.nice(limits["nice"])
+
+
+def exit_code(func) -> int:
+    # What the console script wrapper does with sys.exit(main())
+    try:
+        result = func()
+    except SystemExit as exc:
+        result = exc.code
+    except BaseException:
+        traceback.print_exc()
+        return 1
+
+    if result is None:
+        return 0
+    if isinstance(result, int):
+        return result
+    print(result, file=sys.stderr)
+    return 1
+
+
+class WorkerServer:
+    def __init__(self, sock: socket.socket, commands: dict):
+        self.sock = sock
+        self.commands = commands
+        self.running: dict[int, int] = {}
+        self.buffer = b""
+        self.fds: deque = deque()
+        self.open = True
+
+        # SIGCHLD writes to the pipe, so select wakes up as soon as a command exits
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_w, False)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(self.wakeup_w)
+
+    def send(self, message: dict) -> None:
+        try:
+            self.sock.sendall(json.dumps(message).encode() + b"\n")
+        except OSError:
+            # The ingester went away, running commands still finish
+            self.open = False
+
+    def serve(self) -> None:
+        self.send({"event": "ready", "commands": sorted(self.commands)})
+        while self.open or self.running:
+            watched = [self.sock, self.wakeup_r] if self.open else [self.wakeup_r]
+            readable, _, _ = select.select(watched, [], [], 1.0)
+            if self.wakeup_r in readable:
+                os.read(self.wakeup_r, 4096)
+            self.reap()
+            if self.open and self.sock in readable:
+                self.receive()
+
+    def receive(self) -> None:
+        data, fds, _, _ = socket.recv_fds(self.sock, 65536, 16)
+        self.fds.extend(fds)
+        if not data:
+            self.open = False
+            return
+
+        self.buffer += data
+        while b"\n" in self.buffer:
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            request = json.loads(line)
+            stdout_fd, stderr_fd = (self.fds.popleft() for _ in range(FDS_PER_REQUEST))
+            try:
+                pid = self.spawn(request, stdout_fd, stderr_fd)
+            finally:
+                os.close(stdout_fd)
+                os.close(stderr_fd)
+            self.running[pid] = request["id"]
+            self.send({"id": request["id"], "event": "started", "pid": pid})
+
+    def spawn(self, request: dict, stdout_fd: int, stderr_fd: int) -> int:
+        pid = os.fork()
+        if pid:
+            return pid
+
+        code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            os.setsid()
+            os.dup2(stdout_fd, 1)
+            os.dup2(stderr_fd, 2)
+            # Pipes of other requests must not stay open here, their readers would never see the end of them
+            for fd in (stdout_fd, stderr_fd, self.wakeup_r, self.wakeup_w, *self.fds):
+                os.close(fd)
+            self.sock.close()
+
+            apply_limits(request.get("limits") or {})
+            sys.argv = [request["command"], *request["args"]]
+            code = exit_code(self.commands[request["command"]])
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def reap(self) -> None:
+        while self.running:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+
+            request_id = self.running.pop(pid, None)
+            if request_id is None:
+                continue
+            self.send({
+                "id": request_id,
+                "event": "exited",
+                "returncode": os.waitstatus_to_exitcode(status),
+                "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+                # Linux reports max RSS in kilobytes
+                "max_rss_bytes": rusage.ru_maxrss * 1024,
+            })
+
+
+def main() -> None:
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    WorkerServer(sock, load_commands()).serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+from lomnia_ingester import metrics
+from lomnia_ingester.config import PluginsConfig, load_plugins_config
+
+logger = logging.getLogger(__name__)
+
+
+def _file_signature(path: Path) -> Optional[tuple[int, int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    # Editors often save by writing a new file and renaming it over the old one, which changes the inode
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class PluginsConfigWatcher:
+    """
+    Checks plugins.yaml every poll_interval_seconds and hands on_reload the new config once it changed.
+
+    A config that doesn't load or validate is logged and ignored, the plugins keep running with the previous one
+    until the file is fixed.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        on_reload: Callable[[PluginsConfig], None],
+        poll_interval_seconds: float,
+    ):
+        self.path = path
+        self.on_reload = on_reload
+        self.poll_interval_seconds = poll_interval_seconds
+
+        self._signature = _file_signature(path)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._watch, name="plugins-config-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.poll_interval_seconds):
+            self.check()
+
+    def check(self) -> bool:
+        """Reloads the config if the file changed since the last check, returns whether a new config was applied."""
+        signature = _file_signature(self.path)
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+
+        logger.info(f"Plugins config changed, reloading | path={self.path}")
+        try:
+            plugins_config = load_plugins_config(self.path)
+        except Exception:
+            logger.exception(f"Invalid plugins config, keeping the current one | path={self.path}")
+            metrics.config_reloads_total.inc(result="invalid")
+            return False
+
+        self.on_reload(plugins_config)
+        metrics.config_reloads_total.inc(result="applied")
+        return True
@@ -1,7 +1,28 @@
-import pika
+import logging
+import threading
+from typing import TYPE_CHECKING, Optional
+
+from lomnia_ingester.retry import RetryPolicy
+
+if TYPE_CHECKING:
+    from pika.adapters.blocking_connection import BlockingChannel
+
+logger = logging.getLogger(__name__)
 
 
 class QueuePublisher:
+    """
+    Publishes messages over a single long-lived AMQP connection.
+
+    The connection is opened on first use and reopened when the broker dropped it. Messages are published inside
+    an AMQP transaction, so a batch is handed to the broker with one commit round trip and publish_batch only
+    returns once the broker has accepted every message in it.
+
+    A BlockingConnection only answers heartbeats while it's used, so a background thread services it between
+    publishes. Otherwise the broker drops a connection that was idle for a while and the next publish pays for a
+    failed attempt and a reconnect.
+    """
+
     def __init__(
         self,
         host: str,
@@ -9,23 +30,112 @@ class QueuePublisher:
         username: str,
         password: str,
         queue_name: str,
+        retry: Optional[RetryPolicy] = None,
+        heartbeat_seconds: int = 60,
     ):
+        # Imported here so importing the ingester doesn't pay for pika until a publisher is built
+        import pika
+
         self.queue_name = queue_name
+        # Without a policy the batch is still retried once, the broker closing an idle connection is common
+        self.retry = retry or RetryPolicy(attempts=2, base_delay_seconds=0)
         self.connection_params = pika.ConnectionParameters(
             host=host,
             port=port,
             credentials=pika.PlainCredentials(username, password),
+            heartbeat=heartbeat_seconds,
         )
+        self.heartbeat_seconds = heartbeat_seconds
+
+        # pika connections are not thread safe and plugins publish from several threads
+        self._lock = threading.Lock()
+        self._connection: Optional[pika.BlockingConnection] = None
+        self._channel: Optional[BlockingChannel] = None
+        self._stop = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
 
     def publish(self, message: bytes):
-        conn = pika.BlockingConnection(self.connection_params)
-        channel = conn.channel()
+        self.publish_batch([message])
+
+    def publish_batch(self, messages: list[bytes]):
+        from pika.exceptions import AMQPError
+
+        if not messages:
+            return
+
+        with self._lock:
+            # Reconnect before retrying, most likely the broker closed an idle connection. A batch is only
+            # committed as a whole, so retrying it can at worst deliver it twice if the commit itself got lost.
+            self.retry.call(
+                lambda: self._publish_batch(messages),
+                retry_if=lambda exc: isinstance(exc, AMQPError),
+                operation="queue_publish",
+                on_retry=lambda exc: self._close(),
+            )
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            self._close()
+
+    def _service_connection(self):
+        from pika.exceptions import AMQPError
 
+        # Well within the heartbeat timeout, the broker gives up after missing two heartbeats
+        while not self._stop.wait(self.heartbeat_seconds / 4):
+            with self._lock:
+                if self._connection is None or not self._connection.is_open:
+                    continue
+                try:
+                    self._connection.process_data_events(time_limit=0)
+                except AMQPError:
+                    logger.warning("Queue connection lost while idle, reconnecting on the next publish", exc_info=True)
+                    self._close()
+
+    def _publish_batch(self, messages: list[bytes]):
+        channel = self._ensure_channel()
+
+        for message in messages:
+            channel.basic_publish(
+                exchange="",
+                routing_key=self.queue_name,
+                body=message,
+            )
+
+        channel.tx_commit()
+
+    def _ensure_channel(self) -> "BlockingChannel":
+        import pika
+
+        if self._channel is not None and self._channel.is_open:
+            return self._channel
+
+        self._close()
+
+        logger.info(f"Connecting to queue | host={self.connection_params.host} | queue={self.queue_name}")
+        self._connection = pika.BlockingConnection(self.connection_params)
+        channel = self._connection.channel()
         channel.queue_declare(queue=self.queue_name, durable=True)
-        channel.basic_publish(
-            exchange="",
-            routing_key=self.queue_name,
-            body=message,
-        )
+        channel.tx_select()
+        self._channel = channel
+
+        if self._heartbeat_thread is None:
+            self._heartbeat_thread = threading.Thread(
+                target=self._service_connection, name="queue-heartbeat", daemon=True
+            )
+            self._heartbeat_thread.start()
+
+        return channel
+
+    def _close(self):
+        from pika.exceptions import AMQPError
+
+        connection = self._connection
+        self._connection = None
+        self._channel = None
 
-        conn.close()
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except AMQPError:
+                logger.debug("Failed to close queue connection cleanly", exc_info=True)
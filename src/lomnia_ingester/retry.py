@@ -0,0 +1,50 @@
+import logging
+import random
+import time
+from typing import Callable, TypeVar
+
+from pydantic.dataclasses import dataclass
+
+from lomnia_ingester import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class RetryPolicy:
+    attempts: int = 5
+    base_delay_seconds: float = 0.5
+    max_delay_seconds: float = 30
+
+    def delay(self, attempt: int) -> float:
+        # "Full jitter": a random wait up to the exponential backoff, so clients hitting the same outage spread out
+        return random.uniform(0, min(self.max_delay_seconds, self.base_delay_seconds * 2**attempt))  # noqa: S311
+
+    def call(
+        self,
+        func: Callable[[], T],
+        *,
+        retry_if: Callable[[Exception], bool],
+        operation: str,
+        on_retry: Callable[[Exception], None] = lambda exc: None,
+    ) -> T:
+        """Calls func, retrying it while it raises errors retry_if deems transient and attempts are left."""
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception as exc:
+                attempt += 1
+                if attempt >= self.attempts or not retry_if(exc):
+                    raise
+
+                delay = self.delay(attempt - 1)
+                logger.warning(
+                    f"Operation failed, retrying | operation={operation} | attempt={attempt}/{self.attempts} | "
+                    f"retry_in={delay:.2f}s | error={exc!r}"
+                )
+                metrics.retries_total.inc(operation=operation)
+                on_retry(exc)
+                time.sleep(delay)
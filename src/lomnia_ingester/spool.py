@@ -0,0 +1,214 @@
+import json
+import logging
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+from lomnia_ingester.models import PluginOutput
+from lomnia_ingester.outbox import OUTBOX_NAME, Outbox
+from lomnia_ingester.plugin_output_publisher import PluginOutputPublisher
+from lomnia_ingester.plugin_state_store import PluginStateStore, SqlitePluginStateStore
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+
+class OutputSpool:
+    """
+    Durable on-disk queue of plugin outputs waiting to be uploaded.
+
+    Each entry is a directory holding the raw and canonical folders of one run, a manifest and the outbox of
+    what was already delivered, so a retry picks up where the previous attempt stopped. Entries are
+    assembled under incoming/ and renamed into pending/ once complete, so a crash never leaves a half written
+    entry in the queue. Entries that keep failing, or whose manifest can't be read, end up in failed/ for a human
+    to look at.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.incoming_dir = root / "incoming"
+        self.pending_dir = root / "pending"
+        self.failed_dir = root / "failed"
+
+        for directory in (self.incoming_dir, self.pending_dir, self.failed_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+
+        # Leftovers of entries that were being assembled when the process died
+        for leftover in self.incoming_dir.iterdir():
+            shutil.rmtree(leftover, ignore_errors=True)
+
+    def enqueue(
+        self,
+        output: PluginOutput,
+        outbox: Optional[Outbox] = None,
+        *,
+        run_started_at: Optional[datetime] = None,
+    ) -> Path:
+        name = f"{output.extracted_at.strftime('%Y%m%dT%H%M%S')}-{output.id}-{uuid.uuid4().hex[:8]}"
+        incoming = self.incoming_dir / name
+        incoming.mkdir()
+
+        # A rename when the spool is on the same filesystem as the output, a copy otherwise
+        shutil.move(str(output.raw), str(incoming / "raw"))
+        shutil.move(str(output.canonical), str(incoming / "canonical"))
+        if outbox is not None and outbox.path.exists():
+            shutil.move(str(outbox.path), str(incoming / OUTBOX_NAME))
+        self._write_manifest(
+            incoming,
+            {
+                "id": output.id,
+                "extracted_at": output.extracted_at.isoformat(),
+                "run_started_at": run_started_at.isoformat() if run_started_at else None,
+                "attempts": 0,
+                "next_attempt_at": None,
+            },
+        )
+
+        entry = self.pending_dir / name
+        incoming.rename(entry)
+        logger.info(f"Spooled plugin output | plugin_id={output.id} | entry={entry}")
+        return entry
+
+    def pending(self) -> list[Path]:
+        now = time.time()
+        ready = []
+        for entry in sorted(self.pending_dir.iterdir()):
+            try:
+                next_attempt_at = self.manifest(entry).get("next_attempt_at")
+            except (OSError, ValueError, AttributeError):
+                # One broken entry mustn't keep the others from being retried
+                logger.exception(f"Unreadable spool manifest, moving entry to failed | entry={entry.name}")
+                entry.rename(self.failed_dir / entry.name)
+                continue
+            if next_attempt_at is None or next_attempt_at <= now:
+                ready.append(entry)
+        return ready
+
+    def manifest(self, entry: Path) -> dict:
+        with (entry / MANIFEST_NAME).open("r") as f:
+            return json.load(f)
+
+    def load(self, entry: Path) -> PluginOutput:
+        manifest = self.manifest(entry)
+        return PluginOutput(
+            raw=entry / "raw",
+            canonical=entry / "canonical",
+            extracted_at=datetime.fromisoformat(manifest["extracted_at"]),
+            id=manifest["id"],
+        )
+
+    def outbox(self, entry: Path) -> Outbox:
+        return Outbox(entry / OUTBOX_NAME)
+
+    def complete(self, entry: Path) -> None:
+        shutil.rmtree(entry, ignore_errors=True)
+
+    def fail(self, entry: Path, error: str, *, max_attempts: int, backoff_seconds: float) -> None:
+        manifest = self.manifest(entry)
+        manifest["attempts"] += 1
+        manifest["last_error"] = error
+
+        if manifest["attempts"] >= max_attempts:
+            self._write_manifest(entry, manifest)
+            entry.rename(self.failed_dir / entry.name)
+            logger.error(f"Giving up on spooled output | entry={entry.name} | attempts={manifest['attempts']}")
+            return
+
+        delay = backoff_seconds * 2 ** (manifest["attempts"] - 1)
+        manifest["next_attempt_at"] = time.time() + delay
+        self._write_manifest(entry, manifest)
+        logger.warning(f"Spooled output failed, retrying later | entry={entry.name} | retry_in={delay:.0f}s")
+
+    def _write_manifest(self, entry: Path, manifest: dict) -> None:
+        tmp_path = entry / f"{MANIFEST_NAME}.tmp"
+        with tmp_path.open("w") as f:
+            json.dump(manifest, f)
+        tmp_path.replace(entry / MANIFEST_NAME)
+
+
+class SpoolUploader:
+    """
+    Drains an OutputSpool in the background with its own concurrency, retrying failed entries with backoff.
+
+    Once an entry is uploaded its stats are recorded on the run that spooled it, when the store keeps run history.
+    """
+
+    def __init__(
+        self,
+        spool: OutputSpool,
+        publisher: PluginOutputPublisher,
+        *,
+        store: Optional[Union[PluginStateStore, SqlitePluginStateStore]] = None,
+        concurrency: int = 1,
+        poll_interval_seconds: float = 5,
+        max_attempts: int = 10,
+        backoff_seconds: float = 30,
+    ):
+        self.spool = spool
+        self.publisher = publisher
+        self.store = store
+        self.poll_interval_seconds = poll_interval_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="spool")
+        self._in_flight: set[Path] = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="spool-uploader", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self._dispatch_ready()
+            except Exception:
+                logger.exception("Failed to scan output spool")
+            self._wake.wait(self.poll_interval_seconds)
+            self._wake.clear()
+
+    def _dispatch_ready(self) -> None:
+        for entry in self.spool.pending():
+            with self._lock:
+                if entry in self._in_flight:
+                    continue
+                self._in_flight.add(entry)
+            self._executor.submit(self._upload, entry)
+
+    def _upload(self, entry: Path) -> None:
+        try:
+            manifest = self.spool.manifest(entry)
+            stats = self.publisher.handle_output(self.spool.load(entry), outbox=self.spool.outbox(entry))
+        except Exception as exc:
+            logger.exception(f"Failed to upload spooled output | entry={entry.name}")
+            self.spool.fail(entry, repr(exc), max_attempts=self.max_attempts, backoff_seconds=self.backoff_seconds)
+        else:
+            self.spool.complete(entry)
+            run_started_at = manifest.get("run_started_at")
+            if self.store is not None and run_started_at is not None:
+                self.store.record_delivery(manifest["id"], datetime.fromisoformat(run_started_at), stats)
+        finally:
+            with self._lock:
+                self._in_flight.discard(entry)
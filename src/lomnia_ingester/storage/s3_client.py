@@ -1,7 +1,16 @@
 from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 
-import boto3
-from mypy_boto3_s3 import S3Client
+from lomnia_ingester.retry import RetryPolicy
+from lomnia_ingester.storage.upload_index import HashingReader
+
+if TYPE_CHECKING:
+    from boto3.s3.transfer import TransferConfig
+    from mypy_boto3_s3 import S3Client
+
+# HEAD responses have no body, a missing object only comes back as its status code
+NOT_FOUND_CODES = {"404", "NoSuchKey", "NotFound"}
+THROTTLING_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestTimeout", "RequestTimeTooSkewed"}
 
 
 class S3Storage:
@@ -12,16 +21,84 @@ class S3Storage:
         endpoint_url: str,
         access_key_id: str,
         secret_access_key: str,
+        transfer_config: Optional["TransferConfig"] = None,
+        max_pool_connections: int = 10,
+        retry: Optional[RetryPolicy] = None,
     ):
+        # boto3 takes a while to import, only pay for it when storage is actually used
+        import boto3
+        from botocore.config import Config
+
         self.bucket = bucket
+        self.transfer_config = transfer_config
+        self.retry = retry or RetryPolicy(attempts=1)
         self.client: S3Client = boto3.client(
             "s3",
             region_name=region_name,
             endpoint_url=endpoint_url,
             aws_access_key_id=access_key_id,
             aws_secret_access_key=secret_access_key,
+            config=Config(max_pool_connections=max_pool_connections),
         )
 
     def upload_file(self, file_path: Path, key: str) -> str:
-        self.client.upload_file(str(file_path), self.bucket, key)
+        self.retry.call(
+            lambda: self.client.upload_file(str(file_path), self.bucket, key, Config=self.transfer_config),
+            retry_if=is_transient_error,
+            operation="s3_upload",
+        )
+        return key
+
+    def upload_file_hashed(self, file_path: Path, key: str) -> str:
+        """Uploads a file and returns its sha256, computed while it's read for the upload."""
+
+        def upload() -> str:
+            # Every attempt starts over from the start of the file with a fresh hash
+            with file_path.open("rb") as f:
+                reader = HashingReader(f)
+                self.client.upload_fileobj(reader, self.bucket, key, Config=self.transfer_config)
+            return reader.hexdigest()
+
+        return self.retry.call(upload, retry_if=is_transient_error, operation="s3_upload")
+
+    def copy_file(self, source_key: str, key: str) -> str:
+        self.retry.call(
+            lambda: self.client.copy(
+                {"Bucket": self.bucket, "Key": source_key}, self.bucket, key, Config=self.transfer_config
+            ),
+            retry_if=is_transient_error,
+            operation="s3_copy",
+        )
         return key
+
+    def object_exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        def head() -> bool:
+            try:
+                self.client.head_object(Bucket=self.bucket, Key=key)
+            except ClientError as exc:
+                if exc.response.get("Error", {}).get("Code") in NOT_FOUND_CODES:
+                    return False
+                raise
+            return True
+
+        return self.retry.call(head, retry_if=is_transient_error, operation="s3_head")
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    from boto3.exceptions import S3UploadFailedError
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    if isinstance(exc, S3UploadFailedError):
+        # upload_file wraps whatever went wrong, the error it raised from tells whether retrying can help
+        cause = exc.__cause__ or exc.__context__
+        return cause is not None and is_transient_error(cause)
+
+    if isinstance(exc, ClientError):
+        # Client mistakes like a missing bucket or bad credentials won't go away by retrying
+        status = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return status >= 500 or status == 429 or exc.response.get("Error", {}).get("Code") in THROTTLING_CODES
+
+    # Connection errors and timeouts are BotoCoreErrors
+    return isinstance(exc, BotoCoreError)
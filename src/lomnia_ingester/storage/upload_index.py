@@ -0,0 +1,91 @@
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashingReader:
+    """
+    Read-only file wrapper that hashes everything read through it, so a file is hashed by the pass that uploads it.
+
+    It reports itself as not seekable, which makes boto3 read it once from start to end.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._f.read(size)
+        self.digest.update(chunk)
+        return chunk
+
+    def seekable(self) -> bool:
+        return False
+
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+
+class UploadIndex:
+    """
+    Local SQLite index of the content hashes of every uploaded object.
+
+    Hashes are scoped by upload folder (plugins/{id}/{raw|canonical}), so identical files coming from different
+    plugins or stages are still uploaded separately.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS uploads (
+                    folder TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    bucket TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    uploaded_at TEXT NOT NULL,
+                    PRIMARY KEY (folder, sha256, bucket)
+                )
+                """
+            )
+
+    def find(self, folder: str, sha256: str, bucket: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT key FROM uploads WHERE folder = ? AND sha256 = ? AND bucket = ?",
+                (folder, sha256, bucket),
+            ).fetchone()
+        return row[0] if row else None
+
+    def record(self, folder: str, sha256: str, size: int, bucket: str, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploads (folder, sha256, size, bucket, key, uploaded_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (folder, sha256, size, bucket, key, datetime.now(timezone.utc).isoformat()),
+            )
+
+    def forget(self, folder: str, sha256: str, bucket: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM uploads WHERE folder = ? AND sha256 = ? AND bucket = ?",
+                (folder, sha256, bucket),
+            )
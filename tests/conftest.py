@@ -0,0 +1,20 @@
+import pytest
+
+from lomnia_ingester.context import AppContext, set_context
+from lomnia_ingester.plugin_state_store import PluginStateStore, SqlitePluginStateStore
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SqlitePluginStateStore(tmp_path / "state.db")
+    return PluginStateStore(tmp_path / "plugins_state.json")
+
+
+@pytest.fixture
+def context(store):
+    """An application context with a fresh state store, installed for the code that calls get_context()."""
+    context = AppContext(store=store)
+    set_context(context)
+    yield context
+    set_context(None)
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+from lomnia_ingester.backfill import _advance_watermark, plan_windows, run_backfill
+from lomnia_ingester.models import FailedToRunPlugin, Plugin
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+DAY = timedelta(days=1)
+
+
+def make_plugin(**backfill) -> Plugin:
+    return Plugin(
+        id="fake",
+        path=Path("/plugins/fake"),
+        folder=None,
+        env=None,
+        schedule={"interval_hours": 1},
+        backfill={"enabled": True, "window_hours": 24, **backfill},
+    )
+
+
+@pytest.mark.parametrize(
+    ("end", "window", "expected"),
+    [
+        (START + 2 * DAY, DAY, [(START, START + DAY), (START + DAY, START + 2 * DAY)]),
+        # The last window is cut at the end date
+        (START + 30 * timedelta(hours=1), DAY, [(START, START + DAY), (START + DAY, START + 30 * timedelta(hours=1))]),
+        (START + timedelta(hours=1), DAY, [(START, START + timedelta(hours=1))]),
+        (START, DAY, []),
+        (START - DAY, DAY, []),
+    ],
+)
+def test_plan_windows(end, window, expected):
+    assert plan_windows(START, end, window) == expected
+
+
+@pytest.mark.parametrize(
+    ("completed_days", "watermark_day"),
+    [
+        ([0, 1, 2], 3),
+        # A gap stops the watermark, the window after it is kept for later
+        ([0, 2], 1),
+        ([1, 2], None),
+        ([], None),
+    ],
+)
+def test_advance_watermark(context, store, completed_days, watermark_day):
+    completed = {START + day * DAY: START + (day + 1) * DAY for day in completed_days}
+    for window_start, window_end in completed.items():
+        store.record_window("fake", window_start, window_end)
+
+    _advance_watermark(make_plugin(), START, completed, fencing_token=None)
+
+    if watermark_day is None:
+        assert store.get_next_start_date("fake") is None
+        assert store.completed_windows("fake") == completed
+    else:
+        watermark = START + watermark_day * DAY
+        assert store.get_next_start_date("fake") == watermark
+        assert store.completed_windows("fake") == {
+            window_start: window_end for window_start, window_end in completed.items() if window_end > watermark
+        }
+
+
+def test_failed_window_is_retried_and_completed_ones_are_skipped(context, store):
+    plugin = make_plugin(max_parallel_windows=2)
+    start_date = datetime.now(timezone.utc) - 3 * DAY - timedelta(hours=1)
+    failing = start_date + DAY
+    ran = []
+
+    def run_window(window_start: datetime, window_end: datetime):
+        ran.append(window_start)
+        if window_start == failing:
+            raise RuntimeError
+
+    with pytest.raises(FailedToRunPlugin) as exc_info:
+        run_backfill(plugin, start_date, run_window)
+
+    assert exc_info.value.args == ("BACKFILL_WINDOWS_FAILED",)
+    assert len(ran) == 4
+    # Only the window before the failed one moved the watermark
+    assert store.get_next_start_date("fake") == failing
+
+    ran.clear()
+    run_backfill(plugin, failing, run_window=lambda window_start, window_end: ran.append(window_start))
+
+    assert ran == [failing]
+    assert store.get_next_start_date("fake") > start_date + 3 * DAY
+    assert store.completed_windows("fake") == {}
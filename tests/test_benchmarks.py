@@ -0,0 +1,25 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+BENCHMARK = Path(__file__).resolve().parent.parent / "benchmarks" / "run.py"
+
+
+def test_smoke_benchmark_runs_the_ingest_path():
+    # An empty environment so a local .env or exported settings can't change what the benchmark does
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, str(BENCHMARK), "smoke", "--iterations", "1", "--json"],
+        env={"PATH": os.environ.get("PATH", "")},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    smoke = json.loads(result.stdout)["smoke"]
+    # 20 raw files, their 2 meta files and 20 canonical files, uploaded again under the same keys every run
+    assert smoke["objects_stored"] == 42
+    # One event per canonical file, for the warm-up run and the measured one
+    assert smoke["messages_published"] == 40
+    assert {"extract", "transform", "upload", "publish"} <= set(smoke["stage_seconds"])
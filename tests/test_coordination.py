@@ -0,0 +1,100 @@
+from pathlib import Path
+
+import pytest
+
+from lomnia_ingester import plugin_scheduler
+from lomnia_ingester.config import load_config
+from lomnia_ingester.coordination import LeaseCoordinator, SqliteLeaseBackend
+from lomnia_ingester.models import FailedToRunPlugin, Plugin
+from lomnia_ingester.plugin_scheduler import PluginDispatcher, _ran_since_due
+
+
+def make_plugin() -> Plugin:
+    return Plugin(id="fake", path=Path("/plugins/fake"), folder=None, env=None, schedule={"interval_minutes": 30})
+
+
+@pytest.fixture
+def backend(tmp_path) -> SqliteLeaseBackend:
+    return SqliteLeaseBackend(tmp_path / "leases.sqlite")
+
+
+def coordinator(backend: SqliteLeaseBackend, node_id: str) -> LeaseCoordinator:
+    return LeaseCoordinator(backend, node_id, lease_seconds=60)
+
+
+def test_failed_run_stays_due_on_the_other_nodes(context, backend, monkeypatch):
+    def failing(plugin: Plugin, *, fencing_token=None):
+        raise RuntimeError
+
+    monkeypatch.setattr(plugin_scheduler, "run_and_publish", failing)
+    node_a = coordinator(backend, "a")
+
+    with pytest.raises(RuntimeError):
+        PluginDispatcher(max_workers=1, coordinator=node_a)._run_with_lease(make_plugin(), node_a)
+
+    lease = coordinator(backend, "b").acquire("fake")
+    assert lease is not None
+    assert lease.last_run_at is None
+    assert not _ran_since_due(make_plugin(), lease)
+
+
+def test_successful_run_is_not_repeated_by_the_other_nodes(context, backend, monkeypatch):
+    monkeypatch.setattr(plugin_scheduler, "run_and_publish", lambda plugin, *, fencing_token=None: None)
+    node_a = coordinator(backend, "a")
+
+    PluginDispatcher(max_workers=1, coordinator=node_a)._run_with_lease(make_plugin(), node_a)
+
+    lease = coordinator(backend, "b").acquire("fake")
+    assert lease.last_run_at is not None
+    assert _ran_since_due(make_plugin(), lease)
+
+
+def test_stopping_frees_held_leases_without_marking_them_done(backend):
+    node_a = coordinator(backend, "a")
+    assert node_a.acquire("fake") is not None
+
+    node_a.stop()
+
+    lease = coordinator(backend, "b").acquire("fake")
+    assert lease is not None
+    assert lease.last_run_at is None
+
+
+@pytest.fixture
+def config_env(tmp_path, monkeypatch):
+    (tmp_path / "plugins.yaml").write_text("plugins: []\n")
+    monkeypatch.chdir(tmp_path)
+    for name, value in {
+        "S3_BUCKET_NAME": "lomnia",
+        "S3_URL": "http://localhost:9000",
+        "S3_REGION_NAME": "us-east-1",
+        "S3_ACCESS_KEY_ID": "key",
+        "S3_SECRET_ACCESS_KEY": "secret",
+        "QUEUE_HOST": "localhost",
+        "QUEUE_PORT": "5672",
+        "QUEUE_USERNAME": "guest",
+        "QUEUE_PASSWORD": "guest",
+        "QUEUE_NAME": "lomnia",
+        "STORE_PATH": str(tmp_path / "state"),
+        "COORDINATION_ENABLED": "true",
+        "COORDINATION_NODE_ID": "a",
+    }.items():
+        monkeypatch.setenv(name, value)
+
+
+def test_coordination_needs_the_sqlite_store(config_env, monkeypatch):
+    monkeypatch.setenv("STORE_BACKEND", "json")
+
+    with pytest.raises(FailedToRunPlugin) as exc_info:
+        load_config()
+
+    assert exc_info.value.args == ("COORDINATION_NEEDS_SQLITE_STORE",)
+
+
+def test_coordination_with_the_sqlite_store(config_env, monkeypatch):
+    monkeypatch.setenv("STORE_BACKEND", "sqlite")
+
+    config = load_config()
+
+    assert config.coordination.coordination_enabled
+    assert config.cache.cache_dir.name == "a"
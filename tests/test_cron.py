@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from lomnia_ingester.cron import CronExpression, InvalidCronExpression
+from lomnia_ingester.models import PluginSchedule
+from lomnia_ingester.plugin_scheduler import add_months, next_due
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+# 2026-01-01 is a Thursday
+@pytest.mark.parametrize(
+    ("expression", "after", "expected"),
+    [
+        ("*/15 * * * *", utc(2026, 1, 1, 10, 7), utc(2026, 1, 1, 10, 15)),
+        ("*/15 * * * *", utc(2026, 1, 1, 10, 15), utc(2026, 1, 1, 10, 30)),
+        ("5/15 * * * *", utc(2026, 1, 1, 10, 0), utc(2026, 1, 1, 10, 5)),
+        ("0 * * * *", utc(2026, 1, 1, 23, 30), utc(2026, 1, 2, 0, 0)),
+        ("30 9 * * 1-5", utc(2026, 1, 2, 10, 0), utc(2026, 1, 5, 9, 30)),
+        ("0 12 1,15 * *", utc(2026, 1, 15, 12, 0), utc(2026, 2, 1, 12, 0)),
+        ("0 0 1 */3 *", utc(2026, 2, 10), utc(2026, 4, 1)),
+        ("0 0 * * 0", utc(2026, 1, 1), utc(2026, 1, 4)),
+        ("0 0 * * 7", utc(2026, 1, 1), utc(2026, 1, 4)),
+        ("0 0 29 2 *", utc(2026, 3, 1), utc(2028, 2, 29)),
+        ("0 0 31 * *", utc(2026, 1, 31), utc(2026, 3, 31)),
+        # Both restricted: either the 13th or a Friday
+        ("0 0 13 * 5", utc(2026, 1, 1), utc(2026, 1, 2)),
+        ("0 0 13 * 5", utc(2026, 1, 9, 12), utc(2026, 1, 13)),
+        # A field starting with * isn't restricted: odd days that are Mondays
+        ("0 0 */2 * 1", utc(2026, 1, 1), utc(2026, 1, 5)),
+        ("0 0 */2 * 1", utc(2026, 1, 5), utc(2026, 1, 19)),
+        # The first week's Sundays, Tuesdays, Thursdays and Saturdays
+        ("0 0 1-7 * */2", utc(2026, 1, 1), utc(2026, 1, 3)),
+    ],
+)
+def test_next_after(expression, after, expected):
+    assert CronExpression.parse(expression).next_after(after) == expected
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "",
+        "* * * *",
+        "* * * * * *",
+        "60 * * * *",
+        "* 24 * * *",
+        "* * 0 * *",
+        "* * * 13 *",
+        "* * * * 8",
+        "*/0 * * * *",
+        "5-1 * * * *",
+        "a * * * *",
+        "1,,2 * * * *",
+    ],
+)
+def test_invalid_expressions(expression):
+    with pytest.raises(InvalidCronExpression):
+        CronExpression.parse(expression)
+
+
+def test_expression_that_never_matches():
+    with pytest.raises(InvalidCronExpression):
+        CronExpression.parse("0 0 30 2 *").next_after(utc(2026, 1, 1))
+
+
+@pytest.mark.parametrize(
+    ("dt", "months", "expected"),
+    [
+        (utc(2026, 1, 15), 1, utc(2026, 2, 15)),
+        (utc(2026, 1, 31), 1, utc(2026, 2, 28)),
+        (utc(2028, 1, 31), 1, utc(2028, 2, 29)),
+        (utc(2026, 11, 30), 3, utc(2027, 2, 28)),
+        (utc(2026, 12, 15, 8, 30), 1, utc(2027, 1, 15, 8, 30)),
+        (utc(2026, 5, 31), 12, utc(2027, 5, 31)),
+        (utc(2026, 3, 31), -1, utc(2026, 2, 28)),
+        (utc(2026, 1, 10), -1, utc(2025, 12, 10)),
+    ],
+)
+def test_add_months(dt, months, expected):
+    assert add_months(dt, months) == expected
+
+
+NOW = utc(2026, 1, 1, 12, 0)
+
+
+@pytest.mark.parametrize(
+    ("schedule", "last_run", "expected"),
+    [
+        ({}, NOW - timedelta(hours=1), None),
+        ({"interval_minutes": 30}, None, NOW + timedelta(minutes=30)),
+        ({"interval_minutes": 30}, NOW - timedelta(minutes=10), NOW + timedelta(minutes=20)),
+        ({"interval_hours": 2}, NOW - timedelta(hours=1), NOW + timedelta(hours=1)),
+        ({"interval_days": 1}, NOW - timedelta(hours=1), NOW + timedelta(hours=23)),
+        ({"interval_months": 1}, utc(2025, 12, 31, 12, 0), utc(2026, 1, 31, 12, 0)),
+        # Missed while the ingester was down: a single run right away
+        ({"interval_minutes": 30}, NOW - timedelta(days=3), NOW),
+        ({"cron": "0 * * * *"}, NOW - timedelta(minutes=1), NOW),
+        ({"cron": "0 * * * *"}, NOW, utc(2026, 1, 1, 13, 0)),
+        ({"cron": "0 0 * * *"}, None, utc(2026, 1, 2)),
+        # The earliest of the configured schedules wins
+        ({"interval_hours": 2, "cron": "30 12 * * *"}, NOW, utc(2026, 1, 1, 12, 30)),
+        ({"interval_minutes": 10, "interval_days": 1}, NOW, NOW + timedelta(minutes=10)),
+    ],
+)
+def test_next_due(schedule, last_run, expected):
+    assert next_due(PluginSchedule(**schedule), last_run, NOW) == expected
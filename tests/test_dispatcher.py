@@ -0,0 +1,148 @@
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from lomnia_ingester import plugin_scheduler
+from lomnia_ingester.models import Plugin
+from lomnia_ingester.plugin_scheduler import PluginDispatcher
+
+
+def make_plugin(plugin_id="fake", **concurrency) -> Plugin:
+    return Plugin(
+        id=plugin_id,
+        path=Path("/plugins/fake"),
+        folder=None,
+        env=None,
+        schedule={"interval_minutes": 1},
+        concurrency=concurrency,
+    )
+
+
+class BlockingRuns:
+    """Stands in for run_and_publish, every run waits until release() is called."""
+
+    def __init__(self):
+        self.started: list[str] = []
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+        self._release = threading.Event()
+
+    def __call__(self, plugin: Plugin, *, fencing_token=None):
+        with self._lock:
+            self.started.append(plugin.id)
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        self._release.wait(10)
+        with self._lock:
+            self.running -= 1
+
+    def release(self):
+        self._release.set()
+
+    def wait_for_starts(self, count: int):
+        deadline = time.monotonic() + 10
+        while len(self.started) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+@pytest.fixture
+def runs(monkeypatch) -> BlockingRuns:
+    runs = BlockingRuns()
+    monkeypatch.setattr(plugin_scheduler, "run_and_publish", runs)
+    return runs
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = PluginDispatcher(max_workers=4)
+    yield dispatcher
+    dispatcher._executor.shutdown(wait=True)
+
+
+def wait_until_idle(dispatcher: PluginDispatcher):
+    deadline = time.monotonic() + 10
+    while any(dispatcher._running.values()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_run_due_while_running_is_skipped(runs, dispatcher):
+    plugin = make_plugin(on_overlap="skip")
+
+    dispatcher.submit(plugin)
+    runs.wait_for_starts(1)
+    dispatcher.submit(plugin)
+    dispatcher.submit(plugin)
+    runs.release()
+    wait_until_idle(dispatcher)
+
+    assert runs.started == ["fake"]
+
+
+def test_queued_runs_are_coalesced_into_one(runs, dispatcher):
+    plugin = make_plugin(on_overlap="queue")
+
+    dispatcher.submit(plugin)
+    runs.wait_for_starts(1)
+    dispatcher.submit(plugin)
+    dispatcher.submit(plugin)
+    runs.release()
+    runs.wait_for_starts(2)
+    wait_until_idle(dispatcher)
+
+    assert runs.started == ["fake", "fake"]
+    assert runs.peak == 1
+
+
+def test_queued_run_of_a_forgotten_plugin_is_dropped(runs, dispatcher):
+    plugin = make_plugin(on_overlap="queue")
+
+    dispatcher.submit(plugin)
+    runs.wait_for_starts(1)
+    dispatcher.submit(plugin)
+    dispatcher.forget(plugin.id)
+    runs.release()
+    wait_until_idle(dispatcher)
+
+    assert runs.started == ["fake"]
+
+
+def test_max_concurrent_runs_allows_overlapping_runs(runs, dispatcher):
+    plugin = make_plugin(max_concurrent_runs=2)
+
+    for _ in range(3):
+        dispatcher.submit(plugin)
+    runs.wait_for_starts(2)
+    runs.release()
+    wait_until_idle(dispatcher)
+
+    assert runs.started == ["fake", "fake"]
+    assert runs.peak == 2
+
+
+def test_plugins_are_limited_independently(runs, dispatcher):
+    dispatcher.submit(make_plugin("first"))
+    dispatcher.submit(make_plugin("second"))
+    runs.wait_for_starts(2)
+    runs.release()
+    wait_until_idle(dispatcher)
+
+    assert sorted(runs.started) == ["first", "second"]
+
+
+def test_run_finished_callback_runs_after_failed_runs_too(monkeypatch, dispatcher):
+    def failing(plugin: Plugin, *, fencing_token=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(plugin_scheduler, "run_and_publish", failing)
+    finished = threading.Event()
+    dispatcher.on_run_finished = lambda plugin: finished.set()
+
+    dispatcher.submit(make_plugin())
+
+    assert finished.wait(10)
+    wait_until_idle(dispatcher)
+    # The slot was given back, the next run isn't skipped
+    assert dispatcher._running["fake"] == 0
@@ -1,5 +0,0 @@
-from lomnia_ingester.foo import foo
-
-
-def test_foo():
-    assert foo("foo") == "foo"
@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+
+# Generous enough for slow CI runners, pydantic alone takes a good part of it
+IMPORT_TIME_BUDGET_SECONDS = 1.5
+
+IMPORT_SCRIPT = """
+import json, sys, time
+import dotenv
+dotenv_calls = []
+dotenv.load_dotenv = lambda *args, **kwargs: dotenv_calls.append(args)
+start = time.perf_counter()
+import lomnia_ingester.plugin_scheduler
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules), "dotenv_calls": len(dotenv_calls)}))
+"""
+
+
+def test_import_is_lazy_and_within_budget(tmp_path):
+    # No configuration at all: importing must not read the environment or plugins.yaml
+    env = {"PATH": os.environ.get("PATH", "")}
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", IMPORT_SCRIPT],
+        cwd=tmp_path,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    report = json.loads(result.stdout)
+
+    assert "boto3" not in report["modules"]
+    assert "pika" not in report["modules"]
+    # .env is only read when the config is loaded
+    assert report["dotenv_calls"] == 0
+    assert report["elapsed"] < IMPORT_TIME_BUDGET_SECONDS
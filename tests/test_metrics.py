@@ -0,0 +1,40 @@
+import pytest
+
+from lomnia_ingester.metrics import Counter, Gauge, Histogram, Registry, _Metric
+
+
+def test_metric_type_without_samples_fails_when_constructed():
+    class Incomplete(_Metric):
+        type_name = "untyped"
+
+    with pytest.raises(TypeError):
+        Incomplete("lomnia_incomplete", "Missing its samples")
+
+
+def test_registry_renders_the_text_format():
+    registry = Registry()
+    runs = registry.register(Counter("lomnia_runs_total", "Finished runs", ("plugin_id",)))
+    in_flight = registry.register(Gauge("lomnia_in_flight", "Runs going", ("plugin_id",)))
+    seconds = registry.register(Histogram("lomnia_seconds", "Run time", ("plugin_id",), buckets=(1, 10)))
+
+    runs.inc(plugin_id="fake")
+    runs.inc(2, plugin_id="fake")
+    in_flight.inc(plugin_id="fake")
+    in_flight.dec(plugin_id="fake")
+    seconds.observe(5, plugin_id='say "hi"')
+
+    assert registry.render().splitlines() == [
+        "# HELP lomnia_runs_total Finished runs",
+        "# TYPE lomnia_runs_total counter",
+        'lomnia_runs_total{plugin_id="fake"} 3',
+        "# HELP lomnia_in_flight Runs going",
+        "# TYPE lomnia_in_flight gauge",
+        'lomnia_in_flight{plugin_id="fake"} 0',
+        "# HELP lomnia_seconds Run time",
+        "# TYPE lomnia_seconds histogram",
+        'lomnia_seconds_bucket{plugin_id="say \\"hi\\"",le="1"} 0',
+        'lomnia_seconds_bucket{plugin_id="say \\"hi\\"",le="10"} 1',
+        'lomnia_seconds_bucket{plugin_id="say \\"hi\\"",le="+Inf"} 1',
+        'lomnia_seconds_sum{plugin_id="say \\"hi\\""} 5.0',
+        'lomnia_seconds_count{plugin_id="say \\"hi\\""} 1',
+    ]
@@ -0,0 +1,89 @@
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+
+from lomnia_ingester.fakes import InMemoryQueuePublisher, InMemoryStorage
+from lomnia_ingester.models import PluginOutput
+from lomnia_ingester.outbox import Outbox
+from lomnia_ingester.plugin_output_publisher import PluginOutputPublisher
+
+
+def test_outbox_is_read_back_after_a_restart(tmp_path):
+    path = tmp_path / "outbox.jsonl"
+    outbox = Outbox(path)
+    outbox.record_upload("canonical", Path("a.json"), "lomnia", "plugins/fake/canonical/a.json", duplicate=False)
+    outbox.record_published(["plugins/fake/canonical/a.json"])
+
+    reloaded = Outbox(path)
+
+    assert reloaded.upload("canonical", Path("/elsewhere/a.json")) == {
+        "type": "upload",
+        "file": "canonical/a.json",
+        "bucket": "lomnia",
+        "key": "plugins/fake/canonical/a.json",
+        "duplicate": False,
+    }
+    assert reloaded.upload("raw", Path("a.json")) is None
+    assert reloaded.is_published("plugins/fake/canonical/a.json")
+    assert not reloaded.is_published("plugins/fake/canonical/b.json")
+
+
+def test_outbox_ignores_a_line_cut_short(tmp_path):
+    path = tmp_path / "outbox.jsonl"
+    Outbox(path).record_upload("raw", Path("a.json"), "lomnia", "plugins/fake/raw/a.json", duplicate=False)
+    with path.open("a") as f:
+        f.write('{"type": "published", "ke')
+
+    outbox = Outbox(path)
+
+    assert outbox.upload("raw", Path("a.json")) is not None
+    assert not outbox.is_published("plugins/fake/raw/a.json")
+
+
+class FailingQueuePublisher(InMemoryQueuePublisher):
+    def __init__(self):
+        super().__init__()
+        self.fail = True
+
+    def publish_batch(self, messages: list[bytes]):
+        if self.fail:
+            raise ConnectionError
+        super().publish_batch(messages)
+
+
+def test_retried_delivery_only_sends_what_is_missing(tmp_path):
+    raw = tmp_path / "raw"
+    canonical = tmp_path / "canonical"
+    raw.mkdir()
+    canonical.mkdir()
+    for name in ("a.json", "b.json"):
+        (raw / name).write_text("{}")
+        (canonical / name).write_text("{}")
+    output = PluginOutput(
+        raw=raw, canonical=canonical, extracted_at=datetime(2026, 1, 1, tzinfo=timezone.utc), id="fake"
+    )
+
+    storage = InMemoryStorage()
+    queue = FailingQueuePublisher()
+    publisher = PluginOutputPublisher(storage, queue)
+    outbox = Outbox(tmp_path / "outbox.jsonl")
+
+    with pytest.raises(ConnectionError):
+        publisher.handle_output(output, outbox=outbox)
+    uploads = storage.requests
+    assert uploads == 4
+
+    queue.fail = False
+    stats = publisher.handle_output(output, outbox=Outbox(tmp_path / "outbox.jsonl"))
+
+    # The files were uploaded by the first attempt, only the events are left
+    assert storage.requests == uploads
+    assert stats.raw_files == 0
+    assert stats.canonical_files == 0
+    assert stats.events_published == 2
+
+    # Everything was delivered, a further attempt has nothing to do
+    stats = publisher.handle_output(output, outbox=Outbox(tmp_path / "outbox.jsonl"))
+    assert stats.events_published == 0
+    assert len(queue.messages) == 2
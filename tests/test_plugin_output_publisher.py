@@ -0,0 +1,73 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from lomnia_ingester.fakes import InMemoryQueuePublisher, InMemoryStorage
+from lomnia_ingester.models import PluginOutput
+from lomnia_ingester.plugin_output_publisher import PluginOutputPublisher
+from lomnia_ingester.storage.upload_index import UploadIndex
+
+
+def make_output(tmp_path, day: int) -> PluginOutput:
+    run_dir = tmp_path / f"run-{day}"
+    raw = run_dir / "raw"
+    canonical = run_dir / "canonical"
+    raw.mkdir(parents=True)
+    canonical.mkdir()
+    (raw / "data.json").write_text("{}")
+    (canonical / f"data-{day}.json").write_text('{"same": "content"}')
+    return PluginOutput(
+        raw=raw, canonical=canonical, extracted_at=datetime(2026, 1, day, tzinfo=timezone.utc), id="fake"
+    )
+
+
+def published_keys(queue: InMemoryQueuePublisher) -> list[str]:
+    return [json.loads(message)["key"] for message in queue.messages]
+
+
+@pytest.mark.parametrize("hash_mode", ["before_upload", "during_upload"])
+def test_duplicate_content_is_announced_once(tmp_path, hash_mode):
+    storage = InMemoryStorage()
+    queue = InMemoryQueuePublisher()
+    publisher = PluginOutputPublisher(
+        storage, queue, upload_index=UploadIndex(tmp_path / "index.db"), hash_mode=hash_mode
+    )
+
+    publisher.handle_output(make_output(tmp_path, 1))
+    stats = publisher.handle_output(make_output(tmp_path, 2))
+
+    assert published_keys(queue) == ["plugins/fake/canonical/2026/01/01/data-1.json"]
+    assert stats.events_published == 0
+
+
+def test_skip_mode_uploads_again_when_the_indexed_object_is_gone(tmp_path):
+    storage = InMemoryStorage()
+    queue = InMemoryQueuePublisher()
+    publisher = PluginOutputPublisher(storage, queue, upload_index=UploadIndex(tmp_path / "index.db"))
+
+    publisher.handle_output(make_output(tmp_path, 1))
+    # e.g. expired by a lifecycle rule
+    del storage.objects["plugins/fake/canonical/2026/01/01/data-1.json"]
+    stats = publisher.handle_output(make_output(tmp_path, 2))
+
+    assert "plugins/fake/canonical/2026/01/02/data-2.json" in storage.objects
+    assert published_keys(queue)[-1] == "plugins/fake/canonical/2026/01/02/data-2.json"
+    assert stats.canonical_files == 1
+    assert stats.events_published == 1
+
+
+def test_copy_mode_uploads_again_when_the_indexed_object_is_gone(tmp_path):
+    storage = InMemoryStorage()
+    publisher = PluginOutputPublisher(
+        storage, InMemoryQueuePublisher(), upload_index=UploadIndex(tmp_path / "index.db"), dedup_mode="copy"
+    )
+
+    publisher.handle_output(make_output(tmp_path, 1))
+    publisher.handle_output(make_output(tmp_path, 2))
+    assert "plugins/fake/canonical/2026/01/02/data-2.json" in storage.objects
+
+    storage.objects.clear()
+    publisher.handle_output(make_output(tmp_path, 3))
+
+    assert "plugins/fake/canonical/2026/01/03/data-3.json" in storage.objects
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from lomnia_ingester.models import FailedToRunPlugin, ScheduleBackoff
+from lomnia_ingester.plugin_state_store import PluginStateStore, SqlitePluginStateStore
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def test_next_start_date_round_trip(store):
+    store.set_next_start_date("fake", START, last_successful_run=START + timedelta(hours=1))
+
+    assert store.get_next_start_date("fake") == START
+    assert store.get_last_successful_run("fake") == START + timedelta(hours=1)
+    assert store.get_next_start_date("other") is None
+
+
+def test_sqlite_store_imports_the_json_state(tmp_path):
+    json_store = PluginStateStore(tmp_path / "plugins_state.json")
+    json_store.set_next_start_date("fake", START, last_successful_run=START)
+
+    store = SqlitePluginStateStore(tmp_path / "state.db", migrate_from=tmp_path / "plugins_state.json")
+
+    assert store.get_next_start_date("fake") == START
+    assert store.get_last_successful_run("fake") == START
+
+
+def test_windows_are_cleared_up_to_the_watermark(store):
+    for day in range(3):
+        store.record_window("fake", START + timedelta(days=day), START + timedelta(days=day + 1))
+
+    store.clear_windows("fake", before=START + timedelta(days=2))
+
+    assert store.completed_windows("fake") == {START + timedelta(days=2): START + timedelta(days=3)}
+
+
+def assert_stale(exc_info):
+    assert exc_info.value.args == ("STALE_FENCING_TOKEN",)
+
+
+def test_write_with_a_stale_fencing_token_is_rejected(store):
+    store.set_next_start_date("fake", START, fencing_token=2)
+
+    with pytest.raises(FailedToRunPlugin) as exc_info:
+        store.set_next_start_date("fake", START + timedelta(days=1), fencing_token=1)
+
+    assert_stale(exc_info)
+    assert store.get_next_start_date("fake") == START
+
+
+def test_newer_and_unfenced_writes_go_through(store):
+    store.set_next_start_date("fake", START, fencing_token=2)
+    store.set_next_start_date("fake", START + timedelta(days=1), fencing_token=2)
+    store.set_next_start_date("fake", START + timedelta(days=2), fencing_token=3)
+    # Writes outside of a lease aren't fenced
+    store.set_next_start_date("fake", START + timedelta(days=3))
+
+    assert store.get_next_start_date("fake") == START + timedelta(days=3)
+
+    with pytest.raises(FailedToRunPlugin):
+        store.set_next_start_date("fake", START, fencing_token=2)
+
+
+def test_fencing_tokens_are_per_plugin(store):
+    store.set_next_start_date("fake", START, fencing_token=5)
+    store.set_next_start_date("other", START, fencing_token=1)
+
+    assert store.get_next_start_date("other") == START
+
+
+def test_stale_window_and_backoff_writes_are_rejected(store):
+    store.record_window("fake", START, START + timedelta(days=1), fencing_token=2)
+
+    with pytest.raises(FailedToRunPlugin) as exc_info:
+        store.record_window("fake", START + timedelta(days=1), START + timedelta(days=2), fencing_token=1)
+    assert_stale(exc_info)
+
+    with pytest.raises(FailedToRunPlugin) as exc_info:
+        store.set_schedule_backoff("fake", ScheduleBackoff(empty_runs=1), fencing_token=1)
+    assert_stale(exc_info)
+
+    assert store.completed_windows("fake") == {START: START + timedelta(days=1)}
+    assert store.get_schedule_backoff("fake") is None
+
+
+def test_schedule_backoff_round_trip(store):
+    backoff = ScheduleBackoff(empty_runs=4, interval_seconds=1200, updated_at=START)
+    store.set_schedule_backoff("fake", backoff)
+
+    assert store.get_schedule_backoff("fake") == backoff
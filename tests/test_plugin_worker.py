@@ -0,0 +1,180 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from lomnia_ingester.models import FailedToRunPlugin, Plugin, PluginResources
+from lomnia_ingester.plugin_worker import PluginWorker, PluginWorkerPool, worker_key
+
+PLUGIN_SOURCE = """
+import argparse
+import os
+import time
+
+
+def extract():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sleep", type=float, default=0)
+    args = parser.parse_args()
+    print(f"extract pid={os.getpid()} worker={os.getppid()}")
+    time.sleep(args.sleep)
+
+
+def transform():
+    return 3
+"""
+
+# Stands in for uv: the worker is started with `uv run --no-sync python <script> <fd>`
+UV_SHIM = """#!{python}
+import os
+import sys
+
+args = sys.argv[1:]
+if args[:3] != ["run", "--no-sync", "python"]:
+    sys.exit(f"unexpected uv command: {{args}}")
+os.execv({python!r}, [{python!r}, *args[3:]])
+"""
+
+
+@pytest.fixture
+def plugin_env(tmp_path, monkeypatch) -> dict[str, str]:
+    """A plugin exposing extract and transform console scripts, and a uv on PATH that runs the worker with it."""
+    site = tmp_path / "site"
+    dist_info = site / "fakeplugin-0.1.dist-info"
+    dist_info.mkdir(parents=True)
+    (site / "fakeplugin.py").write_text(PLUGIN_SOURCE)
+    (dist_info / "METADATA").write_text("Metadata-Version: 2.1\nName: fakeplugin\nVersion: 0.1\n")
+    (dist_info / "entry_points.txt").write_text(
+        "[console_scripts]\nextract = fakeplugin:extract\ntransform = fakeplugin:transform\n"
+    )
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    uv = bin_dir / "uv"
+    uv.write_text(textwrap.dedent(UV_SHIM.format(python=sys.executable)))
+    uv.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}")
+
+    return {"PATH": os.environ["PATH"], "PYTHONPATH": str(site)}
+
+
+@pytest.fixture
+def worker(tmp_path, plugin_env):
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    worker = PluginWorker("fake", worker_key(work_dir, plugin_env), work_dir, plugin_env)
+    yield worker
+    worker.retire()
+
+
+def run(worker: PluginWorker, command: str, args: list[str], timeout=None):
+    return worker.run(command, args, description=f"plugin {command}", resources=PluginResources(), timeout=timeout)
+
+
+def assert_exited(pid: int):
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+
+def test_worker_runs_commands_forked_from_the_warm_process(worker):
+    assert worker.commands == {"extract", "transform"}
+
+    first = run(worker, "extract", [])
+    second = run(worker, "extract", [])
+
+    # Each command is a fresh child of the same worker
+    assert f"worker={worker.process.pid}" in first.stdout
+    assert first.stdout != second.stdout
+    assert first.returncode == 0
+    assert worker.runs == 2
+
+
+def test_worker_reports_the_exit_code_of_a_failing_command(worker):
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        run(worker, "transform", [])
+
+    assert exc_info.value.returncode == 3
+    # The worker itself is fine and takes the next command
+    assert run(worker, "extract", []).returncode == 0
+
+
+def test_worker_command_timeout_kills_the_command(worker):
+    started = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        run(worker, "extract", ["--sleep", "30"], timeout=0.5)
+
+    assert time.monotonic() - started < 15
+    assert worker.usable(worker.key, max_runs=100)
+    assert run(worker, "extract", []).returncode == 0
+
+
+def test_worker_dying_mid_command_fails_the_command(worker):
+    result: dict = {}
+
+    def target():
+        try:
+            run(worker, "extract", ["--sleep", "30"])
+        except subprocess.CalledProcessError as exc:
+            result["returncode"] = exc.returncode
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    time.sleep(0.5)
+    os.kill(worker.process.pid, signal.SIGKILL)
+    thread.join(timeout=15)
+
+    assert not thread.is_alive()
+    assert result["returncode"] == -signal.SIGKILL
+    assert not worker.usable(worker.key, max_runs=100)
+
+
+def test_worker_gives_up_on_an_unreadable_message(worker, monkeypatch):
+    handle_event = worker._handle_event
+
+    def broken(event: dict):
+        if event["event"] == "started":
+            raise KeyError("pid")
+        handle_event(event)
+
+    monkeypatch.setattr(worker, "_handle_event", broken)
+
+    # The command doesn't wait for the worker's spawn timeout, it fails as soon as the reader gives up
+    started = time.monotonic()
+    with pytest.raises(FailedToRunPlugin):
+        run(worker, "extract", [])
+
+    assert time.monotonic() - started < 5
+    assert not worker.usable(worker.key, max_runs=100)
+
+
+def test_pool_replaces_the_worker_after_worker_max_runs(tmp_path, plugin_env):
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    plugin = Plugin(
+        id="fake",
+        path=Path(work_dir),
+        folder=None,
+        env=None,
+        schedule={"interval_minutes": 1},
+        execution={"mode": "worker", "worker_max_runs": 2},
+    )
+    pool = PluginWorkerPool()
+    pids = []
+    try:
+        for _ in range(3):
+            with pool.worker(plugin, work_dir, plugin_env) as worker:
+                run(worker, "extract", [])
+                pids.append(worker.process.pid)
+    finally:
+        pool.close()
+
+    assert pids[0] == pids[1]
+    assert pids[2] != pids[0]
+    # The replaced worker stopped once it was done
+    assert_exited(pids[0])
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from lomnia_ingester.models import Plugin, ScheduleBackoff
+from lomnia_ingester.plugin_scheduler import PluginDispatcher, PluginScheduler, next_backoff
+
+NOW = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def make_plugin(plugin_id="fake", schedule=None, **fields) -> Plugin:
+    fields = {"folder": None, "env": None, **fields}
+    return Plugin(id=plugin_id, path=Path("/plugins/fake"), schedule=schedule or {"interval_minutes": 30}, **fields)
+
+
+@pytest.fixture
+def scheduler(context):
+    dispatcher = PluginDispatcher(max_workers=1)
+    yield PluginScheduler(dispatcher)
+    dispatcher._executor.shutdown(wait=True)
+
+
+def due_at(scheduler: PluginScheduler, plugin_id: str) -> Optional[datetime]:
+    """The live heap entry of a plugin, the others are dropped when they reach the top."""
+    entry = scheduler._entries.get(plugin_id)
+    return next((due for due, heap_entry, _ in scheduler._heap if heap_entry == entry), None)
+
+
+def test_reload_only_touches_the_plugins_that_changed(scheduler, store):
+    last_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    store.set_next_start_date("kept", last_run, last_successful_run=last_run)
+    store.set_next_start_date("rescheduled", last_run, last_successful_run=last_run)
+    kept = make_plugin("kept")
+    rescheduled = make_plugin("rescheduled")
+    updated = make_plugin("updated")
+    for plugin in (kept, rescheduled, updated, make_plugin("removed")):
+        scheduler.add(plugin)
+    entries = dict(scheduler._entries)
+
+    new_updated = make_plugin("updated", env={"TOKEN": "new"})
+    scheduler.reload([
+        kept,
+        make_plugin("rescheduled", schedule={"interval_hours": 2}),
+        new_updated,
+        make_plugin("added", run_on_startup=True),
+    ])
+
+    assert set(scheduler._plugins) == {"kept", "rescheduled", "updated", "added"}
+    assert "removed" not in scheduler._entries
+    # Unchanged and updated plugins keep their due time, only the plugin itself is replaced
+    assert scheduler._entries["kept"] == entries["kept"]
+    assert scheduler._entries["updated"] == entries["updated"]
+    assert scheduler._plugins["updated"] is new_updated
+    # A new schedule counts from the last run
+    assert due_at(scheduler, "rescheduled") == last_run + timedelta(hours=2)
+    # run_on_startup runs a new plugin right away
+    assert due_at(scheduler, "added") <= datetime.now(timezone.utc)
+
+
+def test_reload_with_the_same_plugins_changes_nothing(scheduler):
+    plugins = [make_plugin("first"), make_plugin("second", schedule={"cron": "0 * * * *"})]
+    for plugin in plugins:
+        scheduler.add(plugin)
+    entries = dict(scheduler._entries)
+
+    scheduler.reload(plugins)
+
+    assert scheduler._entries == entries
+
+
+def test_plugin_without_schedule_is_not_scheduled(scheduler):
+    scheduler.add(make_plugin(schedule={"jitter_seconds": 5}))
+
+    assert "fake" in scheduler._plugins
+    assert "fake" not in scheduler._entries
+
+
+ADAPTIVE = {"interval_minutes": 10, "adaptive": {"enabled": True, "empty_runs_before_backoff": 3}}
+
+
+@pytest.mark.parametrize(
+    ("backoff", "produced_data", "expected"),
+    [
+        # Data resets the backoff
+        (ScheduleBackoff(empty_runs=5, interval_seconds=2400), True, ScheduleBackoff(0, None)),
+        # Below empty_runs_before_backoff the regular schedule stays
+        (None, False, ScheduleBackoff(1, None)),
+        (ScheduleBackoff(empty_runs=1), False, ScheduleBackoff(2, None)),
+        # Then each empty run doubles the interval, starting from the regular 10 minutes
+        (ScheduleBackoff(empty_runs=2), False, ScheduleBackoff(3, 1200)),
+        (ScheduleBackoff(empty_runs=3, interval_seconds=1200), False, ScheduleBackoff(4, 2400)),
+        # Up to max_interval_minutes
+        (ScheduleBackoff(empty_runs=4, interval_seconds=2400), False, ScheduleBackoff(5, 3600)),
+        (ScheduleBackoff(empty_runs=5, interval_seconds=3600), False, ScheduleBackoff(6, 3600)),
+    ],
+)
+def test_next_backoff(backoff, produced_data, expected):
+    plugin = make_plugin(schedule=ADAPTIVE)
+
+    result = next_backoff(plugin, backoff, produced_data=produced_data, now=NOW)
+
+    assert (result.empty_runs, result.interval_seconds) == (expected.empty_runs, expected.interval_seconds)
+    assert result.updated_at == NOW
+
+
+def test_next_backoff_without_a_regular_schedule_only_counts():
+    plugin = make_plugin(schedule={"adaptive": {"enabled": True, "empty_runs_before_backoff": 1}})
+
+    result = next_backoff(plugin, ScheduleBackoff(empty_runs=3), produced_data=False, now=NOW)
+
+    assert (result.empty_runs, result.interval_seconds) == (4, None)
+
+
+def test_backed_off_plugin_is_due_after_its_backoff_interval(scheduler, store):
+    last_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    store.set_next_start_date("fake", last_run, last_successful_run=last_run)
+    store.set_schedule_backoff("fake", ScheduleBackoff(empty_runs=4, interval_seconds=2400, updated_at=last_run))
+
+    scheduler.add(make_plugin(schedule=ADAPTIVE))
+
+    assert due_at(scheduler, "fake") == last_run + timedelta(minutes=40)
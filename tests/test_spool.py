@@ -0,0 +1,88 @@
+import json
+import time
+from datetime import datetime, timezone
+
+from lomnia_ingester.fakes import InMemoryQueuePublisher, InMemoryStorage
+from lomnia_ingester.models import PluginOutput, PluginRun, UploadStats
+from lomnia_ingester.plugin_output_publisher import PluginOutputPublisher
+from lomnia_ingester.plugin_state_store import SqlitePluginStateStore
+from lomnia_ingester.spool import OutputSpool, SpoolUploader
+
+
+def make_output(tmp_path, plugin_id="fake") -> PluginOutput:
+    raw = tmp_path / "raw"
+    canonical = tmp_path / "canonical"
+    raw.mkdir()
+    canonical.mkdir()
+    (raw / "data.json").write_text("{}")
+    (canonical / "data.json").write_text("{}")
+    return PluginOutput(raw=raw, canonical=canonical, extracted_at=datetime.now(timezone.utc), id=plugin_id)
+
+
+def test_pending_moves_unreadable_entries_to_failed(tmp_path):
+    spool = OutputSpool(tmp_path / "spool")
+    good = spool.enqueue(make_output(tmp_path))
+    for name, manifest in [("half-written", "{"), ("not-an-object", "[]"), ("missing", None)]:
+        (spool.pending_dir / name).mkdir()
+        if manifest is not None:
+            (spool.pending_dir / name / "manifest.json").write_text(manifest)
+
+    assert spool.pending() == [good]
+    assert sorted(entry.name for entry in spool.failed_dir.iterdir()) == ["half-written", "missing", "not-an-object"]
+
+
+def test_pending_waits_for_the_retry_backoff(tmp_path):
+    spool = OutputSpool(tmp_path / "spool")
+    entry = spool.enqueue(make_output(tmp_path))
+
+    spool.fail(entry, "boom", max_attempts=3, backoff_seconds=60)
+    assert spool.pending() == []
+
+    spool.fail(entry, "boom", max_attempts=3, backoff_seconds=60)
+    spool.fail(entry, "boom", max_attempts=3, backoff_seconds=60)
+    assert not entry.exists()
+    assert json.loads((spool.failed_dir / entry.name / "manifest.json").read_text())["attempts"] == 3
+
+
+def test_uploader_records_the_upload_stats_on_the_spooled_run(tmp_path):
+    store = SqlitePluginStateStore(tmp_path / "state.db")
+    spool = OutputSpool(tmp_path / "spool")
+    publisher = PluginOutputPublisher(InMemoryStorage(), InMemoryQueuePublisher())
+    uploader = SpoolUploader(spool, publisher, store=store, poll_interval_seconds=0.05)
+
+    started_at = datetime.now(timezone.utc)
+    spool.enqueue(make_output(tmp_path), run_started_at=started_at)
+    store.record_run(
+        PluginRun(
+            plugin_id="fake", started_at=started_at, finished_at=started_at, status="success", stats=UploadStats()
+        )
+    )
+
+    uploader.start()
+    try:
+        deadline = time.monotonic() + 10
+        while any(spool.pending_dir.iterdir()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        uploader.stop()
+
+    [run] = store.runs("fake")
+    assert run["raw_files"] == 1
+    assert run["canonical_files"] == 1
+    assert run["events_published"] == 1
+
+
+def test_delivery_recorded_before_its_run_is_kept_for_it(tmp_path):
+    store = SqlitePluginStateStore(tmp_path / "state.db")
+    started_at = datetime.now(timezone.utc)
+
+    store.record_delivery("fake", started_at, UploadStats(raw_files=2, canonical_files=2, events_published=2))
+    store.record_run(
+        PluginRun(
+            plugin_id="fake", started_at=started_at, finished_at=started_at, status="success", stats=UploadStats()
+        )
+    )
+
+    [run] = store.runs("fake")
+    assert run["raw_files"] == 2
+    assert run["events_published"] == 2
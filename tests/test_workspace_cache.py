@@ -0,0 +1,104 @@
+import os
+from pathlib import Path
+
+from lomnia_ingester.cache.lru import LAST_USED_MARKER, evict_lru
+from lomnia_ingester.cache.workspace import WorkspaceCache, sync_tree
+from lomnia_ingester.models import Plugin
+
+
+def write(path: Path, content: str = "x", mtime: int = 1_700_000_000) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def tree(root: Path) -> set[str]:
+    return {str(path.relative_to(root)) for path in root.rglob("*") if path.is_file()}
+
+
+def test_sync_tree_mirrors_the_source(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    write(src / "main.py")
+    write(src / "pkg" / "module.py")
+    write(src / "__pycache__" / "main.cpython-311.pyc")
+
+    assert sync_tree(src, dst) == 2
+    assert tree(dst) == {"main.py", "pkg/module.py"}
+
+
+def test_sync_tree_copies_only_changed_files(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    write(src / "main.py", "a")
+    write(src / "other.py", "b")
+    sync_tree(src, dst)
+
+    assert sync_tree(src, dst) == 0
+
+    write(src / "main.py", "changed", mtime=1_700_000_100)
+    assert sync_tree(src, dst) == 1
+    assert (dst / "main.py").read_text() == "changed"
+
+
+def test_sync_tree_removes_stale_files_but_keeps_ignored_ones(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    write(src / "main.py")
+    write(src / "old" / "module.py")
+    sync_tree(src, dst)
+    # Created in the checkout by uv and the cache, they aren't in the source
+    write(dst / ".venv" / "pyvenv.cfg")
+    write(dst / LAST_USED_MARKER)
+
+    (src / "old" / "module.py").unlink()
+    (src / "old").rmdir()
+    sync_tree(src, dst)
+
+    assert tree(dst) == {"main.py", ".venv/pyvenv.cfg", LAST_USED_MARKER}
+    assert not (dst / "old").exists()
+
+
+def make_entry(root: Path, name: str, size: int, last_used: int) -> Path:
+    entry = root / name
+    write(entry / "data", "x" * size)
+    write(entry / LAST_USED_MARKER, "", mtime=last_used)
+    return entry
+
+
+def test_evict_lru_removes_least_recently_used_entries_first(tmp_path):
+    oldest = make_entry(tmp_path, "oldest", 100, last_used=1000)
+    older = make_entry(tmp_path, "older", 100, last_used=2000)
+    newest = make_entry(tmp_path, "newest", 100, last_used=3000)
+
+    evict_lru(tmp_path, max_bytes=150)
+
+    assert not oldest.exists()
+    assert not older.exists()
+    assert newest.exists()
+
+
+def test_evict_lru_stops_once_it_fits_and_keeps_entries_in_use(tmp_path):
+    oldest = make_entry(tmp_path, "oldest", 100, last_used=1000)
+    older = make_entry(tmp_path, "older", 100, last_used=2000)
+    newest = make_entry(tmp_path, "newest", 100, last_used=3000)
+    removed = []
+
+    evict_lru(tmp_path, max_bytes=200, keep={oldest}, remove=removed.append)
+
+    assert removed == [older]
+    assert newest.exists()
+
+
+def test_local_checkout_is_not_synced_while_in_use(tmp_path):
+    src = tmp_path / "plugin"
+    write(src / "main.py", "v1")
+    plugin = Plugin(id="fake", path=src, folder=None, env=None, schedule={"interval_minutes": 1})
+    cache = WorkspaceCache(tmp_path / "cache", max_bytes=1024**3)
+
+    with cache.checkout(plugin) as entry:
+        write(src / "main.py", "v2", mtime=1_700_000_100)
+        with cache.checkout(plugin) as second:
+            assert second == entry
+            assert (entry / "main.py").read_text() == "v1"
+
+    with cache.checkout(plugin) as entry:
+        assert (entry / "main.py").read_text() == "v2"